@@ -27,3 +27,12 @@ ERROR_SAME_CURRENCY = 'Account %s and %s must have different currencies'
 ERROR_DIFFERENT_CURRENCY = 'Account %s and %s must have same currency'
 ERROR_MODEL_NOT_FOUND = 'Invalid %s PK'
 ERROR_MODEL = 'Invalid %s'
+
+# account balance snapshots taken at start of each period
+SNAPSHOT_PERIOD_DAY = 'D'
+SNAPSHOT_PERIOD_MONTH = 'M'
+
+SNAPSHOT_PERIODS = (
+    (SNAPSHOT_PERIOD_DAY, 'Daily'),
+    (SNAPSHOT_PERIOD_MONTH, 'Monthly'),
+)
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounting.constants import SNAPSHOT_PERIODS
+from accounting.models import Account
+from accounting.services import AccountingService
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds accounts balance snapshots from their movements'
+
+    def add_arguments(self, parser):
+        parser.add_argument('accounts', nargs='*', type=int, help='Account ids, all by default')
+        parser.add_argument(
+            '--period', choices=[period for period, name in SNAPSHOT_PERIODS],
+            help='Snapshot period, configured one by default')
+
+    def handle(self, *args, **options):
+        accounts = Account.objects.order_by('pk')
+        if options['accounts']:
+            accounts = accounts.filter(pk__in=options['accounts'])
+            if accounts.count() != len(set(options['accounts'])):
+                raise CommandError('Unknown account in %s' % options['accounts'])
+        for account in accounts:
+            count = AccountingService.build_balance_snapshots(account, options['period'])
+            self.stdout.write('%s: %s snapshots' % (account, count))
@@ -0,0 +1,36 @@
+# Generated by Django 2.2.28 on 2026-10-18 20:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0005_auto_20230522_1258'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='operation',
+            name='datetime',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.CreateModel(
+            name='AccountBalanceSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('D', 'Daily'), ('M', 'Monthly')], max_length=1)),
+                ('datetime', models.DateTimeField()),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='accounting.Account')),
+            ],
+            options={
+                'verbose_name': 'Account Balance Snapshot',
+                'verbose_name_plural': 'Accounts Balances Snapshots',
+                'default_permissions': ('view',),
+                'unique_together': {('account', 'period', 'datetime')},
+            },
+        ),
+    ]
@@ -1,12 +1,12 @@
 from decimal import ROUND_HALF_EVEN, Decimal
-from django.db import connection, models
+from django.db import models
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 
 from accounting.constants import (
     CURRENCIES, CURRENCY_CUC, MOVEMENT_TYPES, MOVEMENT_TYPE_INPUT,
-    MOVEMENT_TYPE_OUTPUT)
+    MOVEMENT_TYPE_OUTPUT, SNAPSHOT_PERIODS)
 
 
 class Account(models.Model):
@@ -25,39 +25,34 @@ class Account(models.Model):
         return '%s (%s)' % (self.name, self.get_currency_display())
 
     def fix_balance(self):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE accounting_account a SET a.balance = (
-                    SELECT COALESCE(
-                        SUM(CASE WHEN movement_type = '%s' THEN 1 ELSE -1 END * amount),
-                        0)
-                    FROM accounting_operationmovement
-                    WHERE account_id = a.id)
-                WHERE id = %s
-                """, [MOVEMENT_TYPE_INPUT, self.pk])
-            self.refresh_from_db()
-        finally:
-            cursor.close()
+        self.recalculate_balance()
+        self.refresh_from_db()
+
+    def balance_at(self, when=None, included=True):
+        """
+        Computes the balance at when, or with all movements, from the last
+        balance snapshot before plus the movements after it
+        """
+        snapshots = self.accountbalancesnapshot_set.order_by('-datetime')
+        if when is not None:
+            snapshots = snapshots.filter(datetime__lte=when)
+        snapshot = snapshots.first()
+        if snapshot is None:
+            return OperationMovement.total(self.pk, until=when, included=included)
+        return snapshot.balance + OperationMovement.total(
+            self.pk, since=snapshot.datetime, until=when, included=included)
 
     def check_balance(self):
         """
-        Computes the balance of the account with the database movements
+        Computes the balance of the account with the last balance snapshot
+        and the database movements after it
         To check the balance is correct
         """
-        all_movs = OperationMovement.objects.filter(account_id=self.id)
-        sum_in = all_movs.filter(
-            movement_type=MOVEMENT_TYPE_INPUT).aggregate(
-                models.Sum('amount'))
-        sum_out = all_movs.filter(
-            movement_type=MOVEMENT_TYPE_OUTPUT).aggregate(
-                models.Sum('amount'))
-        total_in = sum_in['amount__sum'] or 0
-        total_out = sum_out['amount__sum'] or 0
-        if self.balance == total_in - total_out:
+        balance = self.balance_at()
+        if self.balance == balance:
             # everything is fine
             return True, self.balance
-        return False, total_in - total_out
+        return False, balance
 
     def recalculate_balance(self):
         """ computes and updates self.balance if wrong
@@ -74,18 +69,8 @@ class Account(models.Model):
 
     @classmethod
     def fix_balances(cls):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE accounting_account a SET a.balance = (
-                    SELECT COALESCE(
-                        SUM(CASE WHEN movement_type = '%s' THEN 1 ELSE -1 END * amount),
-                        0)
-                    FROM accounting_operationmovement
-                    WHERE account_id = a.id)
-            """, MOVEMENT_TYPE_INPUT)
-        finally:
-            cursor.close()
+        for account in cls.objects.all():
+            account.recalculate_balance()
 
 
 class Operation(models.Model):
@@ -98,7 +83,7 @@ class Operation(models.Model):
         on_delete=models.PROTECT,
         help_text='User who did the operation.',
     )
-    datetime = models.DateTimeField(default=timezone.now)
+    datetime = models.DateTimeField(default=timezone.now, db_index=True)
     concept = models.CharField(max_length=50)
     detail = models.CharField(max_length=200)
 
@@ -157,8 +142,44 @@ class OperationMovement(models.Model):
                     movement.final_account_balance = initial_balance
                     movement.save(update_fields=['final_account_balance'])
 
+    @classmethod
+    def total(cls, account_id, since=None, until=None, included=True):
+        """
+        Sums account movements with operation datetime from since and up to until
+        """
+        movements = cls.objects.filter(account_id=account_id)
+        if since is not None:
+            movements = movements.filter(operation__datetime__gte=since)
+        if until is not None:
+            if included:
+                movements = movements.filter(operation__datetime__lte=until)
+            else:
+                movements = movements.filter(operation__datetime__lt=until)
+        totals = movements.aggregate(
+            total_in=models.Sum('amount', filter=models.Q(movement_type=MOVEMENT_TYPE_INPUT)),
+            total_out=models.Sum('amount', filter=models.Q(movement_type=MOVEMENT_TYPE_OUTPUT)))
+        return (totals['total_in'] or Decimal(0)) - (totals['total_out'] or Decimal(0))
+
     @property
     def balance_before(self):
         return self.final_account_balance + self.amount
 
     balance_before.fget.short_description = "Balance Before"
+
+
+class AccountBalanceSnapshot(models.Model):
+    """
+    Account balance with movements before datetime, start of a period
+    """
+    class Meta:
+        verbose_name = 'Account Balance Snapshot'
+        verbose_name_plural = 'Accounts Balances Snapshots'
+        default_permissions = ('view',)
+        unique_together = (('account', 'period', 'datetime'),)
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    period = models.CharField(max_length=1, choices=SNAPSHOT_PERIODS)
+    datetime = models.DateTimeField()
+    balance = models.DecimalField(default=0, max_digits=12, decimal_places=2)
+
+    def __str__(self):
+        return '%s at %s: %s' % (self.account, self.datetime, self.balance)
@@ -5,15 +5,26 @@ from __future__ import unicode_literals
 Accounting Service
 """
 
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytz
+
+from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import transaction
+from django.db import connection, transaction
+from django.db.models import F
 from django.utils import timezone
 
 from accounting.constants import (
     MOVEMENT_TYPE_INPUT, MOVEMENT_TYPE_OUTPUT,
     ERROR_UNKNOWN_MOVEMENT_TYPE, ERROR_ACCOUNT_REQUIRED, ERROR_DISABLED,
-    ERROR_AMOUNT_REQUIRED, ERROR_NOT_BALANCE, ERROR_DIFFERENT_CURRENCY)
-from accounting.models import Account, Operation, OperationMovement
+    ERROR_AMOUNT_REQUIRED, ERROR_NOT_BALANCE, ERROR_DIFFERENT_CURRENCY,
+    SNAPSHOT_PERIOD_DAY, SNAPSHOT_PERIOD_MONTH)
+from accounting.models import Account, AccountBalanceSnapshot, Operation, OperationMovement
+
+
+BATCH_SIZE = 1000
 
 
 class AccountingService():
@@ -25,7 +36,7 @@ class AccountingService():
     # account should be locked
     def simple_operation(
             cls, user, concept, detail, account, movement_type, amount,
-            other_account=None, other_amount=None, current_datetime=timezone.now()):
+            other_account=None, other_amount=None, current_datetime=None):
         """
         Registers simple operation with 1 or 2 movements
         for first movement parameters:
@@ -37,25 +48,14 @@ class AccountingService():
             reverted movement type
         """
         # verifications
-        cls._validate_movement_type(movement_type=movement_type)
-        cls._validate_account(account=account)
-        cls._validate_amount(amount=amount)
-        if movement_type == MOVEMENT_TYPE_OUTPUT:
-            cls._validate_account_balance(account=account, amount=amount)
-        if other_account:
-            cls._validate_account(account=other_account)
-            movement_amount = amount
-            if other_amount:
-                # can be transfer with or without operation_cost, or exchange 
-                cls._validate_amount(amount=other_amount)
-                movement_amount = other_amount
-            else:
-                # must be accounts with same currencies
-                if account.currency != other_account.currency:
-                    raise ValidationError(ERROR_DIFFERENT_CURRENCY % (account, other_account))
-            # verify balance
-            if movement_type == MOVEMENT_TYPE_INPUT:
-                cls._validate_account_balance(account=other_account, amount=movement_amount)
+        movement_amount = cls._validate_operation(
+            account=account,
+            movement_type=movement_type,
+            amount=amount,
+            other_account=other_account,
+            other_amount=other_amount)
+        if current_datetime is None:
+            current_datetime = timezone.now()
         with transaction.atomic(savepoint=False):
             # create new operation
             operation = Operation(
@@ -78,6 +78,110 @@ class AccountingService():
                     amount=movement_amount)
             return operation
 
+    @classmethod
+    def post_batch(cls, operations):
+        """
+        Registers many simple operations at once
+        operations are dicts with simple_operation parameters, all their
+        accounts are locked once in id order and operations validated in
+        order over the resulting balances before anything is written
+        """
+        account_ids = set()
+        for operation in operations:
+            cls._validate_account(account=operation['account'])
+            account_ids.add(operation['account'].pk)
+            if operation.get('other_account'):
+                account_ids.add(operation['other_account'].pk)
+        with transaction.atomic(savepoint=False):
+            accounts = dict(
+                (account.pk, account)
+                for account in Account.objects.select_for_update().filter(
+                    pk__in=account_ids).order_by('pk'))
+            current_datetime = timezone.now()
+            db_operations = list()
+            batch_movements = list()
+            for operation in operations:
+                account = accounts[operation['account'].pk]
+                other_account = None
+                if operation.get('other_account'):
+                    other_account = accounts[operation['other_account'].pk]
+                movement_type = operation['movement_type']
+                movement_amount = cls._validate_operation(
+                    account=account,
+                    movement_type=movement_type,
+                    amount=operation['amount'],
+                    other_account=other_account,
+                    other_amount=operation.get('other_amount'))
+                db_operation = Operation(
+                    user=operation['user'],
+                    datetime=operation.get('current_datetime') or current_datetime,
+                    concept=operation['concept'],
+                    detail=operation['detail'])
+                db_operations.append(db_operation)
+                batch_movements.append(cls._batch_movement(
+                    db_operation, account, movement_type, operation['amount']))
+                if other_account:
+                    batch_movements.append(cls._batch_movement(
+                        db_operation, other_account, cls._revert_movement_type(movement_type),
+                        movement_amount))
+
+            if connection.features.can_return_ids_from_bulk_insert:
+                Operation.objects.bulk_create(db_operations, batch_size=BATCH_SIZE)
+            else:
+                # movements need operations ids
+                for db_operation in db_operations:
+                    db_operation.save()
+            movements = list()
+            for db_operation, movement in batch_movements:
+                movement.operation_id = db_operation.pk
+                movements.append(movement)
+            OperationMovement.objects.bulk_create(movements, batch_size=BATCH_SIZE)
+            Account.objects.bulk_update(list(accounts.values()), ['balance'])
+            for account in accounts.values():
+                cls._update_batch_balance_snapshots(
+                    account=account,
+                    movements=[
+                        (db_operation.datetime, movement)
+                        for db_operation, movement in batch_movements
+                        if movement.account_id == account.pk])
+        return db_operations
+
+    @classmethod
+    def build_balance_snapshots(cls, account, period=None):
+        """
+        Rebuilds account balance snapshots at start of every period
+        since first movement in one pass over movements
+        """
+        if period is None:
+            period = cls.snapshot_period()
+        with transaction.atomic(savepoint=False):
+            # movements written meanwhile would miss the rebuilt snapshots
+            account = cls._find_and_lock_account_by_id(account.pk)
+            movements = OperationMovement.objects.filter(account=account).order_by(
+                'operation__datetime', 'pk').values_list(
+                    'operation__datetime', 'movement_type', 'amount')
+            snapshots = list()
+            balance = Decimal(0)
+            next_start = None
+            for movement_datetime, movement_type, amount in movements.iterator():
+                if next_start is None:
+                    next_start = cls._period_start(movement_datetime, period)
+                while next_start <= movement_datetime:
+                    snapshots.append(AccountBalanceSnapshot(
+                        account=account, period=period, datetime=next_start, balance=balance))
+                    next_start = cls._next_period_start(next_start, period)
+                if movement_type == MOVEMENT_TYPE_INPUT:
+                    balance += amount
+                else:
+                    balance -= amount
+            AccountBalanceSnapshot.objects.filter(account=account, period=period).delete()
+            AccountBalanceSnapshot.objects.bulk_create(snapshots, batch_size=1000)
+        return len(snapshots)
+
+    @classmethod
+    def snapshot_period(cls):
+        return getattr(settings, 'ACCOUNTING_SNAPSHOT_PERIOD', SNAPSHOT_PERIOD_MONTH)
+
     @classmethod
     def _find_and_lock_account_by_id(cls, account_id):
         """
@@ -104,18 +208,173 @@ class AccountingService():
             amount=amount,
             final_account_balance=account.balance)
         movement.save()
+        amount = cls._decimal(amount)
+        if movement_type == MOVEMENT_TYPE_OUTPUT:
+            amount = -amount
+        cls._update_balance_snapshots(
+            account=account,
+            movement_datetime=operation.datetime,
+            amount=amount)
         return movement
 
     @classmethod
     # account should be locked
     def _do_account_movement(cls, account, amount, movement_type):
-        if movement_type == MOVEMENT_TYPE_INPUT:
-            account.balance = float(account.balance) + float(amount)
-        if movement_type == MOVEMENT_TYPE_OUTPUT:
-            account.balance = float(account.balance) - float(amount)
+        cls._apply_account_movement(
+            account=account,
+            amount=amount,
+            movement_type=movement_type)
         account.save()
         return account
 
+    @classmethod
+    def _apply_account_movement(cls, account, amount, movement_type):
+        if movement_type == MOVEMENT_TYPE_INPUT:
+            account.balance = cls._decimal(account.balance) + cls._decimal(amount)
+        if movement_type == MOVEMENT_TYPE_OUTPUT:
+            account.balance = cls._decimal(account.balance) - cls._decimal(amount)
+
+    @classmethod
+    # account should be locked
+    def _batch_movement(cls, operation, account, movement_type, amount):
+        """
+        Applies movement to account balance in memory
+        """
+        cls._apply_account_movement(
+            account=account,
+            amount=amount,
+            movement_type=movement_type)
+        return operation, OperationMovement(
+            movement_type=movement_type,
+            account=account,
+            amount=amount,
+            final_account_balance=account.balance)
+
+    @classmethod
+    # accounts should be locked
+    def _update_batch_balance_snapshots(cls, account, movements):
+        """
+        Adds batch movements to account snapshots after them and takes
+        snapshots missing at start of batch movements periods
+        """
+        if not movements:
+            return
+        amounts = list()
+        for movement_datetime, movement in movements:
+            amount = cls._decimal(movement.amount)
+            if movement.movement_type == MOVEMENT_TYPE_OUTPUT:
+                amount = -amount
+            amounts.append((movement_datetime, amount))
+        snapshots = list(AccountBalanceSnapshot.objects.filter(
+            account=account, datetime__gt=min(amounts)[0]))
+        for snapshot in snapshots:
+            snapshot.balance += sum(
+                amount for movement_datetime, amount in amounts
+                if movement_datetime < snapshot.datetime)
+        AccountBalanceSnapshot.objects.bulk_update(snapshots, ['balance'], batch_size=BATCH_SIZE)
+
+        period = cls.snapshot_period()
+        period_starts = set(
+            cls._period_start(movement_datetime, period)
+            for movement_datetime, amount in amounts)
+        period_starts -= set(AccountBalanceSnapshot.objects.filter(
+            account=account, period=period, datetime__in=period_starts).values_list(
+                'datetime', flat=True))
+        for period_start in sorted(period_starts):
+            AccountBalanceSnapshot.objects.create(
+                account=account,
+                period=period,
+                datetime=period_start,
+                balance=account.balance_at(period_start, included=False))
+
+    @classmethod
+    # account should be locked
+    def _update_balance_snapshots(cls, account, movement_datetime, amount):
+        """
+        Takes the snapshot at start of movement period when missing,
+        back dated movements are added to later snapshots
+        """
+        period = cls.snapshot_period()
+        period_start = cls._period_start(movement_datetime, period)
+        if not AccountBalanceSnapshot.objects.filter(
+                account=account, period=period, datetime=period_start).exists():
+            AccountBalanceSnapshot.objects.create(
+                account=account,
+                period=period,
+                datetime=period_start,
+                balance=account.balance_at(period_start, included=False))
+        AccountBalanceSnapshot.objects.filter(
+            account=account, datetime__gt=movement_datetime).update(
+                balance=F('balance') + amount)
+
+    @classmethod
+    def _period_start(cls, value, period):
+        value = timezone.localtime(value)
+        day = value.day
+        if period == SNAPSHOT_PERIOD_MONTH:
+            day = 1
+        return cls._day_start(value.year, value.month, day)
+
+    @classmethod
+    def _next_period_start(cls, value, period):
+        value = timezone.localtime(value)
+        if period == SNAPSHOT_PERIOD_DAY:
+            # noon avoids daylight saving changes
+            next_day = value.replace(hour=12) + timedelta(days=1)
+            return cls._period_start(next_day, period)
+        if value.month == 12:
+            return cls._day_start(value.year + 1, 1, 1)
+        return cls._day_start(value.year, value.month + 1, 1)
+
+    @classmethod
+    def _day_start(cls, year, month, day):
+        """
+        First instant of local day, daylight saving changes at midnight
+        make midnight ambiguous or missing on some time zones
+        """
+        midnight = datetime(year, month, day)
+        try:
+            return timezone.make_aware(midnight, is_dst=None)
+        except pytz.AmbiguousTimeError:
+            # clocks turned back, day starts at first midnight
+            return timezone.make_aware(midnight, is_dst=True)
+        except pytz.NonExistentTimeError:
+            # clocks turned forward, day starts at first hour
+            return timezone.make_aware(midnight, is_dst=False)
+
+    @classmethod
+    def _decimal(cls, value):
+        if isinstance(value, Decimal):
+            return value
+        return Decimal(str(value))
+
+    @classmethod
+    def _validate_operation(
+            cls, account, movement_type, amount, other_account=None, other_amount=None):
+        """
+        Validates simple operation, returns other account movement amount
+        """
+        cls._validate_movement_type(movement_type=movement_type)
+        cls._validate_account(account=account)
+        cls._validate_amount(amount=amount)
+        if movement_type == MOVEMENT_TYPE_OUTPUT:
+            cls._validate_account_balance(account=account, amount=amount)
+        movement_amount = amount
+        if other_account:
+            cls._validate_account(account=other_account)
+            if other_amount:
+                # can be transfer with or without operation_cost, or exchange
+                cls._validate_amount(amount=other_amount)
+                movement_amount = other_amount
+            else:
+                # must be accounts with same currencies
+                if account.currency != other_account.currency:
+                    raise ValidationError(ERROR_DIFFERENT_CURRENCY % (account, other_account))
+            # verify balance
+            if movement_type == MOVEMENT_TYPE_INPUT:
+                cls._validate_account_balance(account=other_account, amount=movement_amount)
+        return movement_amount
+
     @classmethod
     def _validate_movement_type(cls, movement_type):
         """
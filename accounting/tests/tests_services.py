@@ -1,14 +1,19 @@
+from datetime import datetime
+from decimal import Decimal
+
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
+from django.db import transaction
 from django.db.utils import IntegrityError
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.utils import timezone
 
 from accounting.constants import (
     MOVEMENT_TYPE_INPUT, MOVEMENT_TYPE_OUTPUT, CURRENCY_CUC, CURRENCY_USD,
     ERROR_UNKNOWN_MOVEMENT_TYPE, ERROR_ACCOUNT_REQUIRED, ERROR_DISABLED,
-    ERROR_AMOUNT_REQUIRED, ERROR_NOT_BALANCE, ERROR_DIFFERENT_CURRENCY)
-from accounting.models import Account
+    ERROR_AMOUNT_REQUIRED, ERROR_NOT_BALANCE, ERROR_DIFFERENT_CURRENCY,
+    SNAPSHOT_PERIOD_DAY, SNAPSHOT_PERIOD_MONTH)
+from accounting.models import Account, AccountBalanceSnapshot, Operation, OperationMovement
 from accounting.services import AccountingService
 
 
@@ -457,3 +462,188 @@ class AccountingServicesTestCase(AccountingBaseTestCase):
 
         with self.assertRaises(IntegrityError) as ex:
             test_account2 = Account.objects.create(name="Test Account 1", currency=CURRENCY_USD)
+
+
+class AccountBalanceSnapshotTestCase(AccountingBaseTestCase):
+
+    def setUp(self):
+        self.test_user = User.objects.create(
+            username='Test User')
+        self.test_account = Account.objects.create(
+            name='Test Account',
+            currency=CURRENCY_CUC)
+
+    def operation(self, day, movement_type, amount):
+        return AccountingService.simple_operation(
+            user=self.test_user,
+            current_datetime=timezone.make_aware(datetime(2020, 1, 1, 12)) + day,
+            concept='Testing',
+            detail='Testing',
+            account=self.test_account,
+            movement_type=movement_type,
+            amount=amount)
+
+    def snapshots(self):
+        return [
+            (snapshot.datetime.month, snapshot.balance)
+            for snapshot in AccountBalanceSnapshot.objects.order_by('datetime')]
+
+    def test_balance_snapshots(self):
+        """
+        Does monthly snapshots kept on movements, back dated ones included
+        """
+        days = timezone.timedelta(days=1)
+        self.operation(10 * days, MOVEMENT_TYPE_INPUT, 100)
+        self.operation(35 * days, MOVEMENT_TYPE_OUTPUT, 40)
+        self.operation(62 * days, MOVEMENT_TYPE_INPUT, 30)
+        self.assertEqual(self.snapshots(), [(1, 0), (2, 100), (3, 60)])
+
+        self.operation(20 * days, MOVEMENT_TYPE_INPUT, 10)
+        self.assertEqual(self.snapshots(), [(1, 0), (2, 110), (3, 70)])
+        self.assertAccount(test_account=self.test_account, test_balance=100)
+        self.assertEqual(self.test_account.check_balance(), (True, 100))
+
+        february = timezone.make_aware(datetime(2020, 2, 10))
+        with self.assertNumQueries(2):
+            self.assertEqual(self.test_account.balance_at(february), 70)
+        self.assertEqual(self.test_account.balance_at(february - 20 * days), 100)
+
+        AccountBalanceSnapshot.objects.all().delete()
+        self.assertEqual(AccountingService.build_balance_snapshots(self.test_account), 3)
+        self.assertEqual(self.snapshots(), [(1, 0), (2, 110), (3, 70)])
+
+    @override_settings(TIME_ZONE='America/Havana')
+    def test_balance_snapshots_daylight_saving(self):
+        """
+        Does snapshots taken on days when clocks change at midnight
+        """
+        # 2026-03-08 midnight does not exist, 2026-11-01 midnight happens twice
+        dates = [datetime(2026, 3, 8, 12), datetime(2026, 11, 1, 0, 30), datetime(2026, 11, 16)]
+        for period in [SNAPSHOT_PERIOD_MONTH, SNAPSHOT_PERIOD_DAY]:
+            with self.settings(ACCOUNTING_SNAPSHOT_PERIOD=period):
+                for value in dates:
+                    self.test_account.refresh_from_db()
+                    AccountingService.simple_operation(
+                        user=self.test_user,
+                        current_datetime=timezone.make_aware(value, is_dst=True),
+                        concept='Testing',
+                        detail='Testing',
+                        account=self.test_account,
+                        movement_type=MOVEMENT_TYPE_INPUT,
+                        amount=10)
+                AccountingService.post_batch([dict(
+                    user=self.test_user,
+                    current_datetime=timezone.make_aware(value, is_dst=True),
+                    concept='Testing',
+                    detail='Testing',
+                    account=self.test_account,
+                    movement_type=MOVEMENT_TYPE_INPUT,
+                    amount=10) for value in dates])
+
+        # period starts are first instants of local days
+        self.assertEqual(
+            [(snapshot.period, timezone.localtime(snapshot.datetime).replace(tzinfo=None))
+             for snapshot in AccountBalanceSnapshot.objects.order_by('period', 'datetime')],
+            [(SNAPSHOT_PERIOD_DAY, datetime(2026, 3, 8, 1)),
+             (SNAPSHOT_PERIOD_DAY, datetime(2026, 11, 1)),
+             (SNAPSHOT_PERIOD_DAY, datetime(2026, 11, 16)),
+             (SNAPSHOT_PERIOD_MONTH, datetime(2026, 3, 1)),
+             (SNAPSHOT_PERIOD_MONTH, datetime(2026, 11, 1))])
+        first_midnight = timezone.make_aware(datetime(2026, 11, 1), is_dst=True)
+        self.assertEqual(
+            AccountBalanceSnapshot.objects.get(
+                period=SNAPSHOT_PERIOD_MONTH, datetime__month=11).datetime, first_midnight)
+        self.assertEqual(self.test_account.balance_at(first_midnight, included=False), 40)
+        self.assertAccount(test_account=self.test_account, test_balance=120)
+        self.assertEqual(self.test_account.check_balance(), (True, 120))
+
+        # every day from 2026-03-08 to 2026-11-16
+        self.assertEqual(AccountingService.build_balance_snapshots(
+            self.test_account, SNAPSHOT_PERIOD_DAY), 254)
+        self.assertEqual(
+            AccountBalanceSnapshot.objects.get(
+                period=SNAPSHOT_PERIOD_DAY, datetime=first_midnight).balance, 40)
+        self.assertEqual(AccountingService.build_balance_snapshots(
+            self.test_account, SNAPSHOT_PERIOD_MONTH), 9)
+
+    def test_balance_decimal(self):
+        """
+        Does balance kept exact with decimal amounts
+        """
+        for day in range(3):
+            self.operation(timezone.timedelta(days=day), MOVEMENT_TYPE_INPUT, Decimal('0.10'))
+        self.test_account.refresh_from_db()
+        self.assertEqual(self.test_account.balance, Decimal('0.30'))
+        self.assertEqual(self.test_account.check_balance(), (True, Decimal('0.30')))
+
+
+class AccountingPostBatchTestCase(AccountingBaseTestCase):
+
+    def setUp(self):
+        self.test_user = User.objects.create(
+            username='Test User')
+        self.test_account1 = Account.objects.create(
+            name='Test Account 1',
+            currency=CURRENCY_CUC)
+        self.test_account2 = Account.objects.create(
+            name='Test Account 2',
+            currency=CURRENCY_CUC)
+
+    def batch_operation(self, account, movement_type, amount, other_account=None, day=1):
+        return dict(
+            user=self.test_user,
+            concept='Testing',
+            detail='Testing',
+            account=account,
+            movement_type=movement_type,
+            amount=amount,
+            other_account=other_account,
+            current_datetime=timezone.make_aware(datetime(2020, 1, day, 12)))
+
+    def test_post_batch(self):
+        """
+        Does batch of deposits, transfer and back dated withdraw posted at once
+        """
+        AccountingService.simple_operation(
+            user=self.test_user,
+            current_datetime=timezone.make_aware(datetime(2020, 2, 1, 12)),
+            concept='Testing',
+            detail='Testing',
+            account=self.test_account1,
+            movement_type=MOVEMENT_TYPE_INPUT,
+            amount=10)
+
+        operations = AccountingService.post_batch([
+            self.batch_operation(self.test_account1, MOVEMENT_TYPE_INPUT, 100),
+            self.batch_operation(
+                self.test_account1, MOVEMENT_TYPE_OUTPUT, Decimal('30.50'), self.test_account2),
+            self.batch_operation(self.test_account2, MOVEMENT_TYPE_OUTPUT, 20, day=2)])
+
+        self.assertEqual(len(operations), 3)
+        self.assertAccount(test_account=self.test_account1, test_balance=Decimal('79.50'))
+        self.assertAccount(test_account=self.test_account2, test_balance=Decimal('10.50'))
+        self.assertEqual(
+            list(OperationMovement.objects.filter(
+                operation__in=operations).order_by('pk').values_list(
+                    'account_id', 'final_account_balance')),
+            [(self.test_account1.pk, 110), (self.test_account1.pk, Decimal('79.50')),
+             (self.test_account2.pk, Decimal('30.50')), (self.test_account2.pk, Decimal('10.50'))])
+        self.assertEqual(self.test_account1.check_balance(), (True, Decimal('79.50')))
+        self.assertEqual(self.test_account2.check_balance(), (True, Decimal('10.50')))
+        # february snapshot includes back dated january movements
+        self.assertEqual(
+            list(AccountBalanceSnapshot.objects.filter(
+                account=self.test_account1).order_by('datetime').values_list('balance', flat=True)),
+            [0, Decimal('69.50')])
+
+    def test_post_batch_validated_before_writing(self):
+        """
+        Does batch with insufficient balance after previous operations write nothing
+        """
+        with self.assertRaises(ValidationError), transaction.atomic():
+            AccountingService.post_batch([
+                self.batch_operation(self.test_account1, MOVEMENT_TYPE_INPUT, 100),
+                self.batch_operation(self.test_account1, MOVEMENT_TYPE_OUTPUT, 60),
+                self.batch_operation(self.test_account1, MOVEMENT_TYPE_OUTPUT, 60)])
+        self.assertFalse(Operation.objects.exists())
+        self.assertAccount(test_account=self.test_account1, test_balance=0)
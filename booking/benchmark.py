@@ -0,0 +1,876 @@
+"""
+booking benchmark
+
+Synthetic production scale dataset and repeatable timings of booking hot paths
+"""
+import random
+import statistics
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from accounting.constants import CURRENCY_EUR, CURRENCY_USD, MOVEMENT_TYPE_INPUT
+from accounting.models import Account
+from accounting.services import AccountingService
+from booking import constants
+from booking.models import (
+    Booking, BookingInvoice, BookingPax, BaseBookingService, BaseBookingServicePax,
+    BookingProvidedAllotment, BookingProvidedExtra,
+    Quote, QuotePaxVariant, NewQuoteAllotment, NewQuoteExtra,
+)
+from booking.services import BookingServices
+from common.deferred import DeferredUpdates
+from config.constants import (
+    AMOUNTS_BY_PAX, AMOUNTS_FIXED, EXTRA_PARAMETER_TYPE_STAY, ROOM_CAPACITY_DOUBLE,
+    BOARD_TYPE_BB, BOARD_TYPE_HB,
+)
+from config.models import (
+    Addon, RoomType, Allotment, AllotmentRoomType, AllotmentBoardType, Extra,
+    ProviderAllotmentService, ProviderAllotmentDetail,
+    AgencyAllotmentService, AgencyAllotmentDetail,
+    ProviderExtraService, ProviderExtraDetail,
+    AgencyExtraService, AgencyExtraDetail,
+)
+from config.services import ConfigServices
+from finance.constants import STATUS_READY
+from finance.models import (
+    Agency, Provider, Office, AgencyPayment, AgencyDocumentMatch,
+)
+from finance.services import FinanceServices
+from reservas.custom_settings import ADDON_FOR_NO_ADDON
+from reservas.utils import retry_on_deadlock
+
+
+BENCHMARK_PREFIX = 'Bench'
+
+BENCHMARK_USER = 'benchmark'
+
+BATCH_SIZE = 1000
+
+ROOM_TYPES = ['Standard', 'Superior', 'Junior Suite', 'Suite']
+
+BOARD_TYPES = [BOARD_TYPE_BB, BOARD_TYPE_HB]
+
+CURRENCIES = [CURRENCY_USD, CURRENCY_EUR]
+
+# booking status and weight, booking services take the same status
+BOOKING_STATUSES = [
+    (constants.BOOKING_STATUS_CONFIRMED, 70),
+    (constants.BOOKING_STATUS_COORDINATED, 10),
+    (constants.BOOKING_STATUS_REQUEST, 8),
+    (constants.BOOKING_STATUS_PENDING, 5),
+    (constants.BOOKING_STATUS_CANCELLED, 7),
+]
+
+INVOICED_STATUSES = [
+    constants.BOOKING_STATUS_CONFIRMED, constants.BOOKING_STATUS_COORDINATED]
+
+
+def _name(kind, number):
+    return '%s %s %06d' % (BENCHMARK_PREFIX, kind, number)
+
+
+def _amount(value):
+    return Decimal(value).quantize(Decimal('1.00'))
+
+
+class _Rollback(Exception):
+    pass
+
+
+@contextmanager
+def rolled_back():
+    """
+    runs the block in a transaction rolled back at the end.
+    Recalculations deferred to commit are run before rolling back
+    """
+    try:
+        with transaction.atomic():
+            yield
+            DeferredUpdates.flush()
+            raise _Rollback()
+    except _Rollback:
+        pass
+    finally:
+        DeferredUpdates.clear()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR,
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+class BenchmarkData(object):
+    """
+    BenchmarkData
+
+    Generates a synthetic dataset shaped as production data: agencies and providers,
+    multi-season allotment and extra catalogs with pax ranges and contract codes,
+    bookings with rooming lists and services, invoices and payments.
+    Rows are bulk created where models allow it, booking services are saved one by one
+    as multi table models and finance documents go through finance services
+    so summaries and accounts stay consistent.
+    Same options and seed generate the same dataset
+    """
+
+    @classmethod
+    def generate(
+            cls, agencies=2000, providers=1000, allotments=300, extras=50, seasons=6,
+            agency_services=5, bookings=50000, invoiced_percent=20, seed=0, log=None):
+        if log is None:
+            def log(message):
+                pass
+        if Agency.objects.filter(name__startswith=BENCHMARK_PREFIX).exists():
+            raise ValueError('Benchmark dataset already generated')
+        rnd = random.Random(seed)
+        start = time.perf_counter()
+
+        with transaction.atomic():
+            user, room_types = cls._base_data()
+            agency_list = cls._bulk_named(Agency, agencies, lambda number: Agency(
+                name=_name('Agency', number), currency=CURRENCIES[number % len(CURRENCIES)],
+                gain_percent=rnd.choice([10, 15, 20])))
+            provider_list = cls._bulk_named(Provider, providers, lambda number: Provider(
+                name=_name('Provider', number), currency=CURRENCY_USD))
+            season_list = cls.season_dates(seasons)
+            log('%s agencies, %s providers' % (len(agency_list), len(provider_list)))
+
+            allotment_list = cls._create_allotments(rnd, allotments, room_types)
+            extra_list = cls._create_extras(extras)
+            hotel_plans = cls._create_allotment_catalogs(
+                rnd, allotment_list, provider_list, agency_list, season_list, agency_services)
+            extra_plans = cls._create_extra_catalogs(
+                rnd, extra_list, provider_list, agency_list, season_list)
+            log('%s allotments, %s extras, %s seasons' % (
+                len(allotment_list), len(extra_list), len(season_list)))
+
+        booking_count = 0
+        for batch_start in range(0, bookings, BATCH_SIZE):
+            size = min(BATCH_SIZE, bookings - batch_start)
+            with transaction.atomic():
+                cls._create_bookings(
+                    rnd, user, agency_list, season_list, hotel_plans, extra_plans, size)
+            booking_count += size
+            log('%s bookings' % booking_count)
+
+        invoices, payments = cls._create_invoices_payments(rnd, user, invoiced_percent)
+        log('%s invoices, %s payments' % (invoices, payments))
+
+        return dict(
+            agencies=len(agency_list),
+            providers=len(provider_list),
+            allotments=len(allotment_list),
+            extras=len(extra_list),
+            seasons=len(season_list),
+            allotment_catalogs=ProviderAllotmentService.objects.filter(
+                service__in=allotment_list).count() + AgencyAllotmentService.objects.filter(
+                    service__in=allotment_list).count(),
+            bookings=booking_count,
+            booking_services=BaseBookingService.objects.filter(
+                booking__name__startswith=BENCHMARK_PREFIX).count(),
+            invoices=invoices,
+            payments=payments,
+            seconds=round(time.perf_counter() - start, 1),
+        )
+
+    @classmethod
+    def season_dates(cls, seasons):
+        """
+        returns seasons splitting last, current and next years
+        """
+        first = date(date.today().year - 1, 1, 1)
+        last = date(date.today().year + 1, 12, 31)
+        days = ((last - first).days + 1) // seasons
+        season_list = list()
+        for season in range(seasons):
+            date_from = first + timedelta(days=season * days)
+            date_to = date_from + timedelta(days=days - 1)
+            if season == seasons - 1:
+                date_to = last
+            season_list.append((date_from, date_to))
+        return season_list
+
+    @classmethod
+    def _base_data(cls):
+        Addon.objects.get_or_create(pk=ADDON_FOR_NO_ADDON, defaults=dict(name='No Addon'))
+        user, created = User.objects.get_or_create(
+            username=BENCHMARK_USER,
+            defaults=dict(
+                first_name=BENCHMARK_PREFIX, last_name='Seller',
+                is_staff=True, is_superuser=True))
+        Office.objects.get_or_create(
+            name='%s Office' % BENCHMARK_PREFIX, defaults=dict(address='Benchmark Street'))
+        for currency in CURRENCIES:
+            Account.objects.get_or_create(
+                name='%s Account' % BENCHMARK_PREFIX, currency=currency)
+        room_types = list()
+        for room_type in ROOM_TYPES:
+            room_types.append(RoomType.objects.get_or_create(
+                name='%s %s' % (BENCHMARK_PREFIX, room_type))[0])
+        return user, room_types
+
+    @classmethod
+    def _bulk_named(cls, model, count, build):
+        model.objects.bulk_create(
+            [build(number) for number in range(count)], batch_size=BATCH_SIZE)
+        # not all databases return ids from bulk_create
+        return list(model.objects.filter(name__startswith=BENCHMARK_PREFIX).order_by('name'))
+
+    @classmethod
+    def _create_allotments(cls, rnd, count, room_types):
+        allotment_list = list()
+        room_rows = list()
+        board_rows = list()
+        for number in range(count):
+            allotment = Allotment.objects.create(
+                name=_name('Hotel', number), cost_type=AMOUNTS_BY_PAX,
+                grouping=True, pax_range=(number % 3 == 0), child_age=12)
+            allotment.bench_room_types = rnd.sample(room_types, 2)
+            allotment.bench_board_type = rnd.choice(BOARD_TYPES)
+            allotment.bench_rate = rnd.randint(30, 120)
+            allotment_list.append(allotment)
+            for room_type in allotment.bench_room_types:
+                room_rows.append(AllotmentRoomType(
+                    allotment=allotment, room_type=room_type,
+                    room_capacity=ROOM_CAPACITY_DOUBLE))
+            board_rows.append(AllotmentBoardType(
+                allotment=allotment, board_type=allotment.bench_board_type))
+        AllotmentRoomType.objects.bulk_create(room_rows, batch_size=BATCH_SIZE)
+        AllotmentBoardType.objects.bulk_create(board_rows, batch_size=BATCH_SIZE)
+        return allotment_list
+
+    @classmethod
+    def _create_extras(cls, count):
+        extra_list = list()
+        for number in range(count):
+            extra = Extra.objects.create(
+                name=_name('Extra', number), cost_type=AMOUNTS_FIXED,
+                parameter_type=EXTRA_PARAMETER_TYPE_STAY)
+            extra.bench_rate = 10 + number % 40
+            extra_list.append(extra)
+        return extra_list
+
+    @classmethod
+    def _allotment_amounts(cls, rate):
+        return dict(
+            ad_1_amount=_amount(rate * 1.6), ad_2_amount=_amount(rate),
+            ad_3_amount=_amount(rate * 0.9), ad_4_amount=_amount(rate * 0.85),
+            ch_1_ad_1_amount=_amount(rate * 0.7), ch_1_ad_2_amount=_amount(rate * 0.5))
+
+    @classmethod
+    def _pax_ranges(cls, allotment):
+        if allotment.pax_range:
+            return [(1, 2), (3, 4)]
+        return [(0, 0)]
+
+    @classmethod
+    def _bulk_catalog(cls, service_model, services, detail_model, owner_field, details):
+        """
+        creates catalog services and their details by (owner, service, contract, season) key
+        """
+        before = service_model.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        service_model.objects.bulk_create(
+            [service for key, service in services], batch_size=BATCH_SIZE)
+        created = service_model.objects.filter(pk__gt=before).order_by('pk')
+        detail_rows = list()
+        for (key, service), db_service in zip(services, created):
+            for detail in details(key):
+                setattr(detail, owner_field, db_service)
+                detail_rows.append(detail)
+        detail_model.objects.bulk_create(detail_rows, batch_size=BATCH_SIZE)
+
+    @classmethod
+    def _create_allotment_catalogs(
+            cls, rnd, allotment_list, provider_list, agency_list, season_list, agency_services):
+        """
+        returns hotel plans by agency id, (allotment, provider, contract code) list
+        """
+        plans = list()
+        for number, allotment in enumerate(allotment_list):
+            provider = provider_list[number % len(provider_list)]
+            plans.append((allotment, provider, ''))
+            if number % 4 == 0:
+                plans.append((allotment, provider, 'CC%04d' % number))
+
+        def seasons_rows(owner_plans, build):
+            rows = list()
+            for allotment, owner, contract_code in owner_plans:
+                for season, (date_from, date_to) in enumerate(season_list):
+                    rows.append((
+                        (allotment, season),
+                        build(owner, allotment, contract_code, date_from, date_to)))
+            return rows
+
+        def details(detail_model, gain):
+            def build_details(key):
+                allotment, season = key
+                rate = allotment.bench_rate * (1 + season * 0.05) * gain
+                detail_list = list()
+                for room_type in allotment.bench_room_types:
+                    for pax_range_min, pax_range_max in cls._pax_ranges(allotment):
+                        # larger groups get lower rates
+                        range_rate = rate * (0.9 if pax_range_min > 2 else 1)
+                        detail_list.append(detail_model(
+                            room_type=room_type, board_type=allotment.bench_board_type,
+                            pax_range_min=pax_range_min, pax_range_max=pax_range_max,
+                            **cls._allotment_amounts(range_rate)))
+                return detail_list
+            return build_details
+
+        cls._bulk_catalog(
+            ProviderAllotmentService,
+            seasons_rows(plans, lambda provider, allotment, contract_code, date_from, date_to:
+                         ProviderAllotmentService(
+                             provider=provider, service=allotment, contract_code=contract_code,
+                             date_from=date_from, date_to=date_to)),
+            ProviderAllotmentDetail, 'provider_service',
+            details(ProviderAllotmentDetail, 1))
+
+        hotel_plans = dict()
+        agency_plans = list()
+        for agency in agency_list:
+            hotel_plans[agency.pk] = rnd.sample(plans, min(agency_services, len(plans)))
+            for allotment, provider, contract_code in hotel_plans[agency.pk]:
+                agency_plans.append((allotment, agency, contract_code))
+        cls._bulk_catalog(
+            AgencyAllotmentService,
+            seasons_rows(agency_plans, lambda agency, allotment, contract_code, date_from, date_to:
+                         AgencyAllotmentService(
+                             agency=agency, service=allotment, contract_code=contract_code,
+                             date_from=date_from, date_to=date_to)),
+            AgencyAllotmentDetail, 'agency_service',
+            details(AgencyAllotmentDetail, 1.2))
+        return hotel_plans
+
+    @classmethod
+    def _create_extra_catalogs(cls, rnd, extra_list, provider_list, agency_list, season_list):
+        """
+        returns extra plans by agency id, (extra, provider) list
+        """
+        if not extra_list:
+            return dict()
+        provider_services = list()
+        agency_services = list()
+        for number, extra in enumerate(extra_list):
+            provider = provider_list[-1 - number % len(provider_list)]
+            extra.bench_provider = provider
+            for season, (date_from, date_to) in enumerate(season_list):
+                provider_services.append(((extra, 1), ProviderExtraService(
+                    provider=provider, service=extra, date_from=date_from, date_to=date_to)))
+        extra_plans = dict()
+        for agency in agency_list:
+            agency_extras = rnd.sample(extra_list, min(2, len(extra_list)))
+            extra_plans[agency.pk] = [(extra, extra.bench_provider) for extra in agency_extras]
+            for extra in agency_extras:
+                for date_from, date_to in season_list:
+                    agency_services.append(((extra, 1.2), AgencyExtraService(
+                        agency=agency, service=extra, date_from=date_from, date_to=date_to)))
+        cls._bulk_catalog(
+            ProviderExtraService, provider_services, ProviderExtraDetail, 'provider_service',
+            lambda key: [ProviderExtraDetail(ad_1_amount=_amount(key[0].bench_rate * key[1]))])
+        cls._bulk_catalog(
+            AgencyExtraService, agency_services, AgencyExtraDetail, 'agency_service',
+            lambda key: [AgencyExtraDetail(ad_1_amount=_amount(key[0].bench_rate * key[1]))])
+        return extra_plans
+
+    @classmethod
+    def _rooming(cls, rnd):
+        """
+        returns (pax_group, pax_age) rows of 1 to 3 rooms
+        """
+        rooming = list()
+        for group in range(1, rnd.choice([1, 1, 1, 2, 2, 3]) + 1):
+            for pax in range(rnd.choice([1, 2, 2, 2, 3])):
+                rooming.append((group, None))
+            if rnd.random() < 0.15:
+                rooming.append((group, rnd.randint(2, 11)))
+        return rooming
+
+    @classmethod
+    def _create_bookings(
+            cls, rnd, user, agency_list, season_list, hotel_plans, extra_plans, size):
+        first_day = season_list[0][0]
+        last_day = season_list[-1][1] - timedelta(days=10)
+        statuses = [status for status, weight in BOOKING_STATUSES]
+        weights = [weight for status, weight in BOOKING_STATUSES]
+        number = Booking.objects.filter(name__startswith=BENCHMARK_PREFIX).count()
+
+        booking_rows = list()
+        plans = list()
+        for position in range(size):
+            agency = rnd.choice(agency_list)
+            date_from = first_day + timedelta(days=rnd.randint(0, (last_day - first_day).days))
+            date_to = date_from + timedelta(days=rnd.randint(1, 7))
+            status = rnd.choices(statuses, weights)[0]
+            rooming = cls._rooming(rnd)
+            services = list()
+            if hotel_plans.get(agency.pk):
+                allotment, provider, contract_code = rnd.choice(hotel_plans[agency.pk])
+                nights = (date_to - date_from).days
+                cost = _amount(allotment.bench_rate * nights * len(rooming))
+                services.append(BookingProvidedAllotment(
+                    service=allotment, provider=provider, contract_code=contract_code,
+                    room_type=rnd.choice(allotment.bench_room_types),
+                    board_type=allotment.bench_board_type,
+                    datetime_from=date_from, datetime_to=date_to, status=status,
+                    cost_amount=cost, price_amount=_amount(cost * Decimal('1.2'))))
+            for extra, provider in extra_plans.get(agency.pk, []):
+                if rnd.random() < 0.5:
+                    continue
+                cost = _amount(extra.bench_rate)
+                services.append(BookingProvidedExtra(
+                    service=extra, provider=provider,
+                    datetime_from=date_from, datetime_to=date_from, status=status,
+                    cost_amount=cost, price_amount=_amount(cost * Decimal('1.2'))))
+            booking_rows.append(Booking(
+                name=_name('Booking', number + position), agency=agency,
+                reference='REF%06d' % (number + position),
+                booked=date_from - timedelta(days=rnd.randint(5, 90)),
+                date_from=date_from, date_to=date_to, status=status,
+                currency=agency.currency, seller=user,
+                cost_amount=sum(service.cost_amount for service in services),
+                price_amount=sum(service.price_amount for service in services)))
+            plans.append((rooming, services))
+
+        before = Booking.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        Booking.objects.bulk_create(booking_rows)
+        booking_rows = list(Booking.objects.filter(pk__gt=before).order_by('pk'))
+
+        pax_rows = list()
+        for booking, (rooming, services) in zip(booking_rows, plans):
+            for pax_number, (pax_group, pax_age) in enumerate(rooming):
+                pax_rows.append(BookingPax(
+                    booking=booking, pax_name='Pax %s-%s' % (booking.pk, pax_number + 1),
+                    pax_age=pax_age, pax_group=pax_group))
+        BookingPax.objects.bulk_create(pax_rows)
+        paxes = dict()
+        for pax in BookingPax.objects.filter(booking__pk__gt=before).order_by('pk'):
+            paxes.setdefault(pax.booking_id, list()).append(pax)
+
+        service_pax_rows = list()
+        for booking, (rooming, services) in zip(booking_rows, plans):
+            for service in services:
+                service.booking = booking
+                service.avoid_all = True
+                service.save()
+                for pax in paxes.get(booking.pk, []):
+                    service_pax_rows.append(BaseBookingServicePax(
+                        booking_service=service, booking_pax=pax, group=pax.pax_group))
+        BaseBookingServicePax.objects.bulk_create(service_pax_rows, batch_size=BATCH_SIZE)
+
+    @classmethod
+    def _create_invoices_payments(cls, rnd, user, invoiced_percent):
+        """
+        invoices part of confirmed bookings, agencies pay their older invoices
+        leaving newer ones and some payment amount open for matching
+        """
+        booking_list = [
+            booking for booking in Booking.objects.select_related('agency', 'seller').filter(
+                name__startswith=BENCHMARK_PREFIX, status__in=INVOICED_STATUSES,
+                price_amount__gt=0).order_by('pk')
+            if rnd.random() * 100 < invoiced_percent]
+        invoices = dict()
+        for booking in booking_list:
+            with transaction.atomic():
+                BookingServices.create_bookinginvoice(user, booking)
+            invoices.setdefault(booking.agency_id, list()).append(booking.invoice)
+
+        accounts = dict(
+            (account.currency, account)
+            for account in Account.objects.filter(name='%s Account' % BENCHMARK_PREFIX))
+        payments = 0
+        for agency_id, invoice_list in invoices.items():
+            paid = invoice_list[:(len(invoice_list) + 1) // 2]
+            amount = sum(invoice.amount for invoice in paid)
+            with transaction.atomic():
+                payment = FinanceServices.save_agency_payment(user, AgencyPayment(
+                    agency_id=agency_id, date=timezone.now().date(),
+                    account=accounts[paid[0].currency], currency=paid[0].currency,
+                    amount=amount + _amount(rnd.randint(10, 100)), status=STATUS_READY))
+                for invoice in paid:
+                    FinanceServices.save_agency_match(AgencyDocumentMatch(
+                        credit_document=payment, debit_document=invoice,
+                        matched_amount=invoice.amount))
+            payments += 1
+        return sum(len(invoice_list) for invoice_list in invoices.values()), payments
+
+
+class BenchmarkSuite(object):
+    """
+    BenchmarkSuite
+
+    Times booking hot paths over items sampled with a seed from the benchmark dataset.
+    Every case runs repeat times in transactions rolled back at the end,
+    results are wall times and query counts by case
+    """
+    CASES = [
+        'pricing_allotment_amounts',
+        'pricing_booking_amounts',
+        'update_booking',
+        'build_booking_from_quote',
+        'changelist_bookings',
+        'changelist_booking_services',
+        'voucher_pdf',
+        'invoice_pdf',
+        'finance_match',
+        'accounting_simple_operations',
+        'accounting_post_batch',
+    ]
+
+    @classmethod
+    def run(cls, cases=None, repeat=5, sample=50, seed=0, log=None):
+        if log is None:
+            def log(message):
+                pass
+        cases = cases or cls.CASES
+        unknown = set(cases) - set(cls.CASES)
+        if unknown:
+            raise ValueError('Unknown benchmark cases %s' % ', '.join(sorted(unknown)))
+        user = User.objects.filter(username=BENCHMARK_USER).first()
+        if user is None:
+            raise ValueError('Benchmark dataset not found')
+
+        results = dict()
+        with rolled_back():
+            for case in cases:
+                rnd = random.Random('%s:%s' % (seed, case))
+                items, run = getattr(cls, '_setup_%s' % case)(rnd, user, sample)
+                results[case] = cls._measure(run, repeat, items)
+                log('%s %s' % (case, results[case]))
+        return dict(
+            commit=git_commit(),
+            created=timezone.now().isoformat(),
+            database=connection.vendor,
+            repeat=repeat,
+            sample=sample,
+            seed=seed,
+            dataset=dict(
+                bookings=Booking.objects.filter(name__startswith=BENCHMARK_PREFIX).count(),
+                booking_services=BaseBookingService.objects.filter(
+                    booking__name__startswith=BENCHMARK_PREFIX).count()),
+            results=results,
+        )
+
+    @classmethod
+    def run_concurrent_payments(cls, threads=8, payments=20, repeat=5):
+        """
+        posts agency payments from parallel threads, all for one agency and
+        account so they contend on the same summary and account rows.
+        Every payment runs in its own transaction rolled back at the end
+        """
+        user = User.objects.filter(username=BENCHMARK_USER).first()
+        agency = Agency.objects.filter(name__startswith=BENCHMARK_PREFIX).order_by('pk').first()
+        if user is None or agency is None:
+            raise ValueError('Benchmark dataset not found')
+        account = Account.objects.get(
+            name='%s Account' % BENCHMARK_PREFIX, currency=agency.currency)
+
+        def post_payment():
+            with rolled_back():
+                FinanceServices.save_agency_payment(user, AgencyPayment(
+                    agency=agency, date=timezone.now().date(), account=account,
+                    currency=agency.currency, amount=10, status=STATUS_READY))
+
+        def post_payments(errors):
+            try:
+                for count in range(payments):
+                    retry_on_deadlock(post_payment)()
+            except Exception as ex:
+                errors.append(ex)
+            finally:
+                if threads > 1:
+                    connection.close()
+
+        timings = list()
+        for count in range(repeat):
+            errors = list()
+            start = time.perf_counter()
+            if threads > 1:
+                workers = [
+                    threading.Thread(target=post_payments, args=(errors,))
+                    for thread in range(threads)]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+            else:
+                # same connection, used on databases without concurrent writers
+                post_payments(errors)
+            timings.append((time.perf_counter() - start) * 1000)
+            if errors:
+                raise errors[0]
+        median = statistics.median(timings)
+        items = threads * payments
+        return dict(
+            items=items,
+            threads=threads,
+            min_ms=round(min(timings), 2),
+            median_ms=round(median, 2),
+            max_ms=round(max(timings), 2),
+            item_ms=round(median / items, 3) if items else None,
+            per_second=round(items * 1000 / median, 1) if median else None,
+            queries=None,
+        )
+
+    @classmethod
+    def compare(cls, previous, current):
+        """
+        returns (case, previous ms, current ms, ratio, previous queries, current queries)
+        rows for cases in both results
+        """
+        rows = list()
+        for case, result in current['results'].items():
+            before = previous.get('results', dict()).get(case)
+            if before is None:
+                continue
+            ratio = None
+            if before['median_ms']:
+                ratio = round(result['median_ms'] / before['median_ms'], 2)
+            rows.append((
+                case, before['median_ms'], result['median_ms'], ratio,
+                before['queries'], result['queries']))
+        return rows
+
+    @classmethod
+    def _measure(cls, run, repeat, items):
+        timings = list()
+        queries = list()
+        for count in range(repeat):
+            # the query log is bounded, counts stop once it is full
+            connection.queries_log.clear()
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                with rolled_back():
+                    run()
+                timings.append((time.perf_counter() - start) * 1000)
+            queries.append(len(captured))
+        median = statistics.median(timings)
+        return dict(
+            items=items,
+            min_ms=round(min(timings), 2),
+            median_ms=round(median, 2),
+            max_ms=round(max(timings), 2),
+            item_ms=round(median / items, 3) if items else None,
+            queries=int(statistics.median(queries)),
+        )
+
+    @classmethod
+    def _sample(cls, rnd, queryset, sample):
+        ids = list(queryset.order_by('pk').values_list('pk', flat=True))
+        return rnd.sample(ids, min(sample, len(ids)))
+
+    @classmethod
+    def _bookings(cls):
+        return Booking.objects.filter(name__startswith=BENCHMARK_PREFIX)
+
+    @classmethod
+    def _setup_pricing_allotment_amounts(cls, rnd, user, sample):
+        ids = cls._sample(rnd, BookingProvidedAllotment.objects.filter(
+            booking__name__startswith=BENCHMARK_PREFIX), sample)
+        stays = list()
+        for service in BookingProvidedAllotment.objects.select_related(
+                'service', 'provider', 'booking__agency').filter(pk__in=ids).order_by('pk'):
+            stays.append((
+                service.service_id, service.datetime_from, service.datetime_to,
+                list(BookingServices.find_groups(service, service.service, True)),
+                list(BookingServices.find_groups(service, service.service, False)),
+                service.provider, service.booking.booked, service.contract_code,
+                service.booking.agency, service.board_type, service.room_type_id))
+
+        def run():
+            ConfigServices.clear_pricing_cache()
+            for stay in stays:
+                ConfigServices.allotment_amounts(*stay)
+        return len(stays), run
+
+    @classmethod
+    def _setup_pricing_booking_amounts(cls, rnd, user, sample):
+        bookings = list(cls._bookings().select_related('agency').filter(
+            pk__in=cls._sample(rnd, cls._bookings(), sample)))
+
+        def run():
+            ConfigServices.clear_pricing_cache()
+            for booking in bookings:
+                BookingServices.find_bookingservices_with_different_amounts(booking)
+        return len(bookings), run
+
+    @classmethod
+    def _setup_update_booking(cls, rnd, user, sample):
+        bookings = list(cls._bookings().filter(
+            pk__in=cls._sample(rnd, cls._bookings(), sample)))
+
+        def run():
+            for booking in bookings:
+                BookingServices.update_booking(booking)
+        return len(bookings), run
+
+    @classmethod
+    def _setup_build_booking_from_quote(cls, rnd, user, sample):
+        service = BookingProvidedAllotment.objects.filter(
+            pk__in=cls._sample(rnd, BookingProvidedAllotment.objects.filter(
+                booking__name__startswith=BENCHMARK_PREFIX), 1)).select_related(
+                    'booking').first()
+        if service is None:
+            return 0, lambda: None
+        booking = service.booking
+        quote = Quote.objects.create(
+            description='%s Quote' % BENCHMARK_PREFIX, reference='%s Quote' % BENCHMARK_PREFIX,
+            agency_id=booking.agency_id, seller=user, currency=booking.currency,
+            booked=booking.booked)
+        NewQuoteAllotment.objects.create(
+            quote=quote, service_id=service.service_id, provider_id=service.provider_id,
+            contract_code=service.contract_code, room_type_id=service.room_type_id,
+            board_type=service.board_type,
+            datetime_from=service.datetime_from, datetime_to=service.datetime_to)
+        for extra in BookingProvidedExtra.objects.filter(booking=booking):
+            NewQuoteExtra.objects.create(
+                quote=quote, service_id=extra.service_id, provider_id=extra.provider_id,
+                datetime_from=extra.datetime_from, datetime_to=extra.datetime_to)
+        QuotePaxVariant.objects.create(quote=quote, pax_quantity=2)
+        DeferredUpdates.flush()
+        rooming = [
+            dict(pax_name='Pax %s' % pax, pax_age=None, pax_group=1, is_price_free=False)
+            for pax in range(2)]
+        builds = min(sample, 10)
+
+        def run():
+            for count in range(builds):
+                booking, message = BookingServices.build_booking_from_quote(
+                    quote.pk, rooming, user)
+                if booking is None:
+                    raise ValueError(message)
+        return builds, run
+
+    @classmethod
+    def _setup_changelist(cls, model, user, sample, path):
+        from reservas.admin import bookings_site
+
+        site_model = bookings_site._registry[model]
+        pages = min(sample, 5)
+
+        def run():
+            for page in range(pages):
+                request = RequestFactory().get(path, dict(p=page) if page else dict())
+                request.user = user
+                site_model.changelist_view(request).render()
+        return pages, run
+
+    @classmethod
+    def _setup_changelist_bookings(cls, rnd, user, sample):
+        return cls._setup_changelist(Booking, user, sample, '/bookings/booking/booking/')
+
+    @classmethod
+    def _setup_changelist_booking_services(cls, rnd, user, sample):
+        return cls._setup_changelist(
+            BaseBookingService, user, sample, '/bookings/booking/basebookingservice/')
+
+    @classmethod
+    def _setup_voucher_pdf(cls, rnd, user, sample):
+        from reservas.admin import bookings_site
+
+        site_model = bookings_site._registry[Booking]
+        office = Office.objects.filter(name='%s Office' % BENCHMARK_PREFIX).first()
+        vouchers = list()
+        for booking_id in cls._sample(rnd, cls._bookings(), min(sample, 10)):
+            vouchers.append((booking_id, list(BaseBookingService.objects.filter(
+                booking=booking_id).values_list('pk', flat=True))))
+
+        def run():
+            for booking_id, service_ids in vouchers:
+                result, pdf = site_model._build_vouchers(
+                    booking_id, service_ids, dict(uid=user.pk, office=office))
+                if result.err:
+                    raise ValueError('Error generating PDF - %s' % result.err)
+        return len(vouchers), run
+
+    @classmethod
+    def _setup_invoice_pdf(cls, rnd, user, sample):
+        from reservas.admin import bookings_site
+
+        site_model = bookings_site._registry[Booking]
+        invoices = list(BookingInvoice.objects.filter(pk__in=cls._sample(
+            rnd, BookingInvoice.objects.filter(
+                invoice_booking__name__startswith=BENCHMARK_PREFIX), min(sample, 10))))
+
+        def run():
+            for invoice in invoices:
+                result, pdf = site_model._build_invoice_pdf(invoice)
+                if result.err:
+                    raise ValueError('Error generating PDF - %s' % result.err)
+        return len(invoices), run
+
+    @classmethod
+    def _setup_finance_match(cls, rnd, user, sample):
+        """
+        agencies pay and match their open invoices
+        """
+        open_invoices = dict()
+        for invoice in BookingInvoice.objects.filter(
+                invoice_booking__name__startswith=BENCHMARK_PREFIX,
+                matched_amount=0).order_by('pk'):
+            open_invoices.setdefault(invoice.agency_id, list()).append(invoice)
+        agency_ids = sorted(open_invoices)
+        agency_ids = rnd.sample(agency_ids, min(sample, len(agency_ids)))
+        accounts = dict(
+            (account.currency, account)
+            for account in Account.objects.filter(name='%s Account' % BENCHMARK_PREFIX))
+
+        def run():
+            for agency_id in agency_ids:
+                invoice_list = open_invoices[agency_id]
+                payment = FinanceServices.save_agency_payment(user, AgencyPayment(
+                    agency_id=agency_id, date=timezone.now().date(),
+                    account=accounts[invoice_list[0].currency],
+                    currency=invoice_list[0].currency,
+                    amount=sum(invoice.amount for invoice in invoice_list),
+                    status=STATUS_READY))
+                for invoice in invoice_list:
+                    FinanceServices.save_agency_match(AgencyDocumentMatch(
+                        credit_document=payment, debit_document=invoice,
+                        matched_amount=invoice.amount))
+        return len(agency_ids), run
+
+    @classmethod
+    def _accounting_operations(cls, rnd, user, sample):
+        """
+        bank statement deposits on benchmark accounts, ten by item sampled
+        """
+        accounts = list(Account.objects.filter(
+            name='%s Account' % BENCHMARK_PREFIX).order_by('pk'))
+        return [
+            dict(user=user, concept='Deposit', detail='%s Deposit %s' % (BENCHMARK_PREFIX, number),
+                 account=rnd.choice(accounts), movement_type=MOVEMENT_TYPE_INPUT,
+                 amount=_amount(rnd.uniform(10, 1000)))
+            for number in range(sample * 10)]
+
+    @classmethod
+    def _setup_accounting_simple_operations(cls, rnd, user, sample):
+        operations = cls._accounting_operations(rnd, user, sample)
+
+        def run():
+            for operation in operations:
+                account = AccountingService._find_and_lock_account_by_id(operation['account'].pk)
+                AccountingService.simple_operation(**dict(operation, account=account))
+        return len(operations), run
+
+    @classmethod
+    def _setup_accounting_post_batch(cls, rnd, user, sample):
+        operations = cls._accounting_operations(rnd, user, sample)
+
+        def run():
+            AccountingService.post_batch(operations)
+        return len(operations), run
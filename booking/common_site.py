@@ -20,6 +20,8 @@ from django.contrib.admin.utils import quote
 from django.core.exceptions import ValidationError
 from django.core.mail import EmailMessage
 from django.db import transaction
+from django.db.models import Case, DecimalField, F, Value, When
+from django.db.models.functions import Coalesce
 from django.db.models.query_utils import Q
 from django.forms import formset_factory
 from django.forms.models import modelformset_factory
@@ -83,6 +85,7 @@ from booking.models import (
     BookingInvoicePartial,
     ProviderBookingPayment, ProviderPaymentBookingProvided,
     get_bookingservice_objects, get_quoteservice_objects,
+    annotate_booking_columns, annotate_bookingservice_columns,
 )
 from booking.services import BookingServices
 from booking.top_filters import (
@@ -107,24 +110,31 @@ MENU_LABEL_BOOKING = 'Booking'
 MENU_GROUP_LABEL_SERVICES = 'Services By Type'
 MENU_GROUP_LABEL_PACKAGE_SERVICES = 'Package Services By Type'
 
+# booking amounts properties as database expressions for changelist totals
+BOOKING_TOTALSUM_EXPRESSIONS = {
+    'utility': Case(
+        When(cost_amount__isnull=False, price_amount__isnull=False,
+             then=F('price_amount') - F('cost_amount')),
+        default=Value(0), output_field=DecimalField()),
+    'invoiced_amount': Coalesce(
+        'invoice__amount', Value(0), output_field=DecimalField()),
+    'paid_amount': Coalesce(
+        'invoice__matched_amount', Value(0), output_field=DecimalField()),
+    'pending_amount': Coalesce(
+        F('invoice__amount') - F('invoice__matched_amount'), Value(0),
+        output_field=DecimalField()),
+}
+
 
 def _get_voucher_services(services):
     objs = []
     booking_services = get_bookingservice_objects(services)
     for booking_service in booking_services:
         if isinstance(booking_service, BookingExtraPackage) and booking_service.voucher_detail:
-            PACKAGE_MODELS = {
-                BASE_BOOKING_SERVICE_CATEGORY_BOOKING_PACKAGE_TRANSFER: BookingProvidedTransfer,
-                BASE_BOOKING_SERVICE_CATEGORY_BOOKING_PACKAGE_EXTRA: BookingProvidedExtra,
-                BASE_BOOKING_SERVICE_CATEGORY_BOOKING_PACKAGE_ALLOTMENT: BookingProvidedAllotment,
-            }
             package_services = list(BookingProvidedService.objects.filter(
                 booking_package=booking_service).exclude(
                     status__in=[SERVICE_STATUS_CANCELLED, SERVICE_STATUS_CANCELLING]))
-            for package_service in package_services:
-                service = PACKAGE_MODELS[package_service.base_category].objects.get(
-                    id=package_service.id)
-                objs.append(service)
+            objs.extend(get_bookingservice_objects(package_services))
         else:
             objs.append(booking_service)
     return objs
@@ -876,6 +886,8 @@ class BookingSiteModel(SiteModel):
     totalsum_list = ['cost_amount', 'price_amount',
                      'invoiced_amount', 'utility',
                      'paid_amount']
+    totalsum_expressions = BOOKING_TOTALSUM_EXPRESSIONS
+    export_allowed = True
     save_as = True
 
     def details(self, obj):
@@ -887,6 +899,9 @@ class BookingSiteModel(SiteModel):
         """
         return BookingStatusChangeList
 
+    def get_export_queryset(self, request, queryset):
+        return annotate_booking_columns(queryset)
+
     def get_urls(self):
 
         info = self.model._meta.app_label, self.model._meta.model_name
@@ -1280,7 +1295,9 @@ class BaseServiceChangeList(ServiceChangeList):
     def get_queryset(self, request):
         # custom queryset to strip BookingPackageServices from list
         qs = super(BaseServiceChangeList, self).get_queryset(request)
-        return qs.exclude(base_category=BASE_BOOKING_SERVICE_CATEGORY_BOOKING_PACKAGE)
+        # booking columns loaded with the list query
+        return annotate_bookingservice_columns(
+            qs.exclude(base_category=BASE_BOOKING_SERVICE_CATEGORY_BOOKING_PACKAGE))
 
 
 @admin.register(BaseBookingService, site=bookings_site)
@@ -1319,7 +1336,12 @@ class BookingBaseServiceSiteModel(SiteModel):
     ordering = ('datetime_from', 'booking__reference', 'name',)
     list_details_template = 'booking/basebookingservice_details.html'
     change_details_template = 'booking/basebookingservice_details.html'
+    keyset_pagination = True
+    export_allowed = True
     totalsum_list = ['cost_amount', 'price_amount', 'cost_amount_pending']
+    totalsum_expressions = {
+        'cost_amount_pending': F('cost_amount_to_pay') - F('cost_amount_paid'),
+    }
 
     def get_changelist(self, request, **kwargs):
         """
@@ -2483,6 +2505,8 @@ class ExportBookingSiteModel(SiteModel):
     totalsum_list = ['cost_amount', 'price_amount',
                      'invoiced_amount', 'utility',
                      'paid_amount', 'pending_amount']
+    totalsum_expressions = BOOKING_TOTALSUM_EXPRESSIONS
+    export_allowed = True
 
     def get_changelist(self, request, **kwargs):
         """
@@ -2490,6 +2514,9 @@ class ExportBookingSiteModel(SiteModel):
         """
         return ExportBookingChangeList
 
+    def get_export_queryset(self, request, queryset):
+        return annotate_booking_columns(queryset)
+
 
 class BaseBookingBookDetailSiteModel(SiteModel):
     readonly_fields = ['utility_percent', 'utility']
@@ -0,0 +1,58 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from booking.benchmark import BenchmarkSuite
+
+
+class Command(BaseCommand):
+    help = 'Times booking hot paths on the benchmark dataset'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'cases', nargs='*',
+            help='Cases to run, all by default: %s' % ', '.join(BenchmarkSuite.CASES))
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument(
+            '--sample', type=int, default=50,
+            help='Items sampled by case')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--threads', type=int, default=0,
+            help='Also post agency payments from these parallel threads')
+        parser.add_argument(
+            '--payments', type=int, default=20,
+            help='Payments posted by thread')
+        parser.add_argument('--output', help='JSON file for results')
+        parser.add_argument('--compare', help='JSON results file to compare with')
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError('Repeat must be at least 1')
+        previous = None
+        if options['compare']:
+            with open(options['compare']) as compare_file:
+                previous = json.load(compare_file)
+        try:
+            results = BenchmarkSuite.run(
+                cases=options['cases'], repeat=options['repeat'],
+                sample=options['sample'], seed=options['seed'], log=self.stdout.write)
+            if options['threads'] > 0:
+                result = BenchmarkSuite.run_concurrent_payments(
+                    threads=options['threads'], payments=options['payments'],
+                    repeat=options['repeat'])
+                results['results']['finance_concurrent_payments'] = result
+                self.stdout.write('finance_concurrent_payments %s' % result)
+        except ValueError as ex:
+            raise CommandError(str(ex))
+
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump(results, output_file, indent=2, sort_keys=True)
+        if previous is not None:
+            self.stdout.write('%-30s %12s %12s %7s %9s' % (
+                'case', 'before ms', 'after ms', 'ratio', 'queries'))
+            for case, before, after, ratio, queries_before, queries_after in \
+                    BenchmarkSuite.compare(previous, results):
+                self.stdout.write('%-30s %12s %12s %7s %4s/%-4s' % (
+                    case, before, after, ratio, queries_before, queries_after))
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from booking.benchmark import BenchmarkData
+
+
+class Command(BaseCommand):
+    help = 'Generates a synthetic production scale dataset for benchmarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--agencies', type=int, default=2000)
+        parser.add_argument('--providers', type=int, default=1000)
+        parser.add_argument('--allotments', type=int, default=300)
+        parser.add_argument('--extras', type=int, default=50)
+        parser.add_argument('--seasons', type=int, default=6)
+        parser.add_argument(
+            '--agency-services', type=int, default=5,
+            help='Allotment catalogs by agency')
+        parser.add_argument('--bookings', type=int, default=50000)
+        parser.add_argument(
+            '--invoiced-percent', type=int, default=20,
+            help='Percent of confirmed bookings invoiced')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options['agencies'] < 1 or options['providers'] < 1 or options['seasons'] < 1:
+            raise CommandError('At least one agency, provider and season required')
+        try:
+            counts = BenchmarkData.generate(
+                agencies=options['agencies'],
+                providers=options['providers'],
+                allotments=options['allotments'],
+                extras=options['extras'],
+                seasons=options['seasons'],
+                agency_services=options['agency_services'],
+                bookings=options['bookings'],
+                invoiced_percent=options['invoiced_percent'],
+                seed=options['seed'],
+                log=self.stdout.write)
+        except ValueError as ex:
+            raise CommandError(str(ex))
+        for name, count in counts.items():
+            self.stdout.write('%s: %s' % (name, count))
@@ -10,6 +10,8 @@ from concurrency.fields import AutoIncVersionField
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.db import models, transaction
+from django.db.models import Case, Count, F, IntegerField, OuterRef, Subquery, When
+from django.db.models.functions import Coalesce
 from django.db.models.query_utils import Q
 from django.urls import reverse
 from django.utils.html import format_html
@@ -73,24 +75,97 @@ from finance.models import (
     Provider, Withdraw)
 
 
-# Utility method to get a list of
-# BookingService child objects from a BookingService list
-def get_bookingservice_objects(services):
+def _get_child_objects(services, child_models, select_related=None):
+    """
+    returns child objects of services in the same order, loading each
+    child model with one query. select_related is an optional dict of
+    related lookups by child model
+    """
+    ids_by_model = dict()
+    for service in services:
+        ids_by_model.setdefault(child_models[service.base_category], list()).append(service.id)
+    objs_by_id = dict()
+    for model, ids in ids_by_model.items():
+        queryset = model.objects.filter(id__in=ids)
+        if select_related and select_related.get(model):
+            queryset = queryset.select_related(*select_related[model])
+        for obj in queryset:
+            objs_by_id[(model, obj.id)] = obj
     objs = []
     for service in services:
-        obj = BOOKINGSERVICE_MODELS[service.base_category].objects.get(id=service.id)
-        objs.append(obj)
+        model = child_models[service.base_category]
+        try:
+            objs.append(objs_by_id[(model, service.id)])
+        except KeyError:
+            raise model.DoesNotExist(
+                '%s matching query does not exist.' % model._meta.object_name)
     return objs
 
 
+# Utility method to get a list of
+# BookingService child objects from a BookingService list
+def get_bookingservice_objects(services, select_related=None):
+    return _get_child_objects(services, BOOKINGSERVICE_MODELS, select_related)
+
+
 # Utility method to get a list of
 # QuoteService child objects from a QuoteService list
-def get_quoteservice_objects(services):
-    objs = []
-    for service in services:
-        obj = QUOTESERVICE_MODELS[service.base_category].objects.get(id=service.id)
-        objs.append(obj)
-    return objs
+def get_quoteservice_objects(services, select_related=None):
+    return _get_child_objects(services, QUOTESERVICE_MODELS, select_related)
+
+
+class BookingServiceQuerySet(models.QuerySet):
+    def as_concrete(self, select_related=None):
+        """
+        returns the child objects of the booking services
+        """
+        return get_bookingservice_objects(list(self), select_related)
+
+
+class QuoteServiceQuerySet(models.QuerySet):
+    def as_concrete(self, select_related=None):
+        """
+        returns the child objects of the quote services
+        """
+        return get_quoteservice_objects(list(self), select_related)
+
+
+# Utility method to annotate BaseBookingService queryset with booking
+# name, reference and pax count, taken from package for package services
+def annotate_bookingservice_columns(queryset):
+    in_package = Q(base_category__in=[
+        BASE_BOOKING_SERVICE_CATEGORY_BOOKING_PACKAGE_ALLOTMENT,
+        BASE_BOOKING_SERVICE_CATEGORY_BOOKING_PACKAGE_TRANSFER,
+        BASE_BOOKING_SERVICE_CATEGORY_BOOKING_PACKAGE_EXTRA])
+    package_booking = 'bookingprovidedservice__booking_package__booking__'
+
+    def pax_count(booking_service):
+        return Coalesce(Subquery(
+            BaseBookingServicePax.objects.filter(
+                booking_service=OuterRef(booking_service)).order_by().values(
+                    'booking_service').annotate(pax_count=Count('pk')).values('pax_count'),
+            output_field=IntegerField()), 0)
+
+    return queryset.select_related('booking', 'provider', 'service_addon').annotate(
+        booking_name_value=Case(
+            When(in_package, then=F(package_booking + 'name')),
+            default=F('booking__name')),
+        booking_reference_value=Case(
+            When(in_package, then=F(package_booking + 'reference')),
+            default=F('booking__reference')),
+        pax_count_value=Case(
+            When(in_package, then=pax_count('bookingprovidedservice__booking_package')),
+            default=pax_count('pk'), output_field=IntegerField()))
+
+
+# Utility method to annotate Booking queryset with pax count
+def annotate_booking_columns(queryset):
+    return queryset.select_related('agency', 'invoice', 'seller').annotate(
+        pax_count_value=Coalesce(Subquery(
+            BookingPax.objects.filter(
+                booking=OuterRef('pk')).order_by().values(
+                    'booking').annotate(pax_count=Count('pk')).values('pax_count'),
+            output_field=IntegerField()), 0))
 
 
 class CostData(models.Model):
@@ -284,7 +359,7 @@ class QuotePaxVariant(PaxVariantAmounts):
         return '%s pax' % (self.pax_quantity)
 
 
-class QuoteInvoicedServiceManager(models.Manager):
+class QuoteInvoicedServiceManager(models.Manager.from_queryset(QuoteServiceQuerySet)):
     def get_queryset(self):
         return super(QuoteInvoicedServiceManager, self).get_queryset().filter(
             base_category__in=['QA', 'QT', 'QE', 'QP'])
@@ -306,7 +381,7 @@ class QuoteService(BookServiceData, DateInterval, ValidateSaveModelMixin, FillDa
     contract_code = models.CharField(max_length=40, blank=True, null=True)
 
     # Other Managers
-    objects = models.Manager()
+    objects = QuoteServiceQuerySet.as_manager()
     invoiced_objects = QuoteInvoicedServiceManager()
 
     def validate(self):
@@ -752,6 +827,8 @@ class Booking(FillDataSaveModelMixin):
 
     @property
     def pax_count(self):
+        if hasattr(self, 'pax_count_value'):
+            return self.pax_count_value
         return self.rooming_list.count()
     pax_count.fget.short_description = 'Pax'
 
@@ -793,7 +870,7 @@ class BookingPax(models.Model):
             return '%s' % (self.pax_name)
 
 
-class InvoicedManager(models.Manager):
+class InvoicedManager(models.Manager.from_queryset(BookingServiceQuerySet)):
     def get_queryset(self):
         return super(InvoicedManager, self).get_queryset().filter(
             base_category__in=[
@@ -844,7 +921,7 @@ class BaseBookingService(BookServiceData, DateInterval, CostData, PriceData, Ato
     has_payment = models.BooleanField(default=False)
 
     # Other Managers
-    objects = models.Manager()
+    objects = BookingServiceQuerySet.as_manager()
     invoiced_objects = InvoicedManager()
 
     @property
@@ -863,6 +940,8 @@ class BaseBookingService(BookServiceData, DateInterval, CostData, PriceData, Ato
 
     def booking_name(self):
         # gets booking.name for this bookingservice
+        if hasattr(self, 'booking_name_value'):
+            return self.booking_name_value
         child_service = get_bookingservice_objects([self])[0]
         if child_service.base_category in ['PA', 'PE', 'PT']:
             return child_service.booking_package.booking.name
@@ -870,6 +949,8 @@ class BaseBookingService(BookServiceData, DateInterval, CostData, PriceData, Ato
 
     def booking_agency_ref(self):
         # gets booking.reference for this bookingservice
+        if hasattr(self, 'booking_reference_value'):
+            return self.booking_reference_value
         child_service = get_bookingservice_objects([self])[0]
         if child_service.base_category in ['PA', 'PE', 'PT']:
             return child_service.booking_package.booking.reference
@@ -877,6 +958,8 @@ class BaseBookingService(BookServiceData, DateInterval, CostData, PriceData, Ato
 
     def service_pax_count(self):
         # gets rooming_list count for this bookingservice
+        if hasattr(self, 'pax_count_value'):
+            return '{}'.format(self.pax_count_value)
         child_service = get_bookingservice_objects([self])[0]
         if child_service.base_category in ['PA', 'PE', 'PT']:
             pax_count = child_service.booking_package.rooming_list.count()
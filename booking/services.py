@@ -10,7 +10,8 @@ from django.contrib.admin.models import LogEntry, ADDITION, CHANGE
 from django.contrib.admin.options import get_content_type_for_model
 from django.core.exceptions import ValidationError
 from django.db import transaction
-from django.db.models import F, Q
+from django.db.models import Count, F, Max, Min, Q, Sum
+from django.db.models.functions import Coalesce
 from django.utils.encoding import force_text
 from django.utils.six import text_type
 
@@ -29,6 +30,7 @@ from booking.models import (
     BookingBookDetail,
     BookingBookDetailAllotment, BookingBookDetailTransfer, BookingBookDetailExtra,
     ProviderBookingPayment, ProviderPaymentBookingProvided,
+    BOOKINGSERVICE_MODELS, get_bookingservice_objects,
 )
 
 from common.filters import parse_date
@@ -38,6 +40,7 @@ from config.models import (
     ServiceBookDetail,
     ServiceBookDetailAllotment, ServiceBookDetailTransfer, ServiceBookDetailExtra,
     ProviderAllotmentDetail, ProviderTransferDetail, ProviderExtraDetail)
+from config.pricing import AmountsRequest
 from config.services import ConfigServices
 from config.views import (
     provider_allotment_queryset, provider_transfer_queryset, provider_extra_queryset)
@@ -251,13 +254,20 @@ class BookingServices(object):
             return True
 
     @classmethod
-    def build_bookingservice_paxes(cls, bookingservice, pax_list, user=None):
+    def build_bookingservice_paxes(cls, bookingservice, pax_list, user=None, bulk_paxes=None):
+        """
+        creates booking service rooming. When bulk_paxes list is given rooming is
+        appended to it to be created later with bulk_create
+        """
         for service_pax in pax_list:
             bookingservice_pax = BaseBookingServicePax()
             bookingservice_pax.booking_service = bookingservice
             bookingservice_pax.booking_pax = service_pax.booking_pax
             bookingservice_pax.group = service_pax.group
 
+            if bulk_paxes is not None:
+                bulk_paxes.append(bookingservice_pax)
+                continue
             bookingservice_pax.avoid_bookingservice_update = True
             bookingservice_pax.avoid_booking_update = True
             bookingservice_pax.save()
@@ -314,14 +324,18 @@ class BookingServices(object):
 
     @classmethod
     def build_bookingservice_from_quoteservice(
-            cls, booking_service, quote_service, booking, pax_list, pax_variant, user):
+            cls, booking_service, quote_service, booking, pax_list, pax_variant, user,
+            bulk_paxes=None, service_pax_variants=None):
         booking_service.booking = booking
         cls._copy_service_info(
             dst_service=booking_service, src_service=quote_service)
         booking_service.p_notes = quote_service.description
         # find service variant
-        service_pax_variant = cls._find_quoteservice_paxvariant_for_bookingservice(
-            quote_service, pax_variant)
+        if service_pax_variants is not None:
+            service_pax_variant = service_pax_variants.get(quote_service.id)
+        else:
+            service_pax_variant = cls._find_quoteservice_paxvariant_for_bookingservice(
+                quote_service, pax_variant)
         if service_pax_variant:
             cls.setup_bookingservice_amounts_from_quote(
                 bookingservice=booking_service,
@@ -332,7 +346,7 @@ class BookingServices(object):
         booking_service.avoid_update = True
         booking_service.avoid_booking_update = True
         booking_service.save()
-        cls.build_bookingservice_paxes(booking_service, pax_list, user)
+        cls.build_bookingservice_paxes(booking_service, pax_list, user, bulk_paxes)
         cls.build_bookingservice_details_from_quoteservice(
             booking_service, quote_service)
 
@@ -357,13 +371,19 @@ class BookingServices(object):
         bookingpackage_service.save()
 
     @classmethod
-    def build_booking_from_quote(cls, quote_id, rooming, user=None):
+    def build_booking_from_quote(cls, quote_id, rooming, user=None, bulk=True):
+        """
+        builds a booking from a quote pax variant matching rooming.
+        On bulk mode rooming rows are created with bulk_create, quote service
+        variants are loaded at once and catalog rate plans are loaded once
+        for all services
+        """
         try:
             quote = Quote.objects.get(pk=quote_id)
         except Quote.DoesNotExist:
             return None, 'Quote with id %s Not Found' % quote_id
         try:
-            with transaction.atomic(savepoint=False):
+            with transaction.atomic(savepoint=False), ConfigServices.rate_plan_index():
                 # create booking
                 booking = Booking()
                 booking.p_notes = quote.description
@@ -400,7 +420,7 @@ class BookingServices(object):
                 booking.save()
 
                 # create pax list
-                pax_list = list()
+                booking_paxes = list()
                 for pax in rooming:
                     if pax['pax_name'] and pax['pax_group']:
                         booking_pax = BookingPax()
@@ -410,12 +430,24 @@ class BookingServices(object):
                         booking_pax.pax_group = pax['pax_group']
                         booking_pax.is_price_free = pax['is_price_free']
                         booking_pax.avoid_booking_update = True
-                        booking_pax.save()
+                        if not bulk:
+                            booking_pax.save()
+                        booking_paxes.append(booking_pax)
+                if bulk:
+                    booking_paxes = cls._bulk_create_booking_paxes(booking, booking_paxes)
 
-                        service_pax = BaseBookingServicePax()
-                        service_pax.booking_pax = booking_pax
-                        service_pax.group = booking_pax.pax_group
-                        pax_list.append(service_pax)
+                pax_list = list()
+                for booking_pax in booking_paxes:
+                    service_pax = BaseBookingServicePax()
+                    service_pax.booking_pax = booking_pax
+                    service_pax.group = booking_pax.pax_group
+                    pax_list.append(service_pax)
+
+                bulk_paxes = None
+                service_pax_variants = None
+                if bulk:
+                    bulk_paxes = list()
+                    service_pax_variants = cls._find_quoteservices_paxvariants(quote, pax_variant)
 
                 # create bookingallotment list
                 for quote_allotment in NewQuoteAllotment.objects.filter(quote_id=quote.id).all():
@@ -423,7 +455,8 @@ class BookingServices(object):
                     ConfigServices.copy_book_allotment_data(
                         dst_service=booking_allotment, src_service=quote_allotment)
                     cls.build_bookingservice_from_quoteservice(
-                        booking_allotment, quote_allotment, booking, pax_list, pax_variant, user)
+                        booking_allotment, quote_allotment, booking, pax_list, pax_variant, user,
+                        bulk_paxes, service_pax_variants)
 
                 # create bookingtransfer list
                 for quote_transfer in NewQuoteTransfer.objects.filter(quote_id=quote.id).all():
@@ -431,7 +464,8 @@ class BookingServices(object):
                     ConfigServices.copy_book_transfer_data(
                         dst_service=booking_transfer, src_service=quote_transfer)
                     cls.build_bookingservice_from_quoteservice(
-                        booking_transfer, quote_transfer, booking, pax_list, pax_variant, user)
+                        booking_transfer, quote_transfer, booking, pax_list, pax_variant, user,
+                        bulk_paxes, service_pax_variants)
                     booking_transfer.quantity = ConfigServices.get_service_quantity(
                         booking_transfer.service, len(pax_list), quote_transfer.quantity)
 
@@ -442,7 +476,8 @@ class BookingServices(object):
                     ConfigServices.copy_book_extra_data(
                         dst_service=booking_extra, src_service=quote_extra)
                     cls.build_bookingservice_from_quoteservice(
-                        booking_extra, quote_extra, booking, pax_list, pax_variant, user)
+                        booking_extra, quote_extra, booking, pax_list, pax_variant, user,
+                        bulk_paxes, service_pax_variants)
                     booking_extra.quantity = ConfigServices.get_service_quantity(
                         booking_extra.service, len(pax_list), quote_extra.quantity)
 
@@ -458,8 +493,11 @@ class BookingServices(object):
                     booking_package.p_notes = quote_package.description
 
                     # find service variant
-                    service_pax_variant = cls._find_quoteservice_paxvariant_for_bookingservice(
-                        quote_package, pax_variant)
+                    if service_pax_variants is not None:
+                        service_pax_variant = service_pax_variants.get(quote_package.id)
+                    else:
+                        service_pax_variant = cls._find_quoteservice_paxvariant_for_bookingservice(
+                            quote_package, pax_variant)
 
                     if service_pax_variant:
                         cls.setup_bookingservice_amounts_from_quote(
@@ -474,7 +512,7 @@ class BookingServices(object):
                     booking_package.save()
 
                     # create bookingservicepax list
-                    cls.build_bookingservice_paxes(booking_package, pax_list, user)
+                    cls.build_bookingservice_paxes(booking_package, pax_list, user, bulk_paxes)
 
                     # create bookingprovidedallotment list
                     for quotepackage_allotment in NewQuoteAllotment.objects.filter(
@@ -511,6 +549,9 @@ class BookingServices(object):
                             bookingpackage_extra, quotepackage_extra,
                             pax_list, service_pax_variant)
 
+                if bulk_paxes:
+                    BaseBookingServicePax.objects.bulk_create(bulk_paxes)
+
                 # update booking
                 cls.update_booking(booking)
                 return booking, 'Booking Succesfully Created'
@@ -518,6 +559,30 @@ class BookingServices(object):
             return None, 'Error on Booking Building : %s' % (ex)
         return None, 'Error on Booking Building'
 
+    @classmethod
+    def _bulk_create_booking_paxes(cls, booking, booking_paxes):
+        """
+        creates booking paxes with one query and returns them loaded with their ids
+        """
+        BookingPax.objects.bulk_create(booking_paxes)
+        # not all databases return ids from bulk_create, booking is new so all its paxes
+        # are the ones just created in order
+        return list(BookingPax.objects.filter(booking=booking.id).order_by('pk'))
+
+    @classmethod
+    def _find_quoteservices_paxvariants(cls, quote, quote_pax_variant):
+        """
+        returns quote services variants for the quote pax variant by quote service id
+        """
+        service_pax_variants = dict()
+        if quote_pax_variant is None:
+            return service_pax_variants
+        for service_pax_variant in QuoteServicePaxVariant.objects.filter(
+                quote_service__quote=quote.id,
+                quote_pax_variant=quote_pax_variant.id):
+            service_pax_variants.setdefault(service_pax_variant.quote_service_id, service_pax_variant)
+        return service_pax_variants
+
     @classmethod
     def update_quote(cls, quote_or_service):
 
@@ -690,24 +755,25 @@ class BookingServices(object):
                 (not package_list)):
             return 2, 'Services Missing', None
 
-        for pax_variant in variant_list:
-            variant_dict = dict()
-            variant_dict.update({'paxes': pax_variant.pax_quantity})
+        with ConfigServices.rate_plan_index():
+            for pax_variant in variant_list:
+                variant_dict = dict()
+                variant_dict.update({'paxes': pax_variant.pax_quantity})
 
-            cost_1, cost_1_msg, price_1, price_1_msg, \
-            cost_2, cost_2_msg, price_2, price_2_msg, \
-            cost_3, cost_3_msg, price_3, price_3_msg, \
-            cost_4, cost_4_msg, price_4, price_4_msg = cls._find_quote_pax_variant_amounts(
-                pax_variant, allotment_list, transfer_list, extra_list, package_list,
-                agency, booked, variant_dict)
+                cost_1, cost_1_msg, price_1, price_1_msg, \
+                cost_2, cost_2_msg, price_2, price_2_msg, \
+                cost_3, cost_3_msg, price_3, price_3_msg, \
+                cost_4, cost_4_msg, price_4, price_4_msg = cls._find_quote_pax_variant_amounts(
+                    pax_variant, allotment_list, transfer_list, extra_list, package_list,
+                    agency, booked, variant_dict)
 
-            variant_dict.update({'total': cls._quote_amounts_dict(
-                cost_1, cost_1_msg, price_1, price_1_msg,
-                cost_2, cost_2_msg, price_2, price_2_msg,
-                cost_3, cost_3_msg, price_3, price_3_msg,
-                cost_4, cost_4_msg, price_4, price_4_msg)})
+                variant_dict.update({'total': cls._quote_amounts_dict(
+                    cost_1, cost_1_msg, price_1, price_1_msg,
+                    cost_2, cost_2_msg, price_2, price_2_msg,
+                    cost_3, cost_3_msg, price_3, price_3_msg,
+                    cost_4, cost_4_msg, price_4, price_4_msg)})
 
-            result.append(variant_dict)
+                result.append(variant_dict)
 
         return 0, '', result
 
@@ -872,7 +938,15 @@ class BookingServices(object):
             cost_4, cost_4_msg, price_4, price_4_msg
 
     @classmethod
-    def find_quoteservice_amounts(
+    def find_quoteservice_amounts(cls, quoteservice, variant_list):
+        """
+        finds quote service amounts for every variant loading each catalog rate plan once
+        """
+        with ConfigServices.rate_plan_index():
+            return cls._find_quoteservice_variants_amounts(quoteservice, variant_list)
+
+    @classmethod
+    def _find_quoteservice_variants_amounts(
             cls, quoteservice, variant_list):
         result = list()
 
@@ -2395,13 +2469,7 @@ class BookingServices(object):
         if hasattr(quote, "avoid_sync_paxvariants"):
             return
         # verify on all services if pax variant exists
-        quote_services = list(QuoteService.objects.all().filter(
-            quote=quote.id))
-        quote_pax_variants = list(QuotePaxVariant.objects.all().filter(
-            quote=quote.id))
-
-        for quote_pax_variant in quote_pax_variants:
-            cls._sync_quote_children_paxvariants(quote_pax_variant, quote_services, user)
+        cls.update_quote_amounts(quote)
 
     @classmethod
     def sync_quote_children_paxvariants(cls, quote_pax_variant, user=None):
@@ -2510,6 +2578,138 @@ class BookingServices(object):
 
     @classmethod
     def update_quoteservice_paxvariants_amounts(cls, quote_service):
+        """
+        updates quote service variants amounts loading each catalog rate plan once
+        """
+        with ConfigServices.rate_plan_index():
+            return cls._update_quoteservice_paxvariants_amounts(quote_service)
+
+    @classmethod
+    def update_quote_amounts(cls, quote):
+        """
+        updates amounts of all quote services pax variants and quote pax variants
+        as one (pax variant x service) matrix loading each catalog rate plan once
+        and writing changed rows with bulk updates
+        """
+        with ConfigServices.rate_plan_index():
+            with transaction.atomic(savepoint=False):
+                return cls._update_quote_amounts(quote)
+
+    @classmethod
+    def _update_quote_amounts(cls, quote):
+        quote_pax_variants = list(QuotePaxVariant.objects.filter(quote=quote.id))
+        if not quote_pax_variants:
+            return 0
+        services = cls._find_quote_services(quote)
+        service_pax_variants = dict()
+        for service_pax_variant in QuoteServicePaxVariant.objects.filter(
+                quote_pax_variant__quote=quote.id):
+            service_pax_variants[(
+                service_pax_variant.quote_service_id,
+                service_pax_variant.quote_pax_variant_id)] = service_pax_variant
+
+        # packages amounts come from their services amounts so go last
+        updated = cls._update_quoteservices_paxvariants_matrix(
+            [service for service in services if not isinstance(service, QuoteExtraPackage)],
+            quote_pax_variants, service_pax_variants)
+        updated += cls._update_quoteservices_paxvariants_matrix(
+            [service for service in services if isinstance(service, QuoteExtraPackage)],
+            quote_pax_variants, service_pax_variants)
+        cls._update_quote_paxvariants_totals(quote_pax_variants)
+        return updated
+
+    @classmethod
+    def _find_quote_services(cls, quote):
+        """
+        returns quote services, book details and packages child objects
+        loading each child model with one query
+        """
+        services = list()
+        for model, service_field in [
+                (NewQuoteAllotment, 'service'),
+                (NewQuoteTransfer, 'service'),
+                (NewQuoteExtra, 'service'),
+                (NewQuoteServiceBookDetailAllotment, 'book_service'),
+                (NewQuoteServiceBookDetailTransfer, 'book_service'),
+                (NewQuoteServiceBookDetailExtra, 'book_service'),
+                (QuoteExtraPackage, 'service')]:
+            services.extend(
+                model.objects.select_related('quote__agency', 'provider', service_field).filter(
+                    quote=quote.id).order_by('pk'))
+        return services
+
+    @classmethod
+    def _update_quoteservices_paxvariants_matrix(
+            cls, services, quote_pax_variants, service_pax_variants):
+        """
+        sets amounts on services pax variants as pre save setup does
+        and writes new and changed ones in bulk.
+        bulk writes skip services pax variants save signals, so package
+        services must be in the matrix and callers totalize quote pax variants
+        """
+        new_objs = list()
+        changed = list()
+        for service in services:
+            for quote_pax_variant in quote_pax_variants:
+                obj = service_pax_variants.get((service.id, quote_pax_variant.id))
+                if obj is None:
+                    obj = QuoteServicePaxVariant(
+                        quote_service_id=service.id,
+                        quote_pax_variant_id=quote_pax_variant.id)
+                    new_objs.append(obj)
+                    service_pax_variants[(service.id, quote_pax_variant.id)] = obj
+                elif obj.manual_costs and obj.manual_prices and not quote_pax_variant.price_percent:
+                    continue
+                # avoid loading again related objects
+                obj.quote_service = service
+                obj.quote_pax_variant = quote_pax_variant
+                if cls.setup_paxvariant_amounts(obj) and obj.pk:
+                    changed.append(obj)
+        if new_objs:
+            QuoteServicePaxVariant.objects.bulk_create(new_objs)
+        if changed:
+            QuoteServicePaxVariant.objects.bulk_update(changed, [
+                'manual_costs', 'manual_prices',
+                'cost_single_amount', 'cost_double_amount',
+                'cost_triple_amount', 'cost_qdrple_amount',
+                'price_single_amount', 'price_double_amount',
+                'price_triple_amount', 'price_qdrple_amount'])
+        return len(new_objs) + len(changed)
+
+    @classmethod
+    def _update_quote_paxvariants_totals(cls, quote_pax_variants):
+        """
+        totalizes quote pax variants amounts loading services pax variants with two queries
+        """
+        excluded_status = [constants.SERVICE_STATUS_CANCELLED, constants.SERVICE_STATUS_CANCELLING]
+        ids = [quote_pax_variant.id for quote_pax_variant in quote_pax_variants]
+        provided_pax_variants = dict()
+        for pax_variant in QuoteServicePaxVariant.provided_objects.filter(
+                quote_pax_variant__in=ids).exclude(quote_service__status__in=excluded_status):
+            provided_pax_variants.setdefault(pax_variant.quote_pax_variant_id, list()).append(pax_variant)
+        invoiced_pax_variants = dict()
+        for pax_variant in QuoteServicePaxVariant.invoiced_objects.filter(
+                quote_pax_variant__in=ids).exclude(quote_service__status__in=excluded_status):
+            invoiced_pax_variants.setdefault(pax_variant.quote_pax_variant_id, list()).append(pax_variant)
+
+        changed = list()
+        fields = set()
+        for quote_pax_variant in quote_pax_variants:
+            c1, c2, c3, c4 = cls._totalize_pax_variants_costs(
+                provided_pax_variants.get(quote_pax_variant.id))
+            p1, p2, p3, p4 = cls._totalize_pax_variants_prices(
+                invoiced_pax_variants.get(quote_pax_variant.id))
+            pax_variant_fields = cls._build_pax_variant_fields(
+                quote_pax_variant, c1, c2, c3, c4, p1, p2, p3, p4)
+            if pax_variant_fields:
+                changed.append(quote_pax_variant)
+                fields.update(pax_variant_fields)
+        if changed:
+            QuotePaxVariant.objects.bulk_update(changed, sorted(fields))
+        return len(changed)
+
+    @classmethod
+    def _update_quoteservice_paxvariants_amounts(cls, quote_service):
         if hasattr(quote_service, "avoid_sync_paxvariants"):
             return
 
@@ -2748,8 +2948,7 @@ class BookingServices(object):
         quote_pax_variants = list(
             QuotePaxVariant.objects.all().filter(quote=quote.id))
 
-        for quote_pax_variant in quote_pax_variants:
-            cls.update_quote_paxvariant_amounts(quote_pax_variant)
+        cls._update_quote_paxvariants_totals(quote_pax_variants)
 
     @classmethod
     def update_quote_paxvariant_amounts(cls, pax_variant, user=None):
@@ -3007,6 +3206,14 @@ class BookingServices(object):
 
     @classmethod
     def find_booking_amounts(cls, booking, pax_list):
+        """
+        finds booking amounts loading each catalog rate plan once
+        """
+        with ConfigServices.rate_plan_index():
+            return cls._find_booking_amounts(booking, pax_list)
+
+    @classmethod
+    def _find_booking_amounts(cls, booking, pax_list):
         agency = None
         if hasattr(booking, 'agency'):
             agency = booking.agency
@@ -3955,8 +4162,12 @@ class BookingServices(object):
                     cls.update_bookingservice_amounts(extra)
 
     @classmethod
-    def update_booking(cls, booking_or_bookingservice):
-
+    def update_booking(cls, booking_or_bookingservice, full_recompute=False):
+        """
+        updates booking dates, status and amounts from its services.
+        Aggregates are found with a fixed number of queries, full_recompute
+        scans every service as done before and is kept to verify them
+        """
         if hasattr(booking_or_bookingservice, 'avoid_booking_update'):
             return
         if hasattr(booking_or_bookingservice, 'booking'):
@@ -3966,6 +4177,130 @@ class BookingServices(object):
         else:
             return
 
+        if full_recompute:
+            date_from, date_to, status = cls._find_booking_dates_status_full(booking)
+        else:
+            date_from, date_to, status = cls._find_booking_dates_status(booking)
+
+        fields = []
+        if booking.date_from != date_from:
+            fields.append('date_from')
+            booking.date_from = date_from
+        if booking.date_to != date_to:
+            fields.append('date_to')
+            booking.date_to = date_to
+        if booking.status != status:
+            fields.append('status')
+            booking.status = status
+
+        cls._set_update_booking_amounts(booking, fields, full_recompute)
+
+        if fields:
+            booking.save(update_fields=fields)
+
+    @classmethod
+    def verify_booking_aggregates(cls, booking):
+        """
+        returns booking aggregate names whose values differ from a full recompute
+        """
+        aggregates = cls._find_booking_dates_status(booking) + cls._find_booking_totals(booking)
+        full_aggregates = cls._find_booking_dates_status_full(booking) + cls._find_booking_totals_full(booking)
+        names = ['date_from', 'date_to', 'status', 'cost_amount', 'price_amount']
+        differences = []
+        for name, value, full_value in zip(names, aggregates, full_aggregates):
+            if name in ['cost_amount', 'price_amount']:
+                if not cls._equals_amounts(value, full_value):
+                    differences.append(name)
+            elif value != full_value:
+                differences.append(name)
+        return differences
+
+    @classmethod
+    def _find_booking_dates_status(cls, booking):
+        """
+        finds booking dates and status grouping services by status
+        """
+        cancelled_statuses = [constants.SERVICE_STATUS_CANCELLED, constants.SERVICE_STATUS_CANCELLING]
+        detail_categories = [
+            constants.BASE_BOOKING_SERVICE_CATEGORY_BOOKING_DETAIL_ALLOTMENT,
+            constants.BASE_BOOKING_SERVICE_CATEGORY_BOOKING_DETAIL_TRANSFER,
+            constants.BASE_BOOKING_SERVICE_CATEGORY_BOOKING_DETAIL_EXTRA]
+
+        groups = BaseBookingService.objects.filter(booking=booking.id).order_by().values(
+            'status', 'base_category', 'bookingbookdetail__booking_service__status',
+        ).annotate(
+            min_datetime_from=Min('datetime_from'),
+            max_datetime_to=Max(Coalesce('datetime_to', 'datetime_from')),
+        )
+
+        date_from = None
+        date_to = None
+        # dates to use when all services are cancelled
+        date_from_min = None
+        date_to_max = None
+        booking_with_services = False
+        statuses = set()
+        for group in groups:
+            booking_with_services = True
+            date_from_min = cls._min_date(date_from_min, group['min_datetime_from'])
+            date_to_max = cls._max_date(date_to_max, group['max_datetime_to'])
+            if group['status'] in cancelled_statuses:
+                continue
+            is_detail = group['base_category'] in detail_categories
+            if is_detail and group['bookingbookdetail__booking_service__status'] in cancelled_statuses:
+                # detail service with parent cancelled not processed
+                continue
+            date_from = cls._min_date(date_from, group['min_datetime_from'])
+            date_to = cls._max_date(date_to, group['max_datetime_to'])
+            if not is_detail:
+                # details are not used for status
+                statuses.add(group['status'])
+
+        if not booking_with_services:
+            return None, None, constants.BOOKING_STATUS_PENDING
+        if not statuses:
+            return date_from_min, date_to_max, constants.BOOKING_STATUS_CANCELLED
+
+        if constants.SERVICE_STATUS_PENDING in statuses and constants.SERVICE_STATUS_ON_HOLD in statuses:
+            # last one of services in pending or on-hold sets status
+            status = list(BaseBookingService.objects.filter(
+                booking=booking.id,
+                status__in=[constants.SERVICE_STATUS_PENDING, constants.SERVICE_STATUS_ON_HOLD]
+            ).exclude(base_category__in=detail_categories).values_list('status', flat=True))[-1]
+            if status == constants.SERVICE_STATUS_PENDING:
+                status = constants.BOOKING_STATUS_PENDING
+            else:
+                status = constants.BOOKING_STATUS_ON_HOLD
+        elif constants.SERVICE_STATUS_PENDING in statuses:
+            status = constants.BOOKING_STATUS_PENDING
+        elif constants.SERVICE_STATUS_ON_HOLD in statuses:
+            status = constants.BOOKING_STATUS_ON_HOLD
+        elif (constants.SERVICE_STATUS_REQUEST in statuses
+                or constants.SERVICE_STATUS_PHONE_CONFIRMED in statuses):
+            status = constants.BOOKING_STATUS_REQUEST
+        elif constants.SERVICE_STATUS_CONFIRMED in statuses:
+            status = constants.BOOKING_STATUS_CONFIRMED
+        elif constants.SERVICE_STATUS_COORDINATED in statuses:
+            status = constants.BOOKING_STATUS_COORDINATED
+        else:
+            status = constants.BOOKING_STATUS_NOSHOW
+        return date_from, date_to, status
+
+    @classmethod
+    def _min_date(cls, date1, date2):
+        if date1 is None or (date2 is not None and date2 < date1):
+            return date2
+        return date1
+
+    @classmethod
+    def _max_date(cls, date1, date2):
+        if date1 is None or (date2 is not None and date2 > date1):
+            return date2
+        return date1
+
+    @classmethod
+    def _find_booking_dates_status_full(cls, booking):
+
         date_from = None
         date_to = None
         # date to use when all services are cancelled
@@ -4068,24 +4403,61 @@ class BookingServices(object):
             date_to = None
             status = constants.BOOKING_STATUS_PENDING
 
-        fields = []
-        if booking.date_from != date_from:
-            fields.append('date_from')
-            booking.date_from = date_from
-        if booking.date_to != date_to:
-            fields.append('date_to')
-            booking.date_to = date_to
-        if booking.status != status:
-            fields.append('status')
-            booking.status = status
+        return date_from, date_to, status
 
-        cls._set_update_booking_amounts(booking, fields)
+    @classmethod
+    def _set_update_booking_amounts(cls, booking, fields, full_recompute=False):
 
-        if fields:
-            booking.save(update_fields=fields)
+        if full_recompute:
+            cost, price = cls._find_booking_totals_full(booking)
+        else:
+            cost, price = cls._find_booking_totals(booking)
+
+        if not cls._equals_amounts(booking.cost_amount, cost):
+            fields.append('cost_amount')
+            booking.cost_amount = cost
+        if not cls._equals_amounts(booking.price_amount, price):
+            fields.append('price_amount')
+            booking.price_amount = price
 
     @classmethod
-    def _set_update_booking_amounts(cls, booking, fields):
+    def _find_booking_totals(cls, booking):
+        """
+        finds booking cost and price with aggregate queries
+        """
+        cost = cls._aggregate_services_amount(
+            BookingProvidedService.objects.filter(booking=booking.id), 'cost_amount')
+        if cost is not None:
+            cost = cls._round_cost(cost)
+
+        # verify package prices
+        if booking.is_package_price:
+            price, price_msg = cls._find_booking_package_price(booking)
+        else:
+            price = cls._aggregate_services_amount(
+                BaseBookingService.invoiced_objects.filter(booking=booking.id), 'price_amount')
+            if price is not None:
+                price = cls._round_price(price)
+        return cost, price
+
+    @classmethod
+    def _aggregate_services_amount(cls, queryset, field):
+        """
+        sums field of not cancelled services, None when no services or some amount missing
+        """
+        totals = queryset.exclude(
+            status__in=[constants.SERVICE_STATUS_CANCELLED, constants.SERVICE_STATUS_CANCELLING]
+        ).order_by().aggregate(
+            services=Count('pk'),
+            missing=Count('pk', filter=Q(**{'%s__isnull' % field: True})),
+            total=Sum(field),
+        )
+        if not totals['services'] or totals['missing']:
+            return None
+        return totals['total']
+
+    @classmethod
+    def _find_booking_totals_full(cls, booking):
 
         booking_provided_services = list(
             BookingProvidedService.objects.all().filter(
@@ -4104,12 +4476,7 @@ class BookingServices(object):
         if booking.is_package_price:
             price, price_msg = cls._find_booking_package_price(booking)
 
-        if not cls._equals_amounts(booking.cost_amount, cost):
-            fields.append('cost_amount')
-            booking.cost_amount = cost
-        if not cls._equals_amounts(booking.price_amount, price):
-            fields.append('price_amount')
-            booking.price_amount = price
+        return cost, price
 
     @classmethod
     def _find_groups(cls, pax_list):
@@ -4208,9 +4575,9 @@ class BookingServices(object):
                 status__in=[constants.SERVICE_STATUS_CANCELLED, constants.SERVICE_STATUS_CANCELLING]).order_by(
                     'datetime_from', 'time', 'datetime_to'))
         services = list()
-        for bookingservice in bookingservices:
-            cost, c_msg, price, p_msg = cls._find_bookingservice_update_amounts(
-                bookingservice=bookingservice, agency=agency)
+        bookingservices_amounts = cls.find_bookingservices_update_amounts(bookingservices, agency)
+        for bookingservice, amounts in zip(bookingservices, bookingservices_amounts):
+            cost, c_msg, price, p_msg = amounts[1]
             if not cls._equals_amounts(cost, bookingservice.cost_amount) \
                     or not cls._equals_amounts(price, bookingservice.price_amount):
                 bookingservice.update_cost_amount = cost
@@ -4220,8 +4587,141 @@ class BookingServices(object):
 
     @classmethod
     def update_bookingservices_amounts(cls, services):
-        for service in services:
-            cls.update_bookingservice_amounts(service)
+        services = list(services)
+        bookingservices_amounts = cls.find_bookingservices_update_amounts(services)
+        with ConfigServices.rate_plan_index():
+            for service, amounts in zip(services, bookingservices_amounts):
+                bookingservice, (cost, cost_msg, price, price_msg) = amounts
+                if hasattr(service, 'avoid_update'):
+                    continue
+                if isinstance(bookingservice, (
+                        BookingProvidedAllotment, BookingProvidedTransfer, BookingProvidedExtra)):
+                    cls._save_booking_service_amounts(bookingservice, cost, price)
+                    service.cost_amount = bookingservice.cost_amount
+                    service.price_amount = bookingservice.price_amount
+                else:
+                    cls.update_bookingservice_amounts(service)
+
+    @classmethod
+    def find_bookingservices_update_amounts(cls, bookingservices, agency=None):
+        """
+        finds update amounts for a list of booking services.
+        Returns a (bookingservice child object, (cost, cost_msg, price, price_msg)) pair
+        for each booking service.
+        Catalog priced services are priced in batch with a fixed number of queries,
+        other services are priced one by one
+        """
+        bookingservices = cls._find_booking_services(bookingservices)
+        pax_lists = cls._find_bookingservices_pax_lists(bookingservices)
+
+        requests = list()
+        requested = list()
+        results = list()
+        with ConfigServices.rate_plan_index():
+            for bookingservice in bookingservices:
+                results.append(None)
+                if not cls._is_catalog_bookingservice(bookingservice):
+                    continue
+                pax_list = pax_lists.get(
+                    bookingservice.booking_package_id or bookingservice.id, list())
+                requests.append(cls._bookingservice_amounts_request(
+                    bookingservice, pax_list, agency or bookingservice.booking.agency))
+                requested.append(len(results) - 1)
+
+            for position, amounts in zip(requested, ConfigServices.batch_amounts(requests)):
+                results[position] = cls._apply_bookingservice_manuals(
+                    bookingservices[position], *amounts)
+
+            for position, bookingservice in enumerate(bookingservices):
+                if results[position] is not None:
+                    continue
+                if bookingservice is None:
+                    results[position] = (
+                        None, "Service Not Found", None, "Service Not Found")
+                else:
+                    results[position] = cls._find_bookingservice_update_amounts(
+                        bookingservice=bookingservice, agency=agency)
+
+        return list(zip(bookingservices, results))
+
+    @classmethod
+    def _find_booking_services(cls, bookingservices):
+        """
+        returns booking services child objects in the same order, loading
+        each child model with one query
+        """
+        select_related = dict()
+        for model in set(BOOKINGSERVICE_MODELS.values()):
+            select_related[model] = ['booking__agency', 'provider']
+            if issubclass(model, (BookingProvidedService, BookingExtraPackage)):
+                select_related[model].append('service')
+        return get_bookingservice_objects(bookingservices, select_related)
+
+    @classmethod
+    def _find_bookingservices_pax_lists(cls, bookingservices):
+        """
+        returns rooming lists by booking service id loaded with one query
+        """
+        ids = set()
+        for bookingservice in bookingservices:
+            if isinstance(bookingservice, BookingProvidedService):
+                ids.add(bookingservice.booking_package_id or bookingservice.id)
+        pax_lists = dict()
+        if ids:
+            for pax in BaseBookingServicePax.objects.select_related('booking_pax').filter(
+                    booking_service__in=ids).order_by('pk'):
+                pax_lists.setdefault(pax.booking_service_id, list()).append(pax)
+        return pax_lists
+
+    @classmethod
+    def _is_catalog_bookingservice(cls, bookingservice):
+        return (
+            isinstance(bookingservice, (
+                BookingProvidedAllotment, BookingProvidedTransfer, BookingProvidedExtra))
+            and bookingservice.service_id is not None
+            and (bookingservice.manual_cost or bookingservice.cost_by_catalog)
+            and (bookingservice.manual_price or bookingservice.price_by_catalog))
+
+    @classmethod
+    def _bookingservice_amounts_request(cls, bookingservice, pax_list, agency):
+        service = bookingservice.service
+        request = AmountsRequest(
+            service=service,
+            date_from=bookingservice.datetime_from,
+            date_to=bookingservice.datetime_to,
+            cost_groups=cls.find_bookingservice_paxes_groups(pax_list, service, True),
+            price_groups=cls.find_bookingservice_paxes_groups(pax_list, service, False),
+            provider=bookingservice.provider,
+            agency=agency,
+            booked=bookingservice.booking.booked,
+            contract_code=bookingservice.contract_code,
+            addon_id=bookingservice.service_addon_id)
+        if isinstance(bookingservice, BookingProvidedAllotment):
+            return request._replace(
+                board_type=bookingservice.board_type,
+                room_type_id=bookingservice.room_type_id)
+        if isinstance(bookingservice, BookingProvidedTransfer):
+            return request._replace(
+                quantity=bookingservice.quantity,
+                location_from_id=bookingservice.location_from_id,
+                location_to_id=bookingservice.location_to_id)
+        return request._replace(
+            quantity=bookingservice.quantity,
+            parameter=bookingservice.parameter)
+
+    @classmethod
+    def _apply_bookingservice_manuals(cls, bookingservice, cost, cost_msg, price, price_msg):
+        if bookingservice.manual_cost:
+            cost = bookingservice.cost_amount
+            cost_msg = None
+            if cost is None:
+                cost_msg = "Missing Manual Cost"
+        if bookingservice.manual_price:
+            price = bookingservice.price_amount
+            price_msg = None
+            if price is None:
+                price_msg = "Missing Manual Price"
+        return cost, cost_msg, price, price_msg
 
     @classmethod
     def find_providers(cls, bookingservice):
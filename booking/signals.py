@@ -16,6 +16,53 @@ from booking.models import (
     ProviderBookingPayment, ProviderPaymentBookingProvided,
 )
 from booking.services import BookingServices
+from common.deferred import DeferredUpdates
+
+
+# recalculations run at commit, services before packages before bookings and quotes
+PRIORITY_BOOKINGSERVICE = 0
+PRIORITY_BOOKINGPACKAGE = 1
+PRIORITY_BOOKING = 2
+PRIORITY_QUOTESERVICE = 0
+PRIORITY_QUOTE_PAXVARIANT = 1
+PRIORITY_QUOTE = 2
+
+
+def defer_update_booking(instance):
+    DeferredUpdates.schedule(
+        'booking', PRIORITY_BOOKING, Booking, instance.booking_id,
+        BookingServices.update_booking)
+
+
+def defer_update_bookingpackage(instance):
+    DeferredUpdates.schedule(
+        'bookingpackage', PRIORITY_BOOKINGPACKAGE, BookingExtraPackage, instance.booking_package_id,
+        BookingServices.update_bookingpackage)
+
+
+def defer_update_quote(instance):
+    DeferredUpdates.schedule(
+        'quote', PRIORITY_QUOTE, Quote, instance.quote_id,
+        BookingServices.update_quote)
+
+
+def defer_update_quote_paxvariant(instance):
+    DeferredUpdates.schedule(
+        'quote_paxvariant', PRIORITY_QUOTE_PAXVARIANT, QuotePaxVariant, instance.quote_pax_variant_id,
+        BookingServices.update_quote_paxvariant_amounts)
+
+
+def update_quoteservice(quote_service):
+    with transaction.atomic(savepoint=False):
+        BookingServices.update_quoteservice_paxvariants_amounts(quote_service)
+        if getattr(quote_service, 'quote_package', None):
+            BookingServices.update_quotepackage_service_pax_variants_amounts(quote_service)
+            BookingServices.update_quotepackage(quote_service)
+
+
+def defer_update_quoteservice(instance, model):
+    DeferredUpdates.schedule(
+        'quoteservice', PRIORITY_QUOTESERVICE, model, instance.pk, update_quoteservice)
 
 
 # Quote
@@ -46,14 +93,13 @@ def post_save_quoteservice_paxvariant(sender, instance, **kwargs):
         with transaction.atomic(savepoint=False):
             if instance.quote_service.base_category == QUOTE_SERVICE_CATEGORY_QUOTE_PACKAGE:
                 BookingServices.sync_quotepackage_children_paxvariants(instance)
-            BookingServices.update_quote_paxvariant_amounts(instance)
+        defer_update_quote_paxvariant(instance)
 
 
 @receiver(post_delete, sender=QuoteServicePaxVariant)
 def post_delete_quoteservice_paxvariant(sender, instance, **kwargs):
     if not hasattr(instance, 'avoid_all'):
-        with transaction.atomic(savepoint=False):
-            BookingServices.update_quote_paxvariant_amounts(instance)
+        defer_update_quote_paxvariant(instance)
 
 
 @receiver(post_save, sender=NewQuoteAllotment)
@@ -75,19 +121,15 @@ def post_save_quoteextra(sender, instance, **kwargs):
 def post_save_quotepackage(sender, instance, **kwargs):
     if not hasattr(instance, 'avoid_all'):
         with transaction.atomic(savepoint=False):
-            BookingServices.update_quoteservice_paxvariants_amounts(instance)
             BookingServices.sync_quotepackage_services(instance)
-            BookingServices.update_quote(instance)
+        defer_update_quoteservice(instance, QuoteExtraPackage)
+        defer_update_quote(instance)
 
 
 def post_save_quoteservice(instance):
     if not hasattr(instance, 'avoid_all'):
-        with transaction.atomic(savepoint=False):
-            BookingServices.update_quoteservice_paxvariants_amounts(instance)
-            if instance.quote_package:
-                BookingServices.update_quotepackage_service_pax_variants_amounts(instance)
-                BookingServices.update_quotepackage(instance)
-            BookingServices.update_quote(instance)
+        defer_update_quoteservice(instance, instance.__class__)
+        defer_update_quote(instance)
 
 
 # Booking
@@ -95,8 +137,9 @@ def post_save_quoteservice(instance):
 @receiver((post_save, post_delete), sender=BaseBookingServicePax)
 def post_save_post_delete_bookingservicepax(sender, instance, **kwargs):
     if not hasattr(instance, 'avoid_bookingservice_update'):
-        with transaction.atomic(savepoint=False):
-            BookingServices.update_bookingservice_amounts(instance.booking_service)
+        DeferredUpdates.schedule(
+            'bookingservice_amounts', PRIORITY_BOOKINGSERVICE, BaseBookingService,
+            instance.booking_service_id, BookingServices.update_bookingservice_amounts)
 
 
 @receiver(pre_save, sender=BookingProvidedAllotment)
@@ -157,38 +200,34 @@ def pre_delete_bookingpackage(sender, instance, **kwargs):
 @receiver((post_save, post_delete), sender=BookingProvidedAllotment)
 def post_save_post_delete_bookingallotment(sender, instance, **kwargs):
     if not hasattr(instance, 'avoid_all'):
-        with transaction.atomic(savepoint=False):
-            if not hasattr(instance, 'avoid_booking_update'):
-                BookingServices.update_booking(instance)
-            if not hasattr(instance, 'avoid_bookingpackage_update'):
-                BookingServices.update_bookingpackage(instance)
+        if not hasattr(instance, 'avoid_booking_update'):
+            defer_update_booking(instance)
+        if not hasattr(instance, 'avoid_bookingpackage_update'):
+            defer_update_bookingpackage(instance)
 
 
 @receiver((post_save, post_delete), sender=BookingProvidedTransfer)
 def post_save_post_delete_bookingtransfer(sender, instance, **kwargs):
     if not hasattr(instance, 'avoid_all'):
-        with transaction.atomic(savepoint=False):
-            if not hasattr(instance, 'avoid_booking_update'):
-                BookingServices.update_booking(instance)
-            if not hasattr(instance, 'avoid_bookingpackage_update'):
-                BookingServices.update_bookingpackage(instance)
+        if not hasattr(instance, 'avoid_booking_update'):
+            defer_update_booking(instance)
+        if not hasattr(instance, 'avoid_bookingpackage_update'):
+            defer_update_bookingpackage(instance)
 
 
 @receiver((post_save, post_delete), sender=BookingProvidedExtra)
 def post_save_post_delete_bookingextra(sender, instance, **kwargs):
     if not hasattr(instance, 'avoid_all'):
-        with transaction.atomic(savepoint=False):
-            if not hasattr(instance, 'avoid_booking_update'):
-                BookingServices.update_booking(instance)
-            if not hasattr(instance, 'avoid_bookingpackage_update'):
-                BookingServices.update_bookingpackage(instance)
+        if not hasattr(instance, 'avoid_booking_update'):
+            defer_update_booking(instance)
+        if not hasattr(instance, 'avoid_bookingpackage_update'):
+            defer_update_bookingpackage(instance)
 
 
 @receiver((post_save, post_delete), sender=BookingExtraPackage)
 def post_save_post_delete_bookingpackage(sender, instance, **kwargs):
     if not hasattr(instance, 'avoid_all') and not hasattr(instance, 'avoid_booking_update'):
-        with transaction.atomic(savepoint=False):
-            BookingServices.update_booking(instance)
+        defer_update_booking(instance)
 
 
 @receiver((post_save), sender=BookingInvoice)
@@ -1,5 +1,31 @@
+import csv
 import unittest
-from django.test import TestCase
+from datetime import date, timedelta
+
+from django.contrib.admin.utils import label_for_field
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.encoding import force_text
+
+from booking import constants
+from booking.benchmark import BenchmarkData, BenchmarkSuite
+from booking.common_site import BaseServiceChangeList, BookingStatusChangeList
+from booking.models import (
+    Booking, BookingInvoice, BookingPax, BookingProvidedExtra, BookingExtraPackage,
+    BaseBookingService, BaseBookingServicePax,
+    Quote, QuotePaxVariant, QuoteServicePaxVariant, NewQuoteExtra,
+    NewQuoteServiceBookDetailExtra,
+    annotate_bookingservice_columns, get_bookingservice_objects,
+)
+from booking.services import BookingServices
+from common.deferred import DeferredUpdates
+from config.constants import AMOUNTS_FIXED, EXTRA_PARAMETER_TYPE_STAY
+from config.models import Extra
+from finance.models import Agency, AgencyPayment, Provider
+from reservas.admin import bookings_site
 
 # Create your tests here.
 
@@ -25,4 +51,371 @@ class BookingTest(TestCase):
         self.assertContains(response, 'Select BaseBookingService to change')
 
         # Check that the rendered context contains 5 customers.
-        # self.assertEqual(len(response.context['customers']), 5)
\ No newline at end of file
+        # self.assertEqual(len(response.context['customers']), 5)
+
+class BookingServicesTestCase(TestCase):
+
+    def setUp(self):
+        # requests of rolled back test transactions are only dropped at a commit
+        DeferredUpdates.clear()
+        self.test_user = User.objects.create(username='seller')
+        self.test_agency = Agency.objects.create(name='Test Agency')
+        self.test_provider = Provider.objects.create(name='Test Provider')
+        self.test_extra = Extra.objects.create(
+            name='Test Extra', cost_type=AMOUNTS_FIXED,
+            parameter_type=EXTRA_PARAMETER_TYPE_STAY)
+        self.test_booking = Booking.objects.create(
+            name='Test Booking', agency=self.test_agency, seller=self.test_user)
+
+    def create_bookingextra(self, date_from, date_to, status, cost, price):
+        return BookingProvidedExtra.objects.create(
+            booking=self.test_booking, service=self.test_extra, name='Test Extra',
+            provider=self.test_provider, status=status,
+            datetime_from=date_from, datetime_to=date_to,
+            manual_cost=True, cost_amount=cost, manual_price=True, price_amount=price)
+
+    def test_update_booking(self):
+        """
+        Does booking dates, status and amounts from services aggregates
+        """
+        self.create_bookingextra(
+            date(2020, 1, 10), date(2020, 1, 12), constants.SERVICE_STATUS_CONFIRMED, 100, 120.5)
+        self.create_bookingextra(
+            date(2020, 1, 8), None, constants.SERVICE_STATUS_REQUEST, 50.25, 60)
+        self.create_bookingextra(
+            date(2020, 1, 1), date(2020, 1, 20), constants.SERVICE_STATUS_CANCELLED, 10, 10)
+
+        BookingServices.update_booking(self.test_booking)
+
+        booking = Booking.objects.get(pk=self.test_booking.pk)
+        self.assertEqual(booking.date_from, date(2020, 1, 8))
+        self.assertEqual(booking.date_to, date(2020, 1, 12))
+        self.assertEqual(booking.status, constants.BOOKING_STATUS_REQUEST)
+        self.assertEqual(float(booking.cost_amount), 150.25)
+        self.assertEqual(float(booking.price_amount), 181)
+        self.assertEqual(BookingServices.verify_booking_aggregates(booking), [])
+
+    def test_update_booking_all_cancelled(self):
+        """
+        Does booking cancelled when all services are cancelled
+        """
+        bookingextra = self.create_bookingextra(
+            date(2020, 1, 10), date(2020, 1, 12), constants.SERVICE_STATUS_PENDING, 100, None)
+        self.create_bookingextra(
+            date(2020, 1, 2), date(2020, 1, 5), constants.SERVICE_STATUS_ON_HOLD, 10, 10)
+        self.assertEqual(BookingServices.verify_booking_aggregates(self.test_booking), [])
+
+        bookingextra.status = constants.SERVICE_STATUS_CANCELLED
+        bookingextra.save()
+        BookingServices.update_booking(self.test_booking)
+        self.assertEqual(self.test_booking.status, constants.BOOKING_STATUS_ON_HOLD)
+        BookingProvidedExtra.objects.filter(
+            booking=self.test_booking).update(status=constants.SERVICE_STATUS_CANCELLED)
+
+        BookingServices.update_booking(self.test_booking)
+
+        self.assertEqual(self.test_booking.status, constants.BOOKING_STATUS_CANCELLED)
+        self.assertEqual(self.test_booking.date_from, date(2020, 1, 2))
+        self.assertEqual(self.test_booking.date_to, date(2020, 1, 12))
+        self.assertIsNone(self.test_booking.cost_amount)
+        self.assertEqual(BookingServices.verify_booking_aggregates(self.test_booking), [])
+
+    def test_deferred_update_booking(self):
+        """
+        Does booking updated once at commit after saving many services
+        """
+        for day in range(1, 4):
+            self.create_bookingextra(
+                date(2020, 1, day), date(2020, 1, day + 1), constants.SERVICE_STATUS_CONFIRMED, 10, 20)
+        # one booking update and no packages
+        self.assertEqual(DeferredUpdates.pending_count(), 1)
+        self.assertIsNone(Booking.objects.get(pk=self.test_booking.pk).date_from)
+
+        DeferredUpdates.flush()
+
+        booking = Booking.objects.get(pk=self.test_booking.pk)
+        self.assertEqual(DeferredUpdates.pending_count(), 0)
+        self.assertEqual(booking.date_from, date(2020, 1, 1))
+        self.assertEqual(booking.date_to, date(2020, 1, 4))
+        self.assertEqual(booking.status, constants.BOOKING_STATUS_CONFIRMED)
+        self.assertEqual(float(booking.cost_amount), 30)
+
+    def build_quote(self):
+        quote = Quote.objects.create(
+            description='Test Quote', reference='Test Quote',
+            agency=self.test_agency, seller=self.test_user)
+        for day in range(1, 3):
+            NewQuoteExtra.objects.create(
+                quote=quote, service=self.test_extra, name='Test Extra',
+                provider=self.test_provider,
+                datetime_from=date(2020, 1, day), datetime_to=date(2020, 1, day))
+        QuotePaxVariant.objects.create(quote=quote, pax_quantity=2)
+        return quote
+
+    def test_build_booking_from_quote_bulk(self):
+        """
+        Does booking from quote with bulk creation same as saving one by one
+        """
+        quote = self.build_quote()
+        rooming = [
+            dict(pax_name='Pax %s' % pax, pax_age=None, pax_group=1, is_price_free=False)
+            for pax in range(2)]
+
+        bookings = [
+            BookingServices.build_booking_from_quote(quote.pk, rooming, self.test_user, bulk)[0]
+            for bulk in [False, True]]
+
+        for booking in bookings:
+            self.assertEqual(BookingPax.objects.filter(booking=booking).count(), 2)
+            self.assertEqual(BookingProvidedExtra.objects.filter(booking=booking).count(), 2)
+            self.assertEqual(BaseBookingServicePax.objects.filter(
+                booking_service__booking=booking).count(), 4)
+        self.assertEqual(bookings[1].date_from, bookings[0].date_from)
+        self.assertEqual(bookings[1].date_to, bookings[0].date_to)
+
+    def test_update_quote_amounts(self):
+        """
+        Does quote pax variants amounts matrix keeping manual amounts
+        """
+        quote = self.build_quote()
+        BookingServices.update_quote_amounts(quote)
+
+        service_pax_variants = list(QuoteServicePaxVariant.objects.filter(
+            quote_pax_variant__quote=quote).order_by('quote_service'))
+        self.assertEqual(len(service_pax_variants), 2)
+        for amount, service_pax_variant in zip([30, 20], service_pax_variants):
+            QuoteServicePaxVariant.objects.filter(pk=service_pax_variant.pk).update(
+                manual_costs=True, cost_single_amount=amount,
+                manual_prices=True, price_single_amount=amount + 5)
+
+        self.assertEqual(BookingServices.update_quote_amounts(quote), 0)
+        quote_pax_variant = QuotePaxVariant.objects.get(quote=quote)
+        self.assertEqual(float(quote_pax_variant.cost_single_amount), 50)
+        self.assertEqual(float(quote_pax_variant.price_single_amount), 60)
+
+    def test_update_quote_amounts_book_details(self):
+        """
+        Does quote pax variants amounts matrix including services book details
+        """
+        quote = self.build_quote()
+        quote_service = NewQuoteExtra.objects.filter(quote=quote).first()
+        detail = NewQuoteServiceBookDetailExtra.objects.create(
+            quote_service=quote_service, book_service=self.test_extra,
+            provider=self.test_provider,
+            datetime_from=date(2020, 1, 1), datetime_to=date(2020, 1, 1))
+
+        BookingServices.update_quote_amounts(quote)
+        self.assertEqual(QuoteServicePaxVariant.objects.filter(
+            quote_pax_variant__quote=quote).count(), 3)
+        self.assertTrue(QuoteServicePaxVariant.objects.filter(
+            quote_service=detail, quote_pax_variant__quote=quote).exists())
+        self.assertEqual(BookingServices.update_quote_amounts(quote), 0)
+
+    def test_booking_changelist_totals(self):
+        """
+        Does booking changelist totals with one aggregate query
+        """
+        invoice = BookingInvoice.objects.create(
+            agency=self.test_agency, invoice_booking=self.test_booking,
+            amount=150, matched_amount=40)
+        self.test_booking.cost_amount = 100
+        self.test_booking.price_amount = 150
+        self.test_booking.invoice = invoice
+        self.test_booking.save()
+        Booking.objects.create(
+            name='Other Booking', agency=self.test_agency, seller=self.test_user,
+            cost_amount=50.5)
+        site_model = bookings_site._registry[Booking]
+
+        with self.assertNumQueries(1):
+            totals = site_model.get_totals(Booking.objects.all())
+
+        bookings = list(Booking.objects.all())
+        self.assertEqual(totals, {
+            'Cost': 150.5,
+            'Price': 150,
+            'Invoiced': sum(booking.invoiced_amount for booking in bookings),
+            'Util.': sum(booking.utility for booking in bookings),
+            'Paid': sum(booking.paid_amount for booking in bookings),
+        })
+
+    def test_annotate_bookingservice_columns(self):
+        """
+        Does booking services list columns without queries by row
+        """
+        self.test_booking.reference = 'REF-1'
+        self.test_booking.save()
+        booking_pax = BookingPax.objects.create(
+            booking=self.test_booking, pax_name='Pax 1', pax_group=1)
+        package = BookingExtraPackage.objects.create(
+            booking=self.test_booking, service=self.test_extra, provider=self.test_provider,
+            datetime_from=date(2020, 1, 10), datetime_to=date(2020, 1, 12))
+        BaseBookingServicePax.objects.create(
+            booking_service=package, booking_pax=booking_pax, group=1)
+        BookingProvidedExtra.objects.create(
+            booking=self.test_booking, booking_package=package, service=self.test_extra,
+            provider=self.test_provider, datetime_from=date(2020, 1, 10), datetime_to=date(2020, 1, 10))
+        self.create_bookingextra(
+            date(2020, 1, 8), date(2020, 1, 9), constants.SERVICE_STATUS_PENDING, 10, 12)
+
+        columns = ['full_booking_name', 'service_pax_count', 'booking_internal_reference']
+        queryset = BaseBookingService.objects.exclude(
+            base_category=constants.BASE_BOOKING_SERVICE_CATEGORY_BOOKING_PACKAGE).order_by('pk')
+        expected = [
+            [getattr(service, column)() for column in columns] for service in queryset]
+
+        with self.assertNumQueries(1):
+            services = list(annotate_bookingservice_columns(queryset))
+            results = [
+                [getattr(service, column)() for column in columns] for service in services]
+        self.assertEqual(results, expected)
+        self.assertEqual(
+            [result[1] for result in results], ['1', '0'])
+
+    def test_bookingservices_as_concrete(self):
+        """
+        Does booking services child objects with one query by child model
+        """
+        package = BookingExtraPackage.objects.create(
+            booking=self.test_booking, service=self.test_extra, provider=self.test_provider,
+            datetime_from=date(2020, 1, 10), datetime_to=date(2020, 1, 12))
+        self.create_bookingextra(
+            date(2020, 1, 8), date(2020, 1, 9), constants.SERVICE_STATUS_PENDING, 10, 12)
+        services = list(BaseBookingService.objects.order_by('-pk'))
+
+        with self.assertNumQueries(3):
+            objs = BaseBookingService.objects.order_by('-pk').as_concrete(
+                select_related={BookingProvidedExtra: ['booking']})
+            self.assertEqual(objs[0].booking, self.test_booking)
+
+        self.assertEqual([obj.pk for obj in objs], [service.pk for service in services])
+        self.assertEqual(
+            [type(obj) for obj in objs], [BookingProvidedExtra, BookingExtraPackage])
+        self.assertEqual(objs, get_bookingservice_objects(services))
+        self.assertEqual(objs[1], package)
+
+    def build_services_changelist(self, session=None, **params):
+        request = RequestFactory().get('/', params)
+        if session is not None:
+            request.session = session
+        request.user = User.objects.create(username='admin%s' % User.objects.count(), is_superuser=True)
+        site_model = bookings_site._registry[BaseBookingService]
+        return BaseServiceChangeList(
+            request, BaseBookingService, site_model.list_display, site_model.list_display_links,
+            (), site_model.top_filters, None, (), False, 2, 200, (), site_model, None)
+
+    def test_services_changelist_keyset_pages(self):
+        """
+        Does services list pages seeking after last row same as offset pages
+        """
+        other_booking = Booking.objects.create(
+            name='Other Booking', reference='REF-2', agency=self.test_agency, seller=self.test_user)
+        # services list shows services from last month by default
+        for day in [3, 1, 3, 2, 3, 3, 1]:
+            service_date = date.today() + timedelta(days=day)
+            self.create_bookingextra(
+                service_date, service_date, constants.SERVICE_STATUS_PENDING, 10, 12)
+        BookingProvidedExtra.objects.filter(pk__in=list(
+            BookingProvidedExtra.objects.order_by('pk').values_list('pk', flat=True)[5:])).update(
+                booking=other_booking)
+
+        session = SessionStore()
+        changelist = self.build_services_changelist(session)
+        expected = list(changelist.queryset.values_list('pk', flat=True))
+        self.assertEqual(changelist.result_count, 7)
+
+        pks = []
+        while True:
+            self.assertTrue(changelist.keyset)
+            pks.extend(service.pk for service in changelist.result_list)
+            if not changelist.keyset_next:
+                break
+            # next pages take results count from session
+            with CaptureQueriesContext(connection) as captured:
+                changelist = self.build_services_changelist(
+                    session, after=changelist.keyset_next)
+            self.assertFalse([
+                query for query in captured
+                if 'COUNT(*)' in query['sql'] and 'booking_basebookingservice' in query['sql']])
+            self.assertEqual(changelist.result_count, 7)
+        self.assertEqual(pks, expected)
+
+        # first page counts again
+        self.create_bookingextra(
+            date.today(), date.today(), constants.SERVICE_STATUS_PENDING, 10, 12)
+        self.assertEqual(self.build_services_changelist(session).result_count, 8)
+
+    def test_bookings_changelist_pax_name_filter(self):
+        """
+        Does bookings list filtered by pax names without repeated rows nor distinct
+        """
+        # bookings list shows bookings from last month by default
+        Booking.objects.filter(pk=self.test_booking.pk).update(date_from=date.today())
+        for pax_name in ['John Smith', 'Jane Smith', 'Other']:
+            BookingPax.objects.create(booking=self.test_booking, pax_name=pax_name, pax_group=1)
+        request = RequestFactory().get('/', {'srch_rooming_list__pax_name': 'Smith'})
+        request.user = User.objects.create(username='admin', is_superuser=True)
+        site_model = bookings_site._registry[Booking]
+
+        changelist = BookingStatusChangeList(
+            request, Booking, site_model.list_display, site_model.list_display_links,
+            (), site_model.top_filters, None, (), False, 50, 200, (), site_model, None)
+
+        self.assertEqual(list(changelist.result_list), [self.test_booking])
+        self.assertFalse(changelist.queryset.query.distinct)
+
+    def test_services_changelist_export(self):
+        """
+        Does services list csv export streaming filtered rows in list order
+        """
+        for day in [3, 1, 2]:
+            service_date = date.today() + timedelta(days=day)
+            self.create_bookingextra(
+                service_date, service_date, constants.SERVICE_STATUS_PENDING, 10, 12)
+        site_model = bookings_site._registry[BaseBookingService]
+        request = RequestFactory().get('/')
+        request.user = User.objects.create(username='admin', is_superuser=True)
+
+        response = site_model.export_view(request)
+        # services are loaded with annotated columns in one query
+        with self.assertNumQueries(1):
+            rows = list(csv.reader(
+                line.decode('utf-8') for line in response.streaming_content))
+
+        self.assertEqual(rows[0], [
+            force_text(label_for_field(field_name, BaseBookingService, site_model))
+            for field_name in site_model.list_display])
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(
+            [row[1] for row in rows[1:]],
+            sorted((date.today() + timedelta(days=day)).isoformat() for day in [3, 1, 2]))
+
+
+class BenchmarkTestCase(TestCase):
+
+    def test_benchmark_small_dataset(self):
+        """
+        Does benchmark cases run on a small generated dataset leaving it unchanged
+        """
+        counts = BenchmarkData.generate(
+            agencies=4, providers=2, allotments=3, extras=2, seasons=2,
+            agency_services=2, bookings=20, invoiced_percent=50)
+        self.assertEqual(counts['bookings'], 20)
+        self.assertEqual(Booking.objects.count(), 20)
+        with self.assertRaises(ValueError):
+            BenchmarkData.generate(agencies=1, providers=1, bookings=0)
+
+        results = BenchmarkSuite.run(repeat=1, sample=2)
+
+        self.assertEqual(sorted(results['results']), sorted(BenchmarkSuite.CASES))
+        for case, result in results['results'].items():
+            self.assertGreater(result['queries'], 0, case)
+        self.assertEqual(Booking.objects.count(), 20)
+        self.assertEqual(
+            [row[0] for row in BenchmarkSuite.compare(results, results)],
+            list(results['results']))
+
+        # test database runs in one transaction, so on one thread
+        result = BenchmarkSuite.run_concurrent_payments(threads=1, payments=2, repeat=1)
+        self.assertEqual(result['items'], 2)
+        self.assertFalse(AgencyPayment.objects.filter(amount=10).exists())
@@ -22,7 +22,6 @@ class CancelledTopFilter(filters.BooleanFilter):
         if search_option == "False":
             queryset = queryset.exclude(status__exact=BOOKING_STATUS_CANCELLED)
 
-        queryset = queryset.distinct()
         return queryset
 
 
@@ -67,7 +66,6 @@ class PaidTopFilter(filters.SingleChoicesFilter):
                 queryset = queryset.filter(
                     ~Q(cost_amount_to_pay=F('cost_amount_paid')))
 
-        queryset = queryset.distinct()
         return queryset
 
 
@@ -86,5 +84,4 @@ class BookingPaidTopFilter(filters.BooleanFilter):
             queryset = queryset.exclude(
                 invoice__isnull=False, invoice__amount=F('invoice__matched_amount'))
 
-        queryset = queryset.distinct()
         return queryset
@@ -11,3 +11,4 @@ class CommonConfig(AppConfig):
         checks.register(check_dependencies, checks.Tags.admin)
         checks.register(check_admin_app, checks.Tags.admin)
         self.module.autodiscover()
+        from common import signals
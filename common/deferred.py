@@ -0,0 +1,122 @@
+"""
+common deferred
+
+Coalesced recalculations run once at transaction commit
+"""
+import logging
+import threading
+
+from django.db import connection, transaction
+
+from reservas.utils import retry_on_deadlock
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class DeferredUpdates(object):
+    """
+    DeferredUpdates
+
+    Collects recalculations requested while a transaction is open in a dirty set
+    keyed by (name, model, pk). Each one runs once when the transaction commits,
+    on the object loaded again from database, ordered by priority so that services
+    are recalculated before their packages and bookings.
+    Out of transactions recalculations run immediately.
+    Every request registers a numbered hook on commit. Hooks of rolled back
+    blocks are discarded, so the first one run at commit drops requests made
+    only before it and flushes the others, those of a block rolled back after
+    the last committed request run too on committed data.
+    Recalculations run after commit in their own transaction, rerun when it
+    is a deadlock victim, and failures are logged without reaching the caller.
+    """
+
+    @classmethod
+    def _pending(cls):
+        pending = getattr(_local, 'pending', None)
+        if pending is None:
+            pending = dict()
+            _local.pending = pending
+            _local.sequence = 0
+            _local.flushing = False
+        return pending
+
+    @classmethod
+    def schedule(cls, name, priority, model, pk, func):
+        """
+        requests func(obj) for the model object with pk
+        """
+        if pk is None:
+            return
+        if not connection.in_atomic_block:
+            obj = model.objects.filter(pk=pk).first()
+            if obj is not None:
+                func(obj)
+            return
+        pending = cls._pending()
+        _local.sequence += 1
+        marker = _local.sequence
+        if not _local.flushing:
+            transaction.on_commit(lambda: cls._committed(marker))
+        request = pending.get((name, model, pk))
+        if request is not None:
+            # already requested, keep original order
+            request[5] = marker
+            return
+        pending[(name, model, pk)] = [priority, marker, model, pk, func, marker]
+
+    @classmethod
+    def _committed(cls, marker):
+        """
+        drops requests of rolled back blocks and runs the others
+        """
+        pending = cls._pending()
+        if _local.flushing:
+            return
+        for key in [key for key, request in pending.items() if request[5] < marker]:
+            del pending[key]
+        try:
+            cls.flush()
+        except Exception:
+            logger.exception('deferred updates not run')
+
+    @classmethod
+    def pending_count(cls):
+        return len(cls._pending())
+
+    @classmethod
+    def clear(cls):
+        cls._pending().clear()
+
+    @classmethod
+    def flush(cls):
+        """
+        runs pending recalculations, including those requested while running them
+        """
+        pending = cls._pending()
+        if _local.flushing or not pending:
+            return
+        requests = dict(pending)
+        _local.flushing = True
+        try:
+            cls._run(requests)
+        finally:
+            pending.clear()
+            _local.flushing = False
+
+    @classmethod
+    @retry_on_deadlock
+    def _run(cls, requests):
+        pending = cls._pending()
+        # requests made by a rolled back attempt are made again
+        pending.clear()
+        pending.update(requests)
+        with transaction.atomic(savepoint=False):
+            while pending:
+                key = min(pending, key=lambda item: pending[item][:2])
+                priority, sequence, model, pk, func, marker = pending.pop(key)
+                obj = model.objects.filter(pk=pk).first()
+                if obj is not None:
+                    func(obj)
@@ -4,11 +4,13 @@ from datetime import datetime
 
 from django import forms
 from django.contrib.admin.filters import FieldListFilter, DateFieldListFilter
-from django.contrib.admin.utils import (lookup_needs_distinct,
+from django.contrib.admin.utils import (
     get_model_from_relation, get_fields_from_path)
 from django.contrib.admin.widgets import AdminDateWidget
-from django.core.exceptions import ImproperlyConfigured
+from django.contrib.contenttypes.fields import GenericRelation
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
 from django.db import models
+from django.db.models.constants import LOOKUP_SEP
 from django.forms.widgets import Media, MEDIA_TYPES
 from django.utils.formats import get_format
 from django.utils.six import text_type
@@ -17,6 +19,68 @@ from django.utils.text import capfirst
 PARAM_PREFIX = 'srch_'
 
 
+def to_many_split(opts, lookup):
+    """
+    returns (relation, inner lookup) for lookups across a to-many relation,
+    relation being the path up to the first to-many field, or None
+    when lookup joins single valued relations only
+    """
+    names = lookup.split(LOOKUP_SEP)
+    for index, name in enumerate(names):
+        if name == 'pk':
+            name = opts.pk.name
+        try:
+            field = opts.get_field(name)
+        except FieldDoesNotExist:
+            # query lookups
+            return None
+        if not hasattr(field, 'get_path_info'):
+            return None
+        path_info = field.get_path_info()
+        if any(path.m2m for path in path_info):
+            if isinstance(field, GenericRelation):
+                return None
+            inner = names[index + 1:]
+            if not inner:
+                inner = ['pk']
+            elif inner[0] != 'pk':
+                try:
+                    path_info[-1].to_opts.get_field(inner[0])
+                except FieldDoesNotExist:
+                    # lookup on related pk
+                    inner = ['pk'] + inner
+            return LOOKUP_SEP.join(names[:index + 1]), LOOKUP_SEP.join(inner)
+        opts = path_info[-1].to_opts
+    return None
+
+
+def filter_related(queryset, relation, *args, **kwargs):
+    """
+    filters rows having objects through to-many relation matching args and kwargs.
+    The relation is checked in a semi join subquery instead of a join,
+    so rows are not repeated and distinct() is not needed
+    """
+    opts = queryset.model._meta
+    names = relation.split(LOOKUP_SEP)
+    for name in names[:-1]:
+        opts = opts.get_field(name).get_path_info()[-1].to_opts
+    field = opts.get_field(names[-1])
+    subquery = field.related_model._base_manager.filter(
+        *args, **kwargs).values(LOOKUP_SEP.join([field.remote_field.name, 'pk']))
+    return queryset.filter(**{LOOKUP_SEP.join(names[:-1] + ['pk', 'in']): subquery})
+
+
+def filter_lookup(queryset, lookup, value):
+    """
+    filters by lookup, across to-many relations with filter_related
+    """
+    split = to_many_split(queryset.model._meta, lookup)
+    if split is None:
+        return queryset.filter(**{lookup: value})
+    relation, inner = split
+    return filter_related(queryset, relation, **{inner: value})
+
+
 class TopFilter(object):
     _top_filters = []
     _take_priority_index = 0
@@ -25,6 +89,8 @@ class TopFilter(object):
     filter_title = None
     filter_field_path = None
     default_value = None
+    # set by filters joining to-many relations, so changelist applies distinct()
+    needs_distinct = False
 
     def __init__(
             self, field, request, params, hidden_params, model, model_admin, field_path):
@@ -128,13 +194,11 @@ class TextFilter(TopFilter):
         search_terms = self._values[0]
         if search_terms and search_terms != '':
             lookup = '%s__icontains' % self.field_path
-            if lookup_needs_distinct(self.model._meta, lookup):
-                queryset = queryset.distinct()
             for bit in search_terms.split():
                 if bit.startswith('!'):
                     queryset = queryset.exclude(**{lookup: bit[1:]})
                 else:
-                    queryset = queryset.filter(**{lookup: bit})
+                    queryset = filter_lookup(queryset, lookup, bit)
         return queryset
 
 
@@ -148,12 +212,10 @@ class BooleanFilter(TopFilter):
         search_option = self._values[0]
         if search_option and search_option != '':
             lookup = '%s__exact' % self.field_path
-            if lookup_needs_distinct(self.model._meta, lookup):
-                queryset = queryset.distinct()
             if search_option == "True":
-                queryset = queryset.filter(**{lookup: True})
+                queryset = filter_lookup(queryset, lookup, True)
             if search_option == "False":
-                queryset = queryset.filter(**{lookup: False})
+                queryset = filter_lookup(queryset, lookup, False)
         return queryset
 
 
@@ -214,9 +276,7 @@ class SingleChoicesFilter(TopFilter):
         search_option = self._values[0]
         if search_option and search_option != '':
             lookup = '%s__exact' % self.field_path
-            if lookup_needs_distinct(self.model._meta, lookup):
-                queryset = queryset.distinct()
-            queryset = queryset.filter(**{lookup: search_option})
+            queryset = filter_lookup(queryset, lookup, search_option)
         return queryset
 
 
@@ -273,9 +333,7 @@ class ChoicesFilter(TopFilter):
         search_option = self._values[0]
         if search_option and search_option != []:
             lookup = '%s__in' % self.field_path
-            if lookup_needs_distinct(self.model._meta, lookup):
-                queryset = queryset.distinct()
-            queryset = queryset.filter(**{lookup: search_option})
+            queryset = filter_lookup(queryset, lookup, search_option)
         return queryset
 
 
@@ -345,9 +403,7 @@ class ForeignKeyFilter(TopFilter):
         search_option = self._values[0]
         if search_option and search_option != []:
             lookup = '%s%s__in' % (self.field_path, '_id')
-            if lookup_needs_distinct(self.model._meta, lookup):
-                queryset = queryset.distinct()
-            queryset = queryset.filter(**{lookup: search_option})
+            queryset = filter_lookup(queryset, lookup, search_option)
         return queryset
 
 
@@ -422,9 +478,7 @@ class DateFilter(TopFilter):
                 from_option = parse_date(from_option)
             if from_option:
                 lookup = '%s__gte' % self.field_path
-                if lookup_needs_distinct(self.model._meta, lookup):
-                    queryset = queryset.distinct()
-                queryset = queryset.filter(**{lookup: from_option})
+                queryset = filter_lookup(queryset, lookup, from_option)
 
         to_option = self._values[1]
         if to_option:
@@ -432,9 +486,7 @@ class DateFilter(TopFilter):
                 to_option = parse_date(to_option)
             if to_option:
                 lookup = '%s__lte' % self.field_path
-                if lookup_needs_distinct(self.model._meta, lookup):
-                    queryset = queryset.distinct()
-                queryset = queryset.filter(**{lookup: to_option})
+                queryset = filter_lookup(queryset, lookup, to_option)
 
         return queryset
 
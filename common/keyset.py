@@ -0,0 +1,101 @@
+"""
+common keyset
+
+Keyset (seek) pagination helpers for changelists ordered by field lookups
+"""
+import base64
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.db.models import F, Q
+
+
+KEYSET_VAR = 'after'
+
+KEYSET_ALIAS = 'keyset_%s'
+
+
+def keyset_fields(ordering):
+    """
+    returns (field, descending) pairs for an ordering made of field lookups
+    or None when some ordering item is not a field lookup
+    """
+    fields = []
+    for item in ordering:
+        if not isinstance(item, str) or item == '?':
+            return None
+        if item.startswith('-'):
+            fields.append((item[1:], True))
+        else:
+            fields.append((item.lstrip('+'), False))
+    return fields
+
+
+def annotate_keyset(queryset, fields):
+    """
+    annotates ordering values so the cursor comes from the page rows
+    """
+    return queryset.annotate(**dict(
+        (KEYSET_ALIAS % index, F(field)) for index, (field, descending) in enumerate(fields)))
+
+
+def encode_keyset(obj, fields):
+    values = [getattr(obj, KEYSET_ALIAS % index) for index in range(len(fields))]
+    data = json.dumps(values, cls=DjangoJSONEncoder)
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_keyset(value, fields):
+    """
+    returns the ordering values of a cursor or None when it is not valid
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(value.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError, UnicodeError):
+        return None
+    if not isinstance(values, list) or len(values) != len(fields):
+        return None
+    return values
+
+
+def _after(field, value, descending):
+    # rows coming after value in field order, nulls sorted as database does
+    nulls_largest = connection.features.nulls_order_largest
+    larger = not descending
+    if value is None:
+        if larger == nulls_largest:
+            return None
+        return Q(**{'%s__isnull' % field: False})
+    if larger:
+        condition = Q(**{'%s__gt' % field: value})
+    else:
+        condition = Q(**{'%s__lt' % field: value})
+    if larger == nulls_largest:
+        condition |= Q(**{'%s__isnull' % field: True})
+    return condition
+
+
+def _equals(field, value):
+    if value is None:
+        return Q(**{'%s__isnull' % field: True})
+    return Q(**{field: value})
+
+
+def keyset_filter(fields, values):
+    """
+    returns the condition for rows after the cursor values.
+    Ordering must end in a unique field
+    """
+    condition = None
+    previous = Q()
+    for (field, descending), value in zip(fields, values):
+        after = _after(field, value, descending)
+        if after is not None:
+            after = previous & after
+            condition = after if condition is None else condition | after
+        previous &= _equals(field, value)
+    if condition is None:
+        # nothing after the last row
+        return Q(pk__in=[])
+    return condition
@@ -4,9 +4,12 @@ from django.contrib.auth import load_backend
 from django.contrib.auth.backends import RemoteUserBackend
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.deprecation import MiddlewareMixin
+from django.db import connection
 from django.utils.functional import SimpleLazyObject
 
-import logging, threading;
+import logging, threading, time;
+
+from common.querystats import QueryStats, RequestQueries
 
 logger = logging.getLogger(__name__)
 
@@ -37,3 +40,35 @@ class SetOrganizationMiddleware(MiddlewareMixin):
         if request.user.is_authenticated and hasattr(request.user, 'vinculation'):
             organization = request.user.vinculation.organization
         set_current_organization(organization)
+
+
+class RecentLinkMiddleware(MiddlewareMixin):
+    """
+    buffers recent links recorded by views and writes them once the
+    response is built
+    """
+    def process_request(self, request):
+        from common.recents import RecentLinkRecorder
+        RecentLinkRecorder.start()
+
+    def process_response(self, request, response):
+        from common.recents import RecentLinkRecorder
+        RecentLinkRecorder.flush()
+        return response
+
+
+class QueryStatsMiddleware(object):
+    """
+    opt-in, records wall time and sql queries of requests by view and site model.
+    Statistics are shown in site query stats page and logged by request
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = RequestQueries()
+        start = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            response = self.get_response(request)
+        QueryStats.record(request, response, time.perf_counter() - start, queries)
+        return response
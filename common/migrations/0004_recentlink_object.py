@@ -0,0 +1,47 @@
+# Generated by Django 2.2.28 on 2026-10-18 20:14
+
+import re
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+LINK_URL_RE = re.compile(r'/(\w+)/(\w+)/([^/?]+)/change/')
+
+
+def fill_link_objects(apps, schema_editor):
+    RecentLink = apps.get_model('common', 'RecentLink')
+    links = []
+    for link in RecentLink.objects.all():
+        match = LINK_URL_RE.search(link.link_url)
+        if match:
+            link.link_model = '%s.%s' % (match.group(1), match.group(2))
+            link.link_object_id = match.group(3)
+            links.append(link)
+    RecentLink.objects.bulk_update(links, ['link_model', 'link_object_id'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('common', '0003_custom_data_migration_20231008'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recentlink',
+            name='link_model',
+            field=models.CharField(default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='recentlink',
+            name='link_object_id',
+            field=models.CharField(default='', max_length=50),
+        ),
+        migrations.AlterIndexTogether(
+            name='recentlink',
+            index_together={('user', 'link_time'), ('user', 'link_model', 'link_object_id')},
+        ),
+        migrations.RunPython(fill_link_objects, migrations.RunPython.noop),
+    ]
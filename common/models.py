@@ -114,7 +114,7 @@ class RecentLink(models.Model):
         verbose_name = 'Recent Entry'
         verbose_name_plural = 'Recents Entries'
         unique_together = (('user', 'link_url'),)
-        index_together = (('user', 'link_time'),)
+        index_together = (('user', 'link_time'), ('user', 'link_model', 'link_object_id'))
         ordering = ['user', '-link_time']
 
     user = models.ForeignKey(
@@ -128,6 +128,9 @@ class RecentLink(models.Model):
     link_label = models.CharField(max_length=250)
     link_url = models.CharField(max_length=250)
     link_icon = models.CharField(max_length=50)
+    # app_label.model_name and pk of linked object
+    link_model = models.CharField(max_length=100, default='')
+    link_object_id = models.CharField(max_length=50, default='')
 
     def __str__(self):
         return self.link_label
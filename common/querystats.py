@@ -0,0 +1,145 @@
+"""
+common querystats
+
+Wall time and SQL statistics of requests by view and site model
+"""
+import json
+import logging
+import re
+import threading
+import time
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+_PARAMS_LIST_RE = re.compile(r'\((?:\s*%s\s*,)+\s*%s\s*\)')
+
+
+def sql_fingerprint(sql):
+    """
+    returns the sql shape, parameters lists of any length collapsed
+    """
+    return _PARAMS_LIST_RE.sub('(%s)', sql)
+
+
+class RequestQueries(object):
+    """
+    RequestQueries
+
+    Database execute wrapper counting and timing the queries of one request
+    by sql shape
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.shapes = dict()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.time += time.perf_counter() - start
+            self.count += 1
+            shape = sql_fingerprint(sql)
+            self.shapes[shape] = self.shapes.get(shape, 0) + 1
+
+    def duplicated(self):
+        """
+        returns queries repeating a previous shape
+        """
+        return sum(count - 1 for count in self.shapes.values())
+
+    def repeated(self, limit):
+        """
+        returns shapes run more than limit times, likely N+1 queries
+        """
+        return dict(
+            (shape, count) for shape, count in self.shapes.items() if count > limit)
+
+
+class QueryStats(object):
+    """
+    QueryStats
+
+    Aggregates requests statistics by view and site model in this process,
+    each request is also logged as one json line for aggregation across processes
+    """
+    _lock = threading.Lock()
+    _views = dict()
+
+    @classmethod
+    def repeated_limit(cls):
+        return getattr(settings, 'QUERY_STATS_REPEATED_LIMIT', 10)
+
+    @classmethod
+    def record(cls, request, response, wall_time, queries):
+        resolver_match = getattr(request, 'resolver_match', None)
+        if resolver_match is None:
+            return
+        model_admin = getattr(resolver_match.func, 'model_admin', None)
+        model = ''
+        if model_admin is not None:
+            model = model_admin.model._meta.label
+        repeated = queries.repeated(cls.repeated_limit())
+        data = dict(
+            view=resolver_match.view_name,
+            model=model,
+            method=request.method,
+            status=response.status_code,
+            wall_ms=round(wall_time * 1000, 1),
+            queries=queries.count,
+            sql_ms=round(queries.time * 1000, 1),
+            duplicated=queries.duplicated(),
+            repeated=sorted(
+                ([count, shape[:200]] for shape, count in repeated.items()), reverse=True),
+        )
+        if repeated:
+            logger.warning('query stats %s', json.dumps(data, sort_keys=True))
+        else:
+            logger.info('query stats %s', json.dumps(data, sort_keys=True))
+
+        key = (data['view'], model)
+        with cls._lock:
+            stats = cls._views.get(key)
+            if stats is None:
+                stats = dict(
+                    view=data['view'], model=model, requests=0,
+                    wall_time=0.0, wall_max=0.0, queries=0, queries_max=0,
+                    sql_time=0.0, duplicated=0, repeated=dict())
+                cls._views[key] = stats
+            stats['requests'] += 1
+            stats['wall_time'] += wall_time
+            stats['wall_max'] = max(stats['wall_max'], wall_time)
+            stats['queries'] += queries.count
+            stats['queries_max'] = max(stats['queries_max'], queries.count)
+            stats['sql_time'] += queries.time
+            stats['duplicated'] += queries.duplicated()
+            for shape, count in repeated.items():
+                stats['repeated'][shape] = max(stats['repeated'].get(shape, 0), count)
+
+    @classmethod
+    def report(cls):
+        """
+        returns views statistics, slowest total time first
+        """
+        with cls._lock:
+            views = [dict(stats, repeated=dict(stats['repeated'])) for stats in cls._views.values()]
+        for stats in views:
+            requests = stats['requests']
+            stats['wall_total_ms'] = round(stats['wall_time'] * 1000, 1)
+            stats['wall_avg_ms'] = round(stats['wall_time'] * 1000 / requests, 1)
+            stats['wall_max_ms'] = round(stats['wall_max'] * 1000, 1)
+            stats['queries_avg'] = round(stats['queries'] / requests, 1)
+            stats['sql_avg_ms'] = round(stats['sql_time'] * 1000 / requests, 1)
+            stats['repeated'] = sorted(
+                stats['repeated'].items(), key=lambda item: item[1], reverse=True)
+        return sorted(views, key=lambda stats: stats['wall_time'], reverse=True)
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._views.clear()
@@ -0,0 +1,144 @@
+"""
+common recents
+
+Buffered recent links tracking written once at request end
+"""
+import logging
+import threading
+
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from common.models import RecentLink
+
+from reservas.utils import get_shared_cache
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def invalidate_recents(user_id):
+    """
+    drops cached recent links of user when current transaction commits
+    """
+    def invalidate():
+        cache = get_shared_cache('MENU_CACHE_BACKEND')
+        if cache is not None:
+            cache.delete('common_recents:%s' % user_id)
+    transaction.on_commit(invalidate)
+
+
+class RecentLinkRecorder(object):
+    """
+    RecentLinkRecorder
+
+    Collects recent links visited while a request is running keyed by
+    (user, model, object_id), so repeated visits of one object are written once.
+    Links are upserted in batch when the request ends, out of the
+    transactions of the request views.
+    Out of requests links are written immediately.
+    """
+
+    @classmethod
+    def _pending(cls):
+        pending = getattr(_local, 'pending', None)
+        if pending is None:
+            pending = dict()
+            _local.pending = pending
+            _local.buffering = False
+        return pending
+
+    @classmethod
+    def start(cls):
+        cls._pending().clear()
+        _local.buffering = True
+
+    @classmethod
+    def record(cls, user_id, link_model, link_object_id, label, url, icon):
+        pending = cls._pending()
+        pending[(user_id, link_model, str(link_object_id))] = dict(
+            link_time=timezone.now(),
+            link_label=label,
+            link_url=url,
+            link_icon=icon)
+        if not _local.buffering:
+            cls.flush()
+
+    @classmethod
+    def discard(cls, user_id, link_model, link_object_id):
+        """
+        removes pending and stored links to object
+        """
+        link_object_id = str(link_object_id)
+        cls._pending().pop((user_id, link_model, link_object_id), None)
+        RecentLink.objects.filter(
+            user_id=user_id, link_model=link_model, link_object_id=link_object_id).delete()
+        invalidate_recents(user_id)
+
+    @classmethod
+    def pending_count(cls):
+        return len(cls._pending())
+
+    @classmethod
+    def flush(cls):
+        """
+        writes pending links and ends buffering
+        """
+        pending = cls._pending()
+        _local.buffering = False
+        if not pending:
+            return
+        links = dict(pending)
+        pending.clear()
+        try:
+            with transaction.atomic():
+                cls._write(links)
+        except IntegrityError:
+            # link url taken by a concurrent write, fall back to one by one
+            for key, values in links.items():
+                cls._write_one(key, values)
+        except Exception:
+            logger.exception('recent links not saved')
+        for user_id in set(key[0] for key in links):
+            invalidate_recents(user_id)
+
+    @classmethod
+    def _write(cls, links):
+        condition = Q()
+        for user_id, link_model, link_object_id in links:
+            condition |= Q(
+                user_id=user_id, link_model=link_model, link_object_id=link_object_id)
+        existing = dict(
+            ((link.user_id, link.link_model, link.link_object_id), link)
+            for link in RecentLink.objects.filter(condition))
+        updated = []
+        created = []
+        for key, values in links.items():
+            link = existing.get(key)
+            if link is None:
+                link = RecentLink(
+                    user_id=key[0], link_model=key[1], link_object_id=key[2])
+                created.append(link)
+            else:
+                updated.append(link)
+            for field, value in values.items():
+                setattr(link, field, value)
+        if updated:
+            RecentLink.objects.bulk_update(
+                updated, ['link_time', 'link_label', 'link_url', 'link_icon'])
+        if created:
+            RecentLink.objects.bulk_create(created)
+
+    @classmethod
+    def _write_one(cls, key, values):
+        user_id, link_model, link_object_id = key
+        try:
+            RecentLink.objects.update_or_create(
+                user_id=user_id,
+                link_url=values['link_url'],
+                defaults=dict(values, link_model=link_model, link_object_id=link_object_id))
+        except Exception:
+            logger.exception('recent link not saved')
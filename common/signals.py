@@ -0,0 +1,31 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from common.sites import invalidate_menus
+
+
+User = get_user_model()
+
+
+# Permissions
+
+@receiver((post_save, post_delete), sender=Permission)
+@receiver((post_save, post_delete), sender=Group)
+@receiver(m2m_changed, sender=Group.permissions.through)
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def post_change_permissions(sender, action=None, **kwargs):
+    # m2m changes are sent before and after
+    if action and not action.startswith('post_'):
+        return
+    invalidate_menus()
+
+
+@receiver((post_save, post_delete), sender=User)
+def post_change_user(sender, instance, update_fields=None, **kwargs):
+    # logins only update last_login
+    if update_fields and set(update_fields) == {'last_login'}:
+        return
+    invalidate_menus()
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 import copy
+import csv
 import datetime
+import hashlib
 import json
 import logging
 import string
@@ -12,6 +14,7 @@ from totalsum.admin import TotalsumAdmin
 
 from concurrency.exceptions import RecordModifiedError
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.admin import helpers
 from django.contrib.admin.exceptions import DisallowedModelAdminLookup, DisallowedModelAdminToField
@@ -34,26 +37,65 @@ from django.db import router, transaction, models
 from django.db.utils import IntegrityError
 from django.forms import fields_for_model
 from django.forms.formsets import all_valid, DELETION_FIELD_NAME
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, StreamingHttpResponse
 from django.http.response import HttpResponseBase
 from django.urls import reverse
 from django.template.response import TemplateResponse, SimpleTemplateResponse
-from django.utils.html import format_html
+from django.utils.html import format_html, strip_tags
 from django.utils.http import urlencode, urlquote
 from django.utils.encoding import force_text
-from django.utils import six, timezone
-from django.utils.safestring import mark_safe
+from django.utils import six
+from django.utils.safestring import mark_safe, SafeData
 from django.utils.translation import ugettext as _, ungettext, ugettext_lazy
 from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import csrf_protect
 from django.views.generic import RedirectView, View
 
 from common.filters import PARAM_PREFIX, TopFilter
+from common.keyset import (
+    KEYSET_VAR, keyset_fields, annotate_keyset, encode_keyset, decode_keyset, keyset_filter)
 from common.models import RecentLink
+from common.querystats import QueryStats
+from common.recents import RecentLinkRecorder
 from common.templatetags.common_utils import common_add_preserved_filters, result_hidden_fields
 
+from reservas.utils import get_shared_cache, retry_on_deadlock
+
 logger = logging.getLogger(__name__)
 
+MENU_VERSION_KEY = 'common_menu_version'
+
+# seconds, bounds staleness of changes not seen by signals
+MENU_CACHE_TIMEOUT = 60
+
+RECENT_LINKS_LIMIT = 20
+
+
+def menu_cache():
+    """
+    returns the cache shared by processes for menus and recent links,
+    they are not cached when MENU_CACHE_BACKEND does not name one
+    """
+    return get_shared_cache('MENU_CACHE_BACKEND')
+
+
+def invalidate_menus():
+    """
+    makes cached menus stale for every user when current transaction commits,
+    called when permissions or registered models change
+    """
+    transaction.on_commit(_invalidate_menus)
+
+
+def _invalidate_menus():
+    cache = menu_cache()
+    if cache is None:
+        return
+    try:
+        cache.incr(MENU_VERSION_KEY)
+    except ValueError:
+        cache.set(MENU_VERSION_KEY, 1, None)
+
 class CommonSite(AdminSite):
 
     site_namespace = 'common'
@@ -65,6 +107,14 @@ class CommonSite(AdminSite):
     password_change_template = 'registration/password_change.html'
     password_change_done_template = 'registration/password_change_done.html'
 
+    def register(self, model_or_iterable, admin_class=None, **options):
+        super(CommonSite, self).register(model_or_iterable, admin_class, **options)
+        invalidate_menus()
+
+    def unregister(self, model_or_iterable):
+        super(CommonSite, self).unregister(model_or_iterable)
+        invalidate_menus()
+
     def get_urls(self):
         from django.conf.urls import url, include
         # Since this module gets imported in the application's root package,
@@ -92,6 +142,7 @@ class CommonSite(AdminSite):
                 wrap(self.password_change_done, cacheable=True),
                 name='password_change_done'),
             url(r'^jsi18n/$', wrap(self.i18n_javascript, cacheable=True), name='jsi18n'),
+            url(r'^query_stats/$', wrap(self.query_stats), name='query_stats'),
         ]
 
         # Add in each model's views, and create a list of valid URLS for the
@@ -224,7 +275,25 @@ class CommonSite(AdminSite):
         """
         Returns a sorted list of menu options from registered models in this site
         available to current user.
-        """
+        With a shared MENU_CACHE_BACKEND menus are cached by user until
+        permissions or registered models change.
+        """
+        user_id = getattr(request.user, 'pk', None)
+        cache = menu_cache()
+        if user_id is None or cache is None:
+            return self._build_app_list(request)
+        version = cache.get(MENU_VERSION_KEY)
+        if version is None:
+            version = 1
+            cache.add(MENU_VERSION_KEY, version, None)
+        key = 'common_menu:%s:%s:%s' % (self.name, version, user_id)
+        menu_list = cache.get(key)
+        if menu_list is None:
+            menu_list = self._build_app_list(request)
+            cache.set(key, menu_list, getattr(settings, 'MENU_CACHE_TIMEOUT', MENU_CACHE_TIMEOUT))
+        return menu_list
+
+    def _build_app_list(self, request):
         menu_dict = self._build_menu_dict(request)
 
         # Sort the menus by their order.
@@ -236,9 +305,18 @@ class CommonSite(AdminSite):
 
         return menu_list
 
-    def find_recents(self, request, limit=20):
+    def find_recents(self, request, limit=RECENT_LINKS_LIMIT):
         if request.user:
-            return RecentLink.objects.filter(user__pk=request.user.pk)[:int(limit)]
+            user_id = request.user.pk
+            cache = menu_cache()
+            if user_id is None or cache is None or int(limit) > RECENT_LINKS_LIMIT:
+                return RecentLink.objects.filter(user__pk=user_id)[:int(limit)]
+            key = 'common_recents:%s' % user_id
+            recents = cache.get(key)
+            if recents is None:
+                recents = list(RecentLink.objects.filter(user__pk=user_id)[:RECENT_LINKS_LIMIT])
+                cache.set(key, recents, getattr(settings, 'MENU_CACHE_TIMEOUT', MENU_CACHE_TIMEOUT))
+            return recents[:int(limit)]
         return None
 
     def get_site_extra_context(self, request):
@@ -264,6 +342,26 @@ class CommonSite(AdminSite):
         request.current_app = self.name
         return TemplateResponse(request, self.index_template, context)
 
+    def query_stats(self, request, extra_context=None):
+        """
+        Displays views statistics collected by QueryStatsMiddleware, staff only.
+        """
+        if not request.user.is_staff:
+            raise PermissionDenied
+        if request.method == 'POST':
+            QueryStats.clear()
+            return HttpResponseRedirect(request.path)
+        context = dict(
+            self.each_context(request),
+            title=_('Query Stats'),
+            views=QueryStats.report(),
+            repeated_limit=QueryStats.repeated_limit(),
+        )
+        context.update(self.get_site_extra_context(request))
+        context.update(extra_context or {})
+        request.current_app = self.name
+        return TemplateResponse(request, 'common/query_stats.html', context)
+
     def password_change(self, request, extra_context=None):
         """
         Handles the "change password" task -- both form display and validation.
@@ -342,6 +440,15 @@ class SiteModel(TotalsumAdmin):
 
     recent_allowed = False
     custom_actions_template = ''
+    # seek pages on ordering values instead of offsets, counting results on first page
+    keyset_pagination = False
+
+    # database expressions for totalsum_list properties, totalized with one aggregate
+    totalsum_expressions = {}
+
+    # stream filtered changelist rows as csv
+    export_allowed = False
+    export_chunk_size = 2000
 
     class Media:
         pass
@@ -521,6 +628,11 @@ class SiteModel(TotalsumAdmin):
 
         urlpatterns += [
             self.build_url(r'^add/$', self.add_view, '%s_%s_add' % info),
+        ]
+        if self.export_allowed:
+            urlpatterns += [
+                self.build_url(r'^export/$', self.export_view, '%s_%s_export' % info),]
+        urlpatterns += [
             self.build_url(r'^(.+)/history/$', self.history_view, '%s_%s_history' % info),
             self.build_url(r'^(.+)/delete/$', self.delete_view, '%s_%s_delete' % info),
             self.build_url(r'^(.+)/change/$', self.change_view, '%s_%s_change' % info),
@@ -565,6 +677,9 @@ class SiteModel(TotalsumAdmin):
     def changelist_url_format(self):
         return '%s:%%s_%%s_changelist' % self.admin_site.site_namespace
 
+    def export_url_format(self):
+        return '%s:%%s_%%s_export' % self.admin_site.site_namespace
+
     def get_model_actions(self, request):
         actions = []
         perms = self.get_model_perms(request)
@@ -622,15 +737,8 @@ class SiteModel(TotalsumAdmin):
                 #        self.model._meta.app_label, self.model._meta.model_name),
                 #    kwargs={'object_id': model_object.pk})
 
-                RecentLink.objects.update_or_create(
-                    user_id=request.user.pk,
-                    link_url=url,
-                    defaults={
-                        'user_id': request.user.pk,
-                        'link_time': timezone.now,
-                        'link_label': label,
-                        'link_url': url,
-                        'link_icon': icon,},)
+                RecentLinkRecorder.record(
+                    request.user.pk, opts.label_lower, model_object.pk, label, url, icon)
         except Exception as ex:
             print('EXCEPTION common sites - recent_link : ' + ex.__str__())
 
@@ -641,21 +749,9 @@ class SiteModel(TotalsumAdmin):
 
     def delete_recent(self, request, object_id):
         """
-        for removing registered recent links for user and url
-        """
-        qs = RecentLink.objects.filter(user=request.user)
-        qs.filter(link_url__iendswith='/%s/%s/%s' % (
-            self.model._meta.app_label,
-            self.model._meta.model_name,
-            object_id)).delete()
-        qs.filter(link_url__icontains='/%s/%s/%s/' % (
-            self.model._meta.app_label,
-            self.model._meta.model_name,
-            object_id)).delete()
-        qs.filter(link_url__icontains='/%s/%s/%s?' % (
-            self.model._meta.app_label,
-            self.model._meta.model_name,
-            object_id)).delete()
+        for removing registered recent links for user and object
+        """
+        RecentLinkRecorder.discard(request.user.pk, self.model._meta.label_lower, object_id)
 
     def changeform_context(
             self, request, form, obj, formsets, inline_instances,
@@ -1025,18 +1121,12 @@ class SiteModel(TotalsumAdmin):
         """
         Hook for custom saving actions.
         """
+        # inline objects get back their state when saving is retried
+        inline_objects = [
+            inline_form.instance for formset in formsets for inline_form in formset.forms]
         try:
-            with transaction.atomic(savepoint=False):
-                self.save_model(request, new_object, form, not add)
-                self.save_related(request, form, formsets, not add)
-                self.recent_link(request, model_object=new_object)
-                change_message = self.construct_change_message(request, form, formsets, add)
-                if add:
-                    self.log_addition(request, new_object, change_message)
-                    return self.response_add(request, new_object)
-                else:
-                    self.log_change(request, new_object, change_message)
-                    return self.response_change(request, new_object)
+            return self.changeform_save_atomic(
+                request, new_object, form, formsets, add, inline_objects)
         except ValidationError as ex:
             for message in ex.messages:
                 self.message_user(request, message, messages.ERROR)
@@ -1056,6 +1146,23 @@ class SiteModel(TotalsumAdmin):
             self.message_user(request, ex, messages.ERROR)
             return False
 
+    @retry_on_deadlock
+    def changeform_save_atomic(self, request, new_object, form, formsets, add, inline_objects):
+        """
+        Saves in one transaction, rerun when it is a deadlock victim
+        """
+        with transaction.atomic(savepoint=False):
+            self.save_model(request, new_object, form, not add)
+            self.save_related(request, form, formsets, not add)
+            self.recent_link(request, model_object=new_object)
+            change_message = self.construct_change_message(request, form, formsets, add)
+            if add:
+                self.log_addition(request, new_object, change_message)
+                return self.response_add(request, new_object)
+            else:
+                self.log_change(request, new_object, change_message)
+                return self.response_change(request, new_object)
+
     @csrf_protect_m
     def changeform_view(self, request, object_id=None, form_url='', extra_context=None):
         """
@@ -1446,25 +1553,11 @@ class SiteModel(TotalsumAdmin):
         request.current_app = self.admin_site.name
 
         # taken from totalsum package to add totals...
-        filtered_query_set = cl.queryset
         extra_context = extra_context or {}
-        extra_context['totals'] = {}
+        extra_context['totals'] = self.get_totals(cl.queryset)
         extra_context['unit_of_measure'] = self.unit_of_measure
-
-        for elem in self.totalsum_list:
-            try:
-                self.model._meta.get_field(elem)  # Checking if elem is a field
-                total = filtered_query_set.aggregate(totalsum_field=models.Sum(elem))['totalsum_field']
-                if total is not None:
-                    extra_context['totals'][label_for_field(elem, self.model, self)] = round(
-                        total, self.totalsum_decimal_places)
-            except FieldDoesNotExist:  # maybe it's a property
-                if hasattr(self.model, elem):
-                    total = 0
-                    for f in filtered_query_set:
-                        total += getattr(f, elem, 0)
-                    extra_context['totals'][label_for_field(elem, self.model, self)] = round(
-                        total, self.totalsum_decimal_places)
+        if self.export_allowed:
+            extra_context['export_url'] = self.get_export_url(request)
         context.update(extra_context)
 
         return TemplateResponse(request, self.change_list_template or [
@@ -1473,6 +1566,116 @@ class SiteModel(TotalsumAdmin):
             'common/change_list.html'
         ], context)
 
+    def get_totals(self, queryset):
+        """
+        returns totalsum_list totals by label. Fields and properties with
+        totalsum_expressions are totalized by database in one aggregate
+        """
+        aggregates = dict()
+        for elem in self.totalsum_list:
+            if elem in self.totalsum_expressions:
+                aggregates['totalsum_%s' % elem] = models.Sum(self.totalsum_expressions[elem])
+            else:
+                try:
+                    self.model._meta.get_field(elem)  # Checking if elem is a field
+                    aggregates['totalsum_%s' % elem] = models.Sum(elem)
+                except FieldDoesNotExist:
+                    pass
+        results = dict()
+        if aggregates:
+            results = queryset.aggregate(**aggregates)
+
+        totals = {}
+        for elem in self.totalsum_list:
+            key = 'totalsum_%s' % elem
+            if key in results:
+                total = results[key]
+                if total is None:
+                    if elem not in self.totalsum_expressions:
+                        continue
+                    total = 0
+            elif hasattr(self.model, elem):  # maybe it's a property
+                total = 0
+                for f in queryset:
+                    total += getattr(f, elem, 0)
+            else:
+                continue
+            totals[label_for_field(elem, self.model, self)] = round(
+                total, self.totalsum_decimal_places)
+        return totals
+
+    def get_export_queryset(self, request, queryset):
+        """
+        returns the exported queryset, annotate here the columns
+        coming from properties to avoid queries by row
+        """
+        return queryset
+
+    def get_export_url(self, request):
+        from django.contrib.admin.views.main import ERROR_FLAG, PAGE_VAR
+        params = request.GET.copy()
+        for param in [PAGE_VAR, ERROR_FLAG, KEYSET_VAR]:
+            params.pop(param, None)
+        url = reverse(self.export_url_format() % (
+            self.model._meta.app_label, self.model._meta.model_name))
+        if params:
+            return '%s?%s' % (url, params.urlencode())
+        return url
+
+    def export_value(self, field_name, obj):
+        try:
+            f, attr, value = lookup_field(field_name, obj, self)
+        except ObjectDoesNotExist:
+            return ''
+        if value is None:
+            return ''
+        if f is not None and not f.auto_created and f.flatchoices:
+            value = dict(f.flatchoices).get(value, value)
+        if isinstance(value, SafeData):
+            return strip_tags(value).strip()
+        return force_text(value)
+
+    def export_view(self, request):
+        """
+        streams changelist rows as csv with current filters and ordering
+        """
+        from django.contrib.admin.views.main import ERROR_FLAG
+        opts = self.model._meta
+        if not self.has_view_permission(request, None) and not self.has_change_permission(request, None):
+            raise PermissionDenied
+
+        list_display = [
+            field_name for field_name in self.get_list_display(request)
+            if field_name not in ['action_checkbox', 'details_button']]
+        ChangeListClass = self.get_changelist(request)
+        try:
+            cl = ChangeListClass(
+                request, self.model, list_display,
+                self.get_list_display_links(request, list_display),
+                self.get_list_filter(request), self.get_top_filters(request),
+                self.date_hierarchy, self.get_search_fields(request),
+                self.get_list_select_related(request), self.list_per_page,
+                self.list_max_show_all, (), self, self.get_sortable_by(request),
+                export=True)
+        except IncorrectLookupParameters:
+            return HttpResponseRedirect('%s?%s=1' % (
+                reverse(self.changelist_url_format() % (opts.app_label, opts.model_name)),
+                ERROR_FLAG))
+
+        queryset = self.get_export_queryset(request, cl.queryset)
+
+        def rows():
+            yield [force_text(label_for_field(field_name, self.model, self))
+                   for field_name in list_display]
+            for obj in queryset.iterator(chunk_size=self.export_chunk_size):
+                yield [self.export_value(field_name, obj) for field_name in list_display]
+
+        writer = csv.writer(_EchoBuffer())
+        response = StreamingHttpResponse(
+            (writer.writerow(row) for row in rows()), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="%s.csv"' % opts.model_name
+        return response
+
     def build_inlines(self, request, obj):
         formsets = self._build_formsets(request, obj)
         inlines = []
@@ -1590,21 +1793,95 @@ class SiteModel(TotalsumAdmin):
             return None
 
 
+class _EchoBuffer(object):
+    # csv writer target giving back each written row
+    def write(self, value):
+        return value
+
+
 class CommonChangeList(ChangeList):
     list_details_template = None
 
     def __init__(self, request, model, list_display, list_display_links,
                  list_filter, top_filters, date_hierarchy, search_fields, list_select_related,
-                 list_per_page, list_max_show_all, list_editable, model_admin, sortable_by):
+                 list_per_page, list_max_show_all, list_editable, model_admin, sortable_by,
+                 export=False):
         self.top_filters = top_filters
+        # export only needs the queryset, results are not paginated
+        self.export = export
         self.hidden_params = dict(request.GET.items())
         if SEARCH_VAR in self.hidden_params:
             self.hidden_params.pop(SEARCH_VAR)
+        # keyset cursor is not kept when searching, filtering or sorting
+        self.keyset_after = self.hidden_params.pop(KEYSET_VAR, None)
+        self.keyset = False
+        self.keyset_next = None
 
         super(CommonChangeList, self).__init__(
             request, model, list_display, list_display_links,
             list_filter, date_hierarchy, search_fields, list_select_related,
             list_per_page, list_max_show_all, list_editable, model_admin, sortable_by)
+        self.params.pop(KEYSET_VAR, None)
+
+    def get_results(self, request):
+        if self.export:
+            self.result_count = self.full_result_count = None
+            self.result_list = []
+            self.can_show_all = self.multi_page = False
+            return
+        fields = None
+        # editable lists need a queryset of results for their formset
+        if (getattr(self.model_admin, 'keyset_pagination', False)
+                and not self.show_all and not self.list_editable):
+            fields = keyset_fields(self.queryset.query.order_by)
+        if not fields:
+            return super(CommonChangeList, self).get_results(request)
+
+        queryset = annotate_keyset(self.queryset, fields)
+        if self.keyset_after:
+            values = decode_keyset(self.keyset_after, fields)
+            if values is None:
+                raise IncorrectLookupParameters
+            queryset = queryset.filter(keyset_filter(fields, values))
+        result_list = list(queryset[:self.list_per_page + 1])
+        if len(result_list) > self.list_per_page:
+            result_list = result_list[:self.list_per_page]
+            self.keyset_next = encode_keyset(result_list[-1], fields)
+
+        result_count = self.get_keyset_result_count(request)
+        self.keyset = True
+        self.result_count = result_count
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = result_list
+        self.can_show_all = result_count <= self.list_max_show_all
+        self.multi_page = result_count > self.list_per_page
+        self.paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+
+    def get_keyset_result_count(self, request):
+        """
+        returns results count counted on first page and kept in session
+        while moving through next pages of the same query
+        """
+        session = getattr(request, 'session', None)
+        if session is None:
+            return self.queryset.count()
+        key = 'changelist_count:%s' % self.opts.label_lower
+        query = hashlib.md5(force_text(self.queryset.query).encode('utf-8')).hexdigest()
+        stored = session.get(key)
+        if self.keyset_after and stored and stored[0] == query:
+            return stored[1]
+        result_count = self.queryset.count()
+        session[key] = [query, result_count]
+        return result_count
+
+    def get_keyset_url(self, after=None):
+        params = dict(self.params)
+        params.pop(KEYSET_VAR, None)
+        if after:
+            params[KEYSET_VAR] = after
+        return '?%s' % urlencode(sorted(params.items()))
 
     def row_classes_for_result(self, result):
         return ''
@@ -1628,6 +1905,7 @@ class CommonChangeList(ChangeList):
         for ignored in IGNORED_PARAMS:
             if ignored in lookup_params:
                 del lookup_params[ignored]
+        lookup_params.pop(KEYSET_VAR, None)
         result = lookup_params.copy()
         for param in lookup_params:
             if param.startswith(PARAM_PREFIX):
@@ -1680,17 +1958,14 @@ class CommonChangeList(ChangeList):
                         if not isinstance(field, models.Field):
                             field_path = field
                             field = get_fields_from_path(self.model, field_path)[-1]
-                    lookup_params_count = len(lookup_params)
                     spec = top_filter_class(
                         field, request, lookup_params, hidden_params,
                         self.model, self.model_admin, field_path=field_path
                     )
-                    # field_list_filter_class removes any lookup_params it
-                    # processes. If that happened, check if distinct() is
-                    # needed to remove duplicate results.
-                    if lookup_params_count > len(lookup_params):
-                        use_distinct = use_distinct or lookup_needs_distinct(self.lookup_opts, field_path)
                 if spec:
+                    # top filters check to-many relations with subqueries,
+                    # only those joining them need distinct()
+                    use_distinct = use_distinct or spec.needs_distinct
                     filter_specs.append(spec)
 
         # At this point, all the parameters used by the various ListFilters
@@ -1725,7 +2000,8 @@ class CommonChangeList(ChangeList):
 
         # Second, we collect all the declared top filters.
         (self.top_filter_specs, self.has_top_filters, remaining_lookup_params,
-         filters_use_distinct) = self.get_top_filters(request, remaining_lookup_params)
+         top_filters_use_distinct) = self.get_top_filters(request, remaining_lookup_params)
+        filters_use_distinct = filters_use_distinct or top_filters_use_distinct
 
         # Then, we let every top filter modify the queryset to its liking.
         for filter_spec in self.top_filter_specs:
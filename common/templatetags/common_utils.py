@@ -43,6 +43,18 @@ def common_pagination(cl):
     """
     paginator, page_num = cl.paginator, cl.page_num
 
+    if getattr(cl, 'keyset', False):
+        # keyset pages only link first and next pages
+        return {
+            'cl': cl,
+            'keyset': True,
+            'pagination_required': cl.multi_page,
+            'keyset_first_url': cl.keyset_after and cl.get_keyset_url(),
+            'keyset_next_url': cl.keyset_next and cl.get_keyset_url(cl.keyset_next),
+            'show_all_url': cl.can_show_all and cl.multi_page and cl.get_query_string({ALL_VAR: ''}),
+            'page_range': [],
+        }
+
     pagination_required = (not cl.show_all or not cl.can_show_all) and cl.multi_page
     if not pagination_required:
         page_range = []
@@ -0,0 +1,256 @@
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.contrib.auth.models import Permission, User
+from django.core.cache import cache, caches
+from django.db import OperationalError, connection, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from booking.models import Booking
+from common.deferred import DeferredUpdates
+from common.models import RecentLink
+from common.sites import MENU_VERSION_KEY
+from common.querystats import QueryStats, RequestQueries, sql_fingerprint
+from common.recents import RecentLinkRecorder
+from finance.models import Agency
+from reservas.admin import bookings_site
+
+
+class CommonSiteTestCase(TransactionTestCase):
+
+    def setUp(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        caches_setting = dict(settings.CACHES)
+        caches_setting['menus'] = dict(
+            BACKEND='django.core.cache.backends.filebased.FileBasedCache', LOCATION=location)
+        shared_cache = override_settings(CACHES=caches_setting, MENU_CACHE_BACKEND='menus')
+        shared_cache.enable()
+        self.addCleanup(shared_cache.disable)
+        self.test_user = User.objects.create(username='Test User', is_staff=True)
+
+    def build_request(self):
+        request = RequestFactory().get('/')
+        # new user object as on each request
+        request.user = User.objects.get(pk=self.test_user.pk)
+        return request
+
+    def menu_models(self, request):
+        return [model['name']
+                for menu in bookings_site.get_app_list(request) for model in menu['model_list']]
+
+    def test_menu_cached_until_permissions_change(self):
+        """
+        Does user menu taken from cache until user permissions change
+        """
+        self.assertNotIn('booking', self.menu_models(self.build_request()))
+
+        request = self.build_request()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.menu_models(request), [])
+
+        self.test_user.user_permissions.add(
+            Permission.objects.get(codename='change_booking'))
+        self.assertIn(Booking._meta.model_name, self.menu_models(self.build_request()))
+
+    def test_menu_invalidated_on_commit(self):
+        """
+        Does permissions change invalidate cached menus on commit only
+        """
+        self.menu_models(self.build_request())
+        permission = Permission.objects.get(codename='change_booking')
+
+        with transaction.atomic():
+            self.test_user.user_permissions.add(permission)
+            # concurrent requests cache menus without uncommitted permissions
+            self.assertEqual(caches['menus'].get(MENU_VERSION_KEY), 1)
+        self.assertEqual(caches['menus'].get(MENU_VERSION_KEY), 2)
+
+        with self.assertRaises(ValueError), transaction.atomic():
+            self.test_user.user_permissions.remove(permission)
+            raise ValueError()
+        self.assertEqual(caches['menus'].get(MENU_VERSION_KEY), 2)
+        self.assertIn(Booking._meta.model_name, self.menu_models(self.build_request()))
+
+    def test_menu_not_cached_without_shared_cache(self):
+        """
+        Does menu built on each request without a shared cache backend
+        """
+        with self.settings(MENU_CACHE_BACKEND='default'):
+            self.menu_models(self.build_request())
+            request = self.build_request()
+            with CaptureQueriesContext(connection) as captured:
+                self.menu_models(request)
+            self.assertTrue(captured.captured_queries)
+
+    def test_recents_cached_until_recent_link(self):
+        """
+        Does user recent links taken from cache until links change
+        """
+        request = self.build_request()
+        self.assertEqual(bookings_site.find_recents(request), [])
+        with self.assertNumQueries(0):
+            self.assertEqual(bookings_site.find_recents(request), [])
+
+        site_model = bookings_site._registry[Booking]
+        booking = Booking(pk=1, name='Test Booking', agency=Agency(name='Test Agency'))
+        site_model.recent_link(request, booking)
+        recents = bookings_site.find_recents(request)
+        self.assertEqual([recent.link_label for recent in recents], [str(booking)])
+
+        site_model.delete_recent(request, booking.pk)
+        self.assertEqual(bookings_site.find_recents(request), [])
+        self.assertFalse(RecentLink.objects.exists())
+
+    def test_recents_buffered_by_object(self):
+        """
+        Does recent links of a request written once by object at request end
+        """
+        request = self.build_request()
+        site_model = bookings_site._registry[Booking]
+        agency = Agency(name='Test Agency')
+        bookings = [Booking(pk=pk, name='Booking %s' % pk, agency=agency) for pk in [1, 2]]
+        site_model.recent_link(request, bookings[0])
+
+        RecentLinkRecorder.start()
+        with self.assertNumQueries(0):
+            for booking in bookings + bookings:
+                site_model.recent_link(request, booking)
+        self.assertEqual(RecentLinkRecorder.pending_count(), 2)
+        # begin, existing links, update and insert
+        with self.assertNumQueries(4):
+            RecentLinkRecorder.flush()
+
+        self.assertEqual(
+            sorted(RecentLink.objects.values_list('link_model', 'link_object_id', 'link_label')),
+            [('booking.booking', '1', str(bookings[0])), ('booking.booking', '2', str(bookings[1]))])
+
+
+@override_settings(
+    MIDDLEWARE=settings.MIDDLEWARE + ['common.middleware.QueryStatsMiddleware'],
+    QUERY_STATS_REPEATED_LIMIT=2)
+class QueryStatsTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        QueryStats.clear()
+
+    def test_repeated_queries(self):
+        """
+        Does queries counted by shape with parameters lists collapsed
+        """
+        queries = RequestQueries()
+        for sql in ['SELECT a FROM t WHERE id = %s'] * 3 + [
+                'SELECT b FROM t WHERE id IN (%s)', 'SELECT b FROM t WHERE id IN (%s, %s)']:
+            queries(lambda *args: None, sql, [], False, dict())
+
+        self.assertEqual(queries.count, 5)
+        self.assertEqual(queries.duplicated(), 3)
+        self.assertEqual(queries.repeated(2), {'SELECT a FROM t WHERE id = %s': 3})
+        self.assertEqual(
+            sql_fingerprint('WHERE id IN (%s, %s,%s) AND x = %s'), 'WHERE id IN (%s) AND x = %s')
+
+    def test_query_stats_report(self):
+        """
+        Does site views recorded by view and model and shown to staff only
+        """
+        user = User.objects.create(username='admin', is_staff=True, is_superuser=True)
+        self.client.force_login(user)
+        with self.assertLogs('common.querystats', 'INFO'):
+            response = self.client.get('/bookings/booking/booking/')
+        self.assertEqual(response.status_code, 200)
+
+        views = dict(((stats['view'], stats['model']), stats) for stats in QueryStats.report())
+        stats = views[('bookings:booking_booking_changelist', 'booking.Booking')]
+        self.assertEqual(stats['requests'], 1)
+        self.assertGreater(stats['queries'], 0)
+
+        response = self.client.get('/bookings/query_stats/')
+        self.assertContains(response, 'bookings:booking_booking_changelist')
+
+        User.objects.filter(pk=user.pk).update(is_staff=False)
+        response = self.client.get('/bookings/query_stats/')
+        self.assertNotEqual(response.status_code, 200)
+
+
+class DeferredUpdatesTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.test_user = User.objects.create(username='Test User')
+        self.updated = list()
+
+    def schedule(self):
+        DeferredUpdates.schedule(
+            'test', 1, User, self.test_user.pk, lambda obj: self.updated.append(obj.pk))
+
+    def test_rolled_back_then_committed(self):
+        """
+        Does update requested in a rolled back transaction run on later commit
+        """
+        with self.assertRaises(ValueError), transaction.atomic():
+            self.schedule()
+            raise ValueError()
+        self.assertEqual(self.updated, [])
+
+        with transaction.atomic():
+            self.schedule()
+            self.schedule()
+        self.assertEqual(self.updated, [self.test_user.pk])
+        self.assertEqual(DeferredUpdates.pending_count(), 0)
+
+    def test_savepoint_rolled_back(self):
+        """
+        Does update requested in a rolled back savepoint run when requested again
+        """
+        with transaction.atomic():
+            with self.assertRaises(ValueError), transaction.atomic():
+                self.schedule()
+                raise ValueError()
+            self.schedule()
+            self.assertEqual(self.updated, [])
+        self.assertEqual(self.updated, [self.test_user.pk])
+
+    def test_rolled_back_request_dropped(self):
+        """
+        Does update requested in a rolled back transaction not run on commit of another one
+        """
+        with self.assertRaises(ValueError), transaction.atomic():
+            self.schedule()
+            raise ValueError()
+
+        with transaction.atomic():
+            DeferredUpdates.schedule(
+                'other', 1, User, self.test_user.pk, lambda obj: self.updated.append(None))
+        self.assertEqual(self.updated, [None])
+        self.assertEqual(DeferredUpdates.pending_count(), 0)
+
+    def test_failed_after_commit(self):
+        """
+        Does failing update keep committed data, logged and out of the caller
+        """
+        def fail(obj):
+            self.updated.append(obj.pk)
+            raise ValueError()
+
+        with self.assertLogs('common.deferred', 'ERROR'):
+            with transaction.atomic():
+                Agency.objects.create(name='Test Agency')
+                DeferredUpdates.schedule('test', 1, User, self.test_user.pk, fail)
+        self.assertEqual(self.updated, [self.test_user.pk])
+        self.assertEqual(Agency.objects.count(), 1)
+        self.assertEqual(DeferredUpdates.pending_count(), 0)
+
+    def test_deadlock_after_commit(self):
+        """
+        Does update rerun in its own transaction when it is a deadlock victim
+        """
+        def deadlocked(obj):
+            self.updated.append(obj.pk)
+            if len(self.updated) == 1:
+                raise OperationalError(1213, 'Deadlock found when trying to get lock')
+
+        with transaction.atomic():
+            DeferredUpdates.schedule('test', 1, User, self.test_user.pk, deadlocked)
+        self.assertEqual(self.updated, [self.test_user.pk, self.test_user.pk])
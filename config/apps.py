@@ -2,3 +2,6 @@ from django.apps import AppConfig
 
 class ConfigConfig(AppConfig):
     name = 'config'
+
+    def ready(self):
+        from config import signals
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-18 20:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('config', '0030_service_voucher_notes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='agencyallotmentservice',
+            index=models.Index(fields=['agency', 'service', 'contract_code', 'date_from', 'date_to'], name='config_agen_agency__00f33a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='agencyextraservice',
+            index=models.Index(fields=['agency', 'service', 'contract_code', 'date_from', 'date_to'], name='config_agen_agency__9b5856_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='agencytransferservice',
+            index=models.Index(fields=['agency', 'service', 'contract_code', 'date_from', 'date_to'], name='config_agen_agency__d805b4_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='providerallotmentservice',
+            index=models.Index(fields=['provider', 'service', 'contract_code', 'date_from', 'date_to'], name='config_prov_provide_3eed7e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='providerextraservice',
+            index=models.Index(fields=['provider', 'service', 'contract_code', 'date_from', 'date_to'], name='config_prov_provide_bb2d03_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='providertransferservice',
+            index=models.Index(fields=['provider', 'service', 'contract_code', 'date_from', 'date_to'], name='config_prov_provide_af85ae_idx'),
+        ),
+    ]
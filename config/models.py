@@ -582,6 +582,10 @@ class ProviderAllotmentService(ProviderCatalogue):
         verbose_name = 'Accomodation Cost'
         verbose_name_plural = 'Accomodation Costs'
         unique_together = (('provider', 'service', 'date_from', 'date_to', 'contract_code'),)
+        # catalog lookups filter by owner, service and contract code on a date window
+        indexes = [
+            models.Index(fields=['provider', 'service', 'contract_code', 'date_from', 'date_to']),
+        ]
     service = models.ForeignKey(Allotment, on_delete=models.CASCADE)
 
     def __str__(self):
@@ -630,6 +634,10 @@ class AgencyAllotmentService(AgencyCatalogue):
         verbose_name = 'Accomodation Price'
         verbose_name_plural = 'Accomodation Prices'
         unique_together = (('agency', 'service', 'date_from', 'date_to', 'contract_code'),)
+        # catalog lookups filter by owner, service and contract code on a date window
+        indexes = [
+            models.Index(fields=['agency', 'service', 'contract_code', 'date_from', 'date_to']),
+        ]
     service = models.ForeignKey(Allotment, on_delete=models.CASCADE)
 
     def __str__(self):
@@ -718,6 +726,10 @@ class ProviderTransferService(ProviderCatalogue):
         verbose_name = 'Transfer Cost'
         verbose_name_plural = 'Transfer Cost'
         unique_together = (('provider', 'service', 'date_from', 'date_to', 'contract_code'),)
+        # catalog lookups filter by owner, service and contract code on a date window
+        indexes = [
+            models.Index(fields=['provider', 'service', 'contract_code', 'date_from', 'date_to']),
+        ]
     service = models.ForeignKey(Transfer, on_delete=models.CASCADE)
 
     def __str__(self):
@@ -767,6 +779,10 @@ class AgencyTransferService(AgencyCatalogue):
         verbose_name = 'Transfer Price'
         verbose_name_plural = 'Transfer Prices'
         unique_together = (('agency', 'service', 'date_from', 'date_to', 'contract_code'),)
+        # catalog lookups filter by owner, service and contract code on a date window
+        indexes = [
+            models.Index(fields=['agency', 'service', 'contract_code', 'date_from', 'date_to']),
+        ]
     service = models.ForeignKey(Transfer, on_delete=models.CASCADE)
 
     def __str__(self):
@@ -818,6 +834,10 @@ class ProviderExtraService(ProviderCatalogue):
         verbose_name = 'Extra Cost'
         verbose_name_plural = 'Extra Costs'
         unique_together = (('provider', 'service', 'date_from', 'date_to', 'contract_code'),)
+        # catalog lookups filter by owner, service and contract code on a date window
+        indexes = [
+            models.Index(fields=['provider', 'service', 'contract_code', 'date_from', 'date_to']),
+        ]
     service = models.ForeignKey(Extra, on_delete=models.CASCADE)
 
     def __str__(self):
@@ -855,6 +875,10 @@ class AgencyExtraService(AgencyCatalogue):
         verbose_name = 'Extra Price'
         verbose_name_plural = 'Extras Prices'
         unique_together = (('agency', 'service', 'date_from', 'date_to', 'contract_code'),)
+        # catalog lookups filter by owner, service and contract code on a date window
+        indexes = [
+            models.Index(fields=['agency', 'service', 'contract_code', 'date_from', 'date_to']),
+        ]
     service = models.ForeignKey(Extra, on_delete=models.CASCADE)
 
     def __str__(self):
@@ -0,0 +1,626 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+"""
+config pricing
+
+Helpers used by ConfigServices to resolve catalog amounts
+"""
+from collections import OrderedDict, namedtuple
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+import functools
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection, transaction
+
+from reservas.custom_settings import ADDON_FOR_NO_ADDON
+
+
+_local = threading.local()
+
+
+def _as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+
+def _as_id(value):
+    if value is None or value == '':
+        return None
+    value = getattr(value, 'pk', value)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def same_id(value1, value2):
+    return _as_id(value1) == _as_id(value2)
+
+
+def pax_range_matches(detail, paxes):
+    """
+    python version of the pax range filtering done on catalog querysets
+    """
+    pax_min = detail.pax_range_min
+    pax_max = detail.pax_range_max
+    return (
+        (pax_min == 0 and pax_max >= paxes) or
+        (pax_min <= paxes and pax_max >= paxes) or
+        (pax_min <= paxes and pax_max == 0) or
+        (pax_min == 0 and pax_max == 0))
+
+
+def group_paxes(group):
+    """
+    returns (adults, children, free_adults, free_children) for a pax group
+    """
+    free_adults, free_children = 0, 0
+    if 2 in group:
+        free_adults = group[2]
+    if 3 in group:
+        free_children = group[3]
+    return group[0], group[1], free_adults, free_children
+
+
+def resolve_date_range(
+        details, catalog_field, date_from, date_to, groups, segment_amount, date_class=date):
+    """
+    resolves the amount of every pax group for the date window in one pass
+    over the details, sorted by date_from asc and date_to desc.
+    Each group covers the window segment by segment with the first detail having
+    an amount for it, as find_amount does for one group.
+    segment_amount(detail, segment_from, segment_to, group) returns the segment
+    amount or None.
+    Returns an (amount, message) tuple for each group
+    """
+    current_dates = [date_from] * len(groups)
+    amounts = [0] * len(groups)
+    solved = [False] * len(groups)
+    pending = len(groups)
+    for detail in details:
+        if not pending:
+            break
+        catalog = getattr(detail, catalog_field)
+        end_date = catalog.date_to + timedelta(days=1)
+        full_range = end_date >= date_to
+        if not full_range:
+            end_date = date_class(year=end_date.year, month=end_date.month, day=end_date.day)
+        for position, group in enumerate(groups):
+            if solved[position] or current_dates[position] < catalog.date_from:
+                continue
+            if full_range:
+                result = segment_amount(detail, current_dates[position], date_to, group)
+                if result is not None and result >= 0:
+                    amounts[position] += result
+                    solved[position] = True
+                    pending -= 1
+            else:
+                result = segment_amount(detail, current_dates[position], end_date, group)
+                if result is not None and result >= 0:
+                    amounts[position] += result
+                    current_dates[position] = end_date
+    results = list()
+    for position in range(len(groups)):
+        if solved[position]:
+            results.append((amounts[position], ''))
+        else:
+            results.append((None, 'Amount Not Found for date %s' % current_dates[position]))
+    return results
+
+
+def addon_matches(detail, addon_id):
+    if addon_id:
+        return same_id(detail.addon_id, addon_id)
+    return same_id(detail.addon_id, ADDON_FOR_NO_ADDON)
+
+
+class RatePlanIndex(object):
+    """
+    RatePlanIndex
+
+    Keeps in memory every catalog detail of a (provider or agency, service, contract_code)
+    rate plan, sorted by date_from asc and date_to desc as the catalog querysets do.
+    Once loaded, a rate plan is resolved for any date window without database round trips.
+    """
+
+    def __init__(self):
+        self._plans = dict()
+        self._services = dict()
+        self.loaded_plans = 0
+
+    @classmethod
+    def active(cls):
+        """
+        returns the index activated for current thread, if any
+        """
+        stack = getattr(_local, 'rate_plan_indexes', None)
+        if stack:
+            return stack[-1]
+        return None
+
+    def __enter__(self):
+        stack = getattr(_local, 'rate_plan_indexes', None)
+        if stack is None:
+            stack = list()
+            _local.rate_plan_indexes = stack
+        stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.rate_plan_indexes.pop()
+        return False
+
+    @classmethod
+    def catalog_field(cls, for_provider):
+        if for_provider:
+            return 'provider_service'
+        return 'agency_service'
+
+    @classmethod
+    def owner_field(cls, for_provider):
+        if for_provider:
+            return 'provider_id'
+        return 'agency_id'
+
+    @classmethod
+    def plan_key(cls, detail_model, owner_id, service_id, contract_code):
+        return (detail_model, _as_id(owner_id), _as_id(service_id), contract_code or '')
+
+    def get_service(self, service_model, service_id):
+        if isinstance(service_id, service_model):
+            return service_id
+        key = (service_model, _as_id(service_id))
+        service = self._services.get(key)
+        if service is None:
+            service = service_model.objects.get(pk=service_id)
+            self._services[key] = service
+        return service
+
+    def add_service(self, service):
+        self._services[(service.__class__, service.pk)] = service
+
+    def _store(self, key, for_provider, details):
+        catalog_field = self.catalog_field(for_provider)
+        details.sort(key=lambda detail: (
+            getattr(detail, catalog_field).date_from,
+            -getattr(detail, catalog_field).date_to.toordinal(),
+            detail.pk))
+        self._plans[key] = details
+        self.loaded_plans += 1
+
+    def load(self, detail_model, for_provider, keys):
+        """
+        loads with one query all rate plans for the (owner_id, service_id, contract_code) keys
+        not already present in the index
+        """
+        pending = set()
+        for owner_id, service_id, contract_code in keys:
+            key = self.plan_key(detail_model, owner_id, service_id, contract_code)
+            if key not in self._plans:
+                pending.add(key)
+        if not pending:
+            return
+        catalog_field = self.catalog_field(for_provider)
+        owner_field = self.owner_field(for_provider)
+        plans = dict()
+        for key in pending:
+            plans[key] = list()
+        queryset = detail_model.objects.select_related(
+            '%s__service' % catalog_field
+        ).filter(**{
+            '%s__%s__in' % (catalog_field, owner_field): set([key[1] for key in pending]),
+            '%s__service_id__in' % catalog_field: set([key[2] for key in pending]),
+            '%s__contract_code__in' % catalog_field: set([key[3] for key in pending]),
+        })
+        for detail in queryset:
+            catalog = getattr(detail, catalog_field)
+            key = self.plan_key(
+                detail_model, getattr(catalog, owner_field), catalog.service_id,
+                catalog.contract_code)
+            if key in plans:
+                plans[key].append(detail)
+        for key, details in plans.items():
+            self._store(key, for_provider, details)
+
+    def details(
+            self, detail_model, for_provider, owner_id, service_id,
+            date_from, date_to, booked, contract_code):
+        """
+        returns the rate plan details valid for the date window and booked date
+        """
+        if date_from is None or date_to is None:
+            return list()
+        key = self.plan_key(detail_model, owner_id, service_id, contract_code)
+        if key not in self._plans:
+            self.load(detail_model, for_provider, [key[1:]])
+        catalog_field = self.catalog_field(for_provider)
+        date_from = _as_date(date_from)
+        date_to = _as_date(date_to)
+        booked = _as_date(booked)
+        result = list()
+        for detail in self._plans[key]:
+            catalog = getattr(detail, catalog_field)
+            if catalog.date_from > date_to:
+                # sorted by date_from, no more details for the window
+                break
+            if catalog.date_to < date_from:
+                continue
+            if booked:
+                if catalog.booked_from is not None and catalog.booked_from > booked:
+                    continue
+                if catalog.booked_to is not None and catalog.booked_to < booked:
+                    continue
+            result.append(detail)
+        return result
+
+
+# occupancy kernel entry kinds
+_ADULTS_ONLY = 0
+_CHILDREN_TOTAL = 1
+_CHILDREN_EACH = 2
+_CHILDREN_DISCOUNT = 3
+
+
+class OccupancyKernel(object):
+    """
+    OccupancyKernel
+
+    Amounts of an AmountDetail compiled into a table indexed by [adults][paying children]
+    with child discount fallbacks already resolved. Gives the same amounts
+    find_detail_amount gave with its adults and children branches.
+    """
+
+    __slots__ = ('child_discount_percent', 'rows', 'children_only', 'three_children')
+
+    def __init__(self, detail, child_discount_percent):
+        self.child_discount_percent = child_discount_percent
+        discount = None
+        if child_discount_percent is not None:
+            discount = 1.0 - float(child_discount_percent) / 100.0
+
+        ch_1_ad_0 = detail.ch_1_ad_0_amount
+        ch_2_ad_0 = detail.ch_2_ad_0_amount
+        ch_3_ad_0 = detail.ch_3_ad_0_amount
+        children_only = [None, None, None]
+        if ch_1_ad_0 is not None:
+            children_only[1] = ch_1_ad_0
+            if ch_2_ad_0 is not None:
+                children_only[2] = ch_1_ad_0 + ch_2_ad_0
+        self.children_only = children_only
+        self.three_children = None
+        if ch_1_ad_0 is not None and ch_2_ad_0 is not None and ch_3_ad_0 is not None:
+            self.three_children = ch_1_ad_0 + ch_2_ad_0 + ch_3_ad_0
+
+        rows = [None]
+        for adults in range(1, 5):
+            adult_amount = getattr(detail, 'ad_%s_amount' % adults)
+            if adult_amount is None:
+                rows.append(None)
+                continue
+            ch_1 = getattr(detail, 'ch_1_ad_%s_amount' % adults)
+            ch_2 = getattr(detail, 'ch_2_ad_%s_amount' % adults)
+            ch_3 = getattr(detail, 'ch_3_ad_%s_amount' % adults)
+            discount_entry = None
+            if discount is not None:
+                discount_entry = (
+                    _CHILDREN_DISCOUNT, float(adult_amount), (float(adult_amount), discount))
+            row = [(_ADULTS_ONLY, adult_amount, None)]
+            if ch_1 is not None:
+                row.append((_CHILDREN_TOTAL, adult_amount, ch_1))
+            else:
+                row.append(discount_entry)
+            if adults == 4:
+                # four adults rows are priced by child
+                if ch_2 is not None:
+                    row.append((_CHILDREN_EACH, adult_amount, ch_2))
+                else:
+                    row.append(discount_entry)
+            elif ch_1 is not None and ch_2 is not None:
+                row.append((_CHILDREN_TOTAL, adult_amount, ch_1 + ch_2))
+            else:
+                row.append(discount_entry)
+            if ch_3 is not None:
+                row.append((_CHILDREN_EACH, adult_amount, ch_3))
+            else:
+                row.append(discount_entry)
+            rows.append(row)
+        self.rows = rows
+
+    @classmethod
+    def for_detail(cls, service, detail):
+        """
+        returns the kernel of the detail for the service, compiled once per detail
+        """
+        child_discount_percent = getattr(service, 'child_discount_percent', None)
+        kernel = getattr(detail, '_occupancy_kernel', None)
+        if kernel is None or kernel.child_discount_percent != child_discount_percent:
+            kernel = cls(detail, child_discount_percent)
+            detail._occupancy_kernel = kernel
+        return kernel
+
+    def amount(self, adults, children, free_adults=0, free_children=0):
+        paying_children = children - free_children
+        if adults == 0:
+            if paying_children == 1 or paying_children == 2:
+                amount = self.children_only[paying_children]
+                if amount is not None:
+                    return amount
+                return None
+            if children == 3:
+                return self.three_children
+            return None
+        if adults < 0 or adults > 4:
+            return None
+        row = self.rows[adults]
+        if row is None:
+            return None
+        column = paying_children
+        if adults < 3 and not 0 <= paying_children <= 2:
+            # one and two adults rows look for three children ignoring free children
+            if children != 3:
+                return None
+            column = 3
+        if not 0 <= column <= 3:
+            return None
+        entry = row[column]
+        if entry is None:
+            return None
+        kind, adult_amount, child_amount = entry
+        paying_adults = adults - free_adults
+        if kind == _ADULTS_ONLY:
+            return paying_adults * adult_amount
+        if kind == _CHILDREN_TOTAL:
+            return paying_adults * adult_amount + child_amount
+        if kind == _CHILDREN_EACH:
+            return paying_adults * adult_amount + paying_children * child_amount
+        float_amount, discount = child_amount
+        return paying_adults * adult_amount + paying_children * float_amount * discount
+
+
+AmountsRequest = namedtuple('AmountsRequest', [
+    'service', 'date_from', 'date_to', 'cost_groups', 'price_groups',
+    'provider', 'agency', 'booked', 'contract_code',
+    'addon_id', 'quantity', 'parameter',
+    'board_type', 'room_type_id',
+    'location_from_id', 'location_to_id'])
+AmountsRequest.__new__.__defaults__ = (None,) * 7
+AmountsRequest.__doc__ = """
+AmountsRequest
+
+Catalog amounts to find for a service in a batch.
+service must be a config Service instance, room and board are used for allotments
+and locations for transfers.
+"""
+
+
+def _cache_key_part(value):
+    if value is None or isinstance(value, (bool, int, float, Decimal, str, date)):
+        return value
+    if hasattr(value, '_meta') and hasattr(value, 'pk'):
+        return value.pk
+    if isinstance(value, dict):
+        return tuple(sorted(
+            [(_cache_key_part(k), _cache_key_part(v)) for k, v in value.items()]))
+    if isinstance(value, (list, tuple)):
+        return tuple([_cache_key_part(item) for item in value])
+    return value
+
+
+class PricingCache(object):
+    """
+    PricingCache
+
+    Bounded LRU of catalog costs and prices results by service, provider or agency
+    and call arguments, in front of a django cache shared by processes holding
+    results and per service invalidation generations. Entries are invalidated
+    when catalogs, details or services changes are committed (see config.signals),
+    meanwhile the changing transaction computes amounts of those services again.
+
+    Settings:
+    PRICING_CACHE_BACKEND django cache alias shared by processes, as memcached or
+    database caches. The cache is disabled when missing or a local memory cache
+    PRICING_CACHE_SIZE max entries kept in memory, 0 disables the cache (default 2048)
+    PRICING_CACHE_TIMEOUT seconds an entry is valid (default 300)
+    """
+
+    def __init__(self, max_size=None, timeout=None, backend=None):
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self._service_keys = dict()
+        self._options = (max_size, timeout, backend)
+        self.reset()
+        self.reset_stats()
+
+    def reset(self):
+        """
+        clears entries, settings are read again on next use
+        """
+        self.clear()
+        self._max_size, self._timeout, self._backend = self._options
+        self._configured = False
+
+    def _configure(self):
+        if self._configured:
+            return
+        if self._backend is None:
+            alias = getattr(settings, 'PRICING_CACHE_BACKEND', None)
+            if alias:
+                self._backend = caches[alias]
+        if self._backend is None or isinstance(self._backend, (LocMemCache, DummyCache)):
+            # invalidations would not reach other processes
+            self._backend = None
+            self._max_size = 0
+        if self._max_size is None:
+            self._max_size = getattr(settings, 'PRICING_CACHE_SIZE', 2048)
+        if self._timeout is None:
+            self._timeout = getattr(settings, 'PRICING_CACHE_TIMEOUT', 300)
+        self._configured = True
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = 0.0
+        if lookups:
+            hit_rate = float(self.hits) / lookups
+        return dict(
+            size=len(self._entries),
+            max_size=self._max_size,
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=hit_rate,
+            evictions=self.evictions,
+            invalidations=self.invalidations,
+        )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._service_keys.clear()
+        self._changed_services().clear()
+
+    def _generation_key(self, service_id):
+        return 'config.pricing.generation.%s' % service_id
+
+    def _generation(self, service_id):
+        if self._backend is None:
+            return None
+        return self._backend.get(self._generation_key(service_id), 0)
+
+    def _backend_key(self, key, generation):
+        digest = hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+        return 'config.pricing.%s.%s.%s' % (key[1], generation, digest)
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        keys = self._service_keys.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._service_keys[key[1]]
+
+    def _store(self, key, value, generation):
+        self._entries[key] = (value, generation, time.time() + self._timeout)
+        self._entries.move_to_end(key)
+        self._service_keys.setdefault(key[1], set()).add(key)
+        while len(self._entries) > self._max_size:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def get_or_compute(self, key, compute):
+        """
+        returns the cached value for key or computes and caches it.
+        key must start with (for_provider, service_id, owner_id)
+        """
+        self._configure()
+        if not self._max_size or key[1] in self._changed_services():
+            return compute()
+        generation = self._generation(key[1])
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, entry_generation, expires = entry
+                if entry_generation == generation and expires > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+        if self._backend is not None:
+            value = self._backend.get(self._backend_key(key, generation))
+            if value is not None:
+                with self._lock:
+                    self.hits += 1
+                    self._store(key, value, generation)
+                return value
+        value = compute()
+        with self._lock:
+            self.misses += 1
+            self._store(key, value, generation)
+        if self._backend is not None:
+            self._backend.set(self._backend_key(key, generation), value, self._timeout)
+        return value
+
+    def _changed_services(self):
+        """
+        services changed by current transaction, not invalidated until commit
+        """
+        changed = getattr(_local, 'changed_services', None)
+        if changed is None:
+            changed = _local.changed_services = set()
+        elif changed and not connection.in_atomic_block:
+            changed.clear()
+        return changed
+
+    def invalidate_on_commit(self, service_id, for_provider=None, owner_id=None):
+        """
+        invalidates entries when current transaction commits, other processes
+        could cache again rows read before commit otherwise
+        """
+        self._configure()
+        if not self._max_size:
+            return
+        service_id = _as_id(service_id)
+        owner_id = _as_id(owner_id)
+        if connection.in_atomic_block:
+            self._changed_services().add(service_id)
+        transaction.on_commit(
+            lambda: self.invalidate(service_id, for_provider, owner_id))
+
+    def invalidate(self, service_id, for_provider=None, owner_id=None):
+        """
+        removes entries for the service, optionally only those of a provider or agency
+        """
+        self._configure()
+        service_id = _as_id(service_id)
+        owner_id = _as_id(owner_id)
+        self._changed_services().discard(service_id)
+        with self._lock:
+            for key in list(self._service_keys.get(service_id, list())):
+                if for_provider is not None and key[0] != for_provider:
+                    continue
+                if owner_id is not None and key[2] != owner_id:
+                    continue
+                self._remove(key)
+            self.invalidations += 1
+        if self._backend is not None:
+            generation_key = self._generation_key(service_id)
+            self._backend.add(generation_key, 0, None)
+            try:
+                self._backend.incr(generation_key)
+            except ValueError:
+                # expired between add and incr
+                self._backend.set(generation_key, 1, None)
+
+
+pricing_cache = PricingCache()
+
+
+def cached_amounts(for_provider):
+    """
+    caches results of ConfigServices catalog costs or prices methods, having
+    (cls, service_id, date_from, date_to, groups, provider or agency, ...) arguments
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(cls, service_id, date_from, date_to, groups, owner, *args, **kwargs):
+            key = (
+                for_provider, _as_id(service_id), _as_id(owner), func.__name__,
+                _cache_key_part((date_from, date_to, groups, args)),
+                _cache_key_part(sorted(kwargs.items())))
+            return pricing_cache.get_or_compute(
+                key, lambda: func(cls, service_id, date_from, date_to, groups, owner, *args, **kwargs))
+        return wrapper
+    return decorator
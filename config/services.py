@@ -25,11 +25,24 @@ from config.models import (
     ProviderExtraService, ProviderExtraDetail,
     AgencyExtraService, AgencyExtraDetail,
     Schedule, TransferInterval, TransferPickupTime,
+    SERVICE_MODELS,
+)
+from config.pricing import (
+    OccupancyKernel, RatePlanIndex, addon_matches, cached_amounts, group_paxes,
+    pax_range_matches, pricing_cache, resolve_date_range, same_id,
 )
 from finance.models import Agency
 from reservas.custom_settings import ADDON_FOR_NO_ADDON
 
 
+# catalog (cost, price) detail models by service category
+CATALOG_DETAIL_MODELS = {
+    SERVICE_CATEGORY_ALLOTMENT: (ProviderAllotmentDetail, AgencyAllotmentDetail),
+    SERVICE_CATEGORY_TRANSFER: (ProviderTransferDetail, AgencyTransferDetail),
+    SERVICE_CATEGORY_EXTRA: (ProviderExtraDetail, AgencyExtraDetail),
+}
+
+
 # helper function to compare Q objects until migration to Django2
 # which actually implements __eq__ for Q objects
 # once migrated, use normal comparison and remove this function
@@ -642,6 +655,7 @@ class ConfigServices(object):
         return cost, cost_message, price, price_message
 
     @classmethod
+    @cached_amounts(for_provider=True)
     def allotment_costs(
             cls, service_id, date_from, date_to, cost_groups, provider, booked, contract_code,
             board_type, room_type_id, addon_id=None, quantity=None):
@@ -656,7 +670,7 @@ class ConfigServices(object):
 
         # provider cost
         # obtain details order by date_from asc, date_to desc
-        service = Allotment.objects.get(pk=service_id)
+        service = cls._get_catalog_service(Allotment, service_id)
 
         if (cost_groups is None or not cost_groups) and service.cost_type == AMOUNTS_BY_PAX:
             cost = None
@@ -673,29 +687,13 @@ class ConfigServices(object):
                     paxes = group[0] + group[1]
                     if paxes == 0:
                         continue
-                    queryset = cls._get_provider_queryset(
-                        ProviderAllotmentDetail.objects,
-                        provider.id, service_id, date_from, date_to, booked, contract_code)
-                    # pax range filtering
-                    queryset = queryset.filter(
-                        (Q(pax_range_min=0) & Q(pax_range_max__gte=paxes)) |
-                        (Q(pax_range_min__lte=paxes) & Q(pax_range_max__gte=paxes)) |
-                        (Q(pax_range_min__lte=paxes) & Q(pax_range_max=0)) |
-                        (Q(pax_range_min=0) & Q(pax_range_max=0))
-                    )
-                    # addon filtering
-                    if addon_id:
-                        queryset = queryset.filter(addon_id=addon_id)
-                    else:
-                        queryset = queryset.filter(addon_id=ADDON_FOR_NO_ADDON)
+                    catalog_details = cls._catalog_details_finder(
+                        ProviderAllotmentDetail, True,
+                        provider.id, service_id, date_from, date_to, booked, contract_code,
+                        paxes, addon_id)
 
-                    detail_list = list(
-                        queryset.filter(
-                            board_type=board_type
-                        ).filter(
-                            room_type_id=room_type_id
-                        )
-                    )
+                    detail_list = catalog_details(
+                        board_type=board_type, room_type_id=room_type_id)
                     if not detail_list:
                         return None, ERROR_NO_COST_FOUND % (service, provider, date_from)
                     group_cost, group_cost_message = cls.find_group_amount(
@@ -710,21 +708,12 @@ class ConfigServices(object):
                         cost_message = group_cost_message
                         break
             else:
-                queryset = cls._get_provider_queryset(
-                    ProviderAllotmentDetail.objects,
-                    provider.id, service_id, date_from, date_to, booked, contract_code)
-                # addon filtering
-                if addon_id:
-                    queryset = queryset.filter(addon_id=addon_id)
-                else:
-                    queryset = queryset.filter(addon_id=ADDON_FOR_NO_ADDON)
-                detail_list = list(
-                    queryset.filter(
-                        board_type=board_type
-                    ).filter(
-                        room_type_id=room_type_id
-                    )
-                )
+                catalog_details = cls._catalog_details_finder(
+                    ProviderAllotmentDetail, True,
+                    provider.id, service_id, date_from, date_to, booked, contract_code,
+                    None, addon_id)
+                detail_list = catalog_details(
+                    board_type=board_type, room_type_id=room_type_id)
                 if not detail_list:
                     return None, ERROR_NO_COST_FOUND % (service, provider, date_from)
                 cost, cost_message = cls.find_groups_amount(
@@ -735,6 +724,7 @@ class ConfigServices(object):
 
 
     @classmethod
+    @cached_amounts(for_provider=False)
     def allotment_prices(
             cls, service_id, date_from, date_to, price_groups, agency, booked, contract_code,
             board_type, room_type_id, addon_id=None, quantity=None):
@@ -749,7 +739,7 @@ class ConfigServices(object):
 
         # agency price
         # obtain details order by date_from asc, date_to desc
-        service = Allotment.objects.get(pk=service_id)
+        service = cls._get_catalog_service(Allotment, service_id)
 
         if (price_groups is None or not price_groups) and service.cost_type == AMOUNTS_BY_PAX:
             price = None
@@ -766,29 +756,13 @@ class ConfigServices(object):
                     paxes = group[0] + group[1]
                     if paxes == 0:
                         continue
-                    queryset = cls._get_agency_queryset(
-                        AgencyAllotmentDetail.objects,
-                        agency.id, service_id, date_from, date_to, booked, contract_code)
-                    # pax range filtering
-                    queryset = queryset.filter(
-                        (Q(pax_range_min=0) & Q(pax_range_max__gte=paxes)) |
-                        (Q(pax_range_min__lte=paxes) & Q(pax_range_max__gte=paxes)) |
-                        (Q(pax_range_min__lte=paxes) & Q(pax_range_max=0)) |
-                        (Q(pax_range_min=0) & Q(pax_range_max=0))
-                    )
-                    # addon filtering
-                    if addon_id:
-                        queryset = queryset.filter(addon_id=addon_id)
-                    else:
-                        queryset = queryset.filter(addon_id=ADDON_FOR_NO_ADDON)
+                    catalog_details = cls._catalog_details_finder(
+                        AgencyAllotmentDetail, False,
+                        agency.id, service_id, date_from, date_to, booked, contract_code,
+                        paxes, addon_id)
 
-                    detail_list = list(
-                        queryset.filter(
-                            board_type=board_type
-                        ).filter(
-                            room_type_id=room_type_id
-                        )
-                    )
+                    detail_list = catalog_details(
+                        board_type=board_type, room_type_id=room_type_id)
                     if not detail_list:
                         return None, "Price Not Found"
                     group_price, group_price_message = cls.find_group_amount(
@@ -803,21 +777,12 @@ class ConfigServices(object):
                         price_message = group_price_message
                         break
             else:
-                queryset = cls._get_agency_queryset(
-                    AgencyAllotmentDetail.objects,
-                    agency.id, service_id, date_from, date_to, booked, contract_code)
-                # addon filtering
-                if addon_id:
-                    queryset = queryset.filter(addon_id=addon_id)
-                else:
-                    queryset = queryset.filter(addon_id=ADDON_FOR_NO_ADDON)
-                detail_list = list(
-                    queryset.filter(
-                        board_type=board_type
-                    ).filter(
-                        room_type_id=room_type_id
-                    )
-                )
+                catalog_details = cls._catalog_details_finder(
+                    AgencyAllotmentDetail, False,
+                    agency.id, service_id, date_from, date_to, booked, contract_code,
+                    None, addon_id)
+                detail_list = catalog_details(
+                    board_type=board_type, room_type_id=room_type_id)
                 if not detail_list:
                     return None, "Price Not Found"
                 price, price_message = cls.find_groups_amount(
@@ -857,6 +822,7 @@ class ConfigServices(object):
 
 
     @classmethod
+    @cached_amounts(for_provider=True)
     def transfer_costs(
             cls, service_id, date_from, date_to, cost_groups, provider, booked, contract_code,
             location_from_id, location_to_id, addon_id=None, quantity=None):
@@ -873,7 +839,7 @@ class ConfigServices(object):
 
         # provider cost
         # obtain details order by date_from asc, date_to desc
-        service = Transfer.objects.get(pk=service_id)
+        service = cls._get_catalog_service(Transfer, service_id)
 
         if (cost_groups is None or not cost_groups) and service.cost_type == AMOUNTS_BY_PAX:
             cost = None
@@ -890,26 +856,14 @@ class ConfigServices(object):
                     paxes = group[0] + group[1]
                     if paxes == 0:
                         continue
-                    queryset = cls._get_provider_queryset(
-                        ProviderTransferDetail.objects,
-                        provider.id, service_id, date_from, date_to, booked, contract_code)
-                    # pax range filtering
-                    queryset = queryset.filter(
-                        (Q(pax_range_min=0) & Q(pax_range_max__gte=paxes)) |
-                        (Q(pax_range_min__lte=paxes) & Q(pax_range_max__gte=paxes)) |
-                        (Q(pax_range_min__lte=paxes) & Q(pax_range_max=0)) |
-                        (Q(pax_range_min=0) & Q(pax_range_max=0))
-                    )
-                    # addon filtering
-                    if addon_id:
-                        queryset = queryset.filter(addon_id=addon_id)
-                    else:
-                        queryset = queryset.filter(addon_id=ADDON_FOR_NO_ADDON)
+                    catalog_details = cls._catalog_details_finder(
+                        ProviderTransferDetail, True,
+                        provider.id, service_id, date_from, date_to, booked, contract_code,
+                        paxes, addon_id)
 
-                    detail_list = list(
-                        queryset.filter(
-                            location_from_id=location_from_id,
-                            location_to_id=location_to_id))
+                    detail_list = catalog_details(
+                        location_from_id=location_from_id,
+                        location_to_id=location_to_id)
                     group_cost = None
                     if detail_list:
                         group_cost, group_cost_message = cls.find_groups_amount(
@@ -917,10 +871,9 @@ class ConfigServices(object):
                             quantity, None, detail_list
                         )
                     if group_cost is None:
-                        detail_list = list(
-                            queryset.filter(
-                                location_to_id=location_from_id,
-                                location_from_id=location_to_id))
+                        detail_list = catalog_details(
+                            location_to_id=location_from_id,
+                            location_from_id=location_to_id)
                         if not detail_list:
                             return None, ERROR_NO_COST_FOUND % (service, provider, date_from)
                         group_cost, group_cost_message = cls.find_groups_amount(
@@ -936,18 +889,13 @@ class ConfigServices(object):
                         cost_message = group_cost_message
                         break
             else:
-                queryset = cls._get_provider_queryset(
-                    ProviderTransferDetail.objects,
-                    provider.id, service_id, date_from, date_to, booked, contract_code)
-                # addon filtering
-                if addon_id:
-                    queryset = queryset.filter(addon_id=addon_id)
-                else:
-                    queryset = queryset.filter(addon_id=ADDON_FOR_NO_ADDON)
-                detail_list = list(
-                    queryset.filter(
-                        location_from_id=location_from_id,
-                        location_to_id=location_to_id))
+                catalog_details = cls._catalog_details_finder(
+                    ProviderTransferDetail, True,
+                    provider.id, service_id, date_from, date_to, booked, contract_code,
+                    None, addon_id)
+                detail_list = catalog_details(
+                    location_from_id=location_from_id,
+                    location_to_id=location_to_id)
                 cost = None
                 if detail_list:
                     cost, cost_message = cls.find_groups_amount(
@@ -955,10 +903,9 @@ class ConfigServices(object):
                         quantity, None, detail_list
                     )
                 if cost is None:
-                    detail_list = list(
-                        queryset.filter(
-                            location_to_id=location_from_id,
-                            location_from_id=location_to_id))
+                    detail_list = catalog_details(
+                        location_to_id=location_from_id,
+                        location_from_id=location_to_id)
                     if not detail_list:
                         return None, ERROR_NO_COST_FOUND % (service, provider, date_from)
                     cost, cost_message = cls.find_groups_amount(
@@ -969,6 +916,7 @@ class ConfigServices(object):
 
 
     @classmethod
+    @cached_amounts(for_provider=False)
     def transfer_prices(
             cls, service_id, date_from, date_to, price_groups, agency, booked, contract_code,
             location_from_id, location_to_id, addon_id=None, quantity=None):
@@ -985,7 +933,7 @@ class ConfigServices(object):
 
         # agency price
         # obtain details order by date_from asc, date_to desc
-        service = Transfer.objects.get(pk=service_id)
+        service = cls._get_catalog_service(Transfer, service_id)
 
         if (price_groups is None or not price_groups) and service.cost_type == AMOUNTS_BY_PAX:
             price = None
@@ -1002,26 +950,14 @@ class ConfigServices(object):
                     paxes = group[0] + group[1]
                     if paxes == 0:
                         continue
-                    queryset = cls._get_agency_queryset(
-                        AgencyTransferDetail.objects,
-                        agency.id, service_id, date_from, date_to, booked, contract_code)
-                    # pax range filtering
-                    queryset = queryset.filter(
-                        (Q(pax_range_min=0) & Q(pax_range_max__gte=paxes)) |
-                        (Q(pax_range_min__lte=paxes) & Q(pax_range_max__gte=paxes)) |
-                        (Q(pax_range_min__lte=paxes) & Q(pax_range_max=0)) |
-                        (Q(pax_range_min=0) & Q(pax_range_max=0))
-                    )
-                    # addon filtering
-                    if addon_id:
-                        queryset = queryset.filter(addon_id=addon_id)
-                    else:
-                        queryset = queryset.filter(addon_id=ADDON_FOR_NO_ADDON)
+                    catalog_details = cls._catalog_details_finder(
+                        AgencyTransferDetail, False,
+                        agency.id, service_id, date_from, date_to, booked, contract_code,
+                        paxes, addon_id)
 
-                    detail_list = list(
-                        queryset.filter(
-                            location_from_id=location_from_id,
-                            location_to_id=location_to_id))
+                    detail_list = catalog_details(
+                        location_from_id=location_from_id,
+                        location_to_id=location_to_id)
                     group_price = None
                     if detail_list:
                         group_price, group_price_message = cls.find_groups_amount(
@@ -1029,10 +965,9 @@ class ConfigServices(object):
                             quantity, None, detail_list
                         )
                     if group_price is None:
-                        detail_list = list(
-                            queryset.filter(
-                                location_to_id=location_from_id,
-                                location_from_id=location_to_id))
+                        detail_list = catalog_details(
+                            location_to_id=location_from_id,
+                            location_from_id=location_to_id)
                         if not detail_list:
                             return None, "Price Not Found"
                         group_price, group_price_message = cls.find_groups_amount(
@@ -1048,18 +983,13 @@ class ConfigServices(object):
                         price_message = group_price_message
                         break
             else:
-                queryset = cls._get_agency_queryset(
-                    AgencyTransferDetail.objects,
-                    agency.id, service_id, date_from, date_to, booked, contract_code)
-                # addon filtering
-                if addon_id:
-                    queryset = queryset.filter(addon_id=addon_id)
-                else:
-                    queryset = queryset.filter(addon_id=ADDON_FOR_NO_ADDON)
-                detail_list = list(
-                    queryset.filter(
-                        location_from_id=location_from_id,
-                        location_to_id=location_to_id))
+                catalog_details = cls._catalog_details_finder(
+                    AgencyTransferDetail, False,
+                    agency.id, service_id, date_from, date_to, booked, contract_code,
+                    None, addon_id)
+                detail_list = catalog_details(
+                    location_from_id=location_from_id,
+                    location_to_id=location_to_id)
                 price = None
                 if detail_list:
                     price, price_message = cls.find_groups_amount(
@@ -1067,10 +997,9 @@ class ConfigServices(object):
                         quantity, None, detail_list
                     )
                 if price is None:
-                    detail_list = list(
-                        queryset.filter(
-                            location_to_id=location_from_id,
-                            location_from_id=location_to_id))
+                    detail_list = catalog_details(
+                        location_to_id=location_from_id,
+                        location_from_id=location_to_id)
                     if not detail_list:
                         return None, "Price Not Found"
                     price, price_message = cls.find_groups_amount(
@@ -1086,7 +1015,7 @@ class ConfigServices(object):
             cls, service_id, date_from, date_to, cost_groups, price_groups,
             provider, booked, contract_code, agency,
             addon_id, quantity, parameter):
-        service = Extra.objects.get(pk=service_id)
+        service = cls._get_catalog_service(Extra, service_id)
 
         if date_from is None and date_to is None:
             return None, 'Both Dates are Missing', None, 'Both Dates are Missing'
@@ -1113,10 +1042,11 @@ class ConfigServices(object):
 
 
     @classmethod
+    @cached_amounts(for_provider=True)
     def extra_costs(
             cls, service_id, date_from, date_to, cost_groups, provider, booked, contract_code,
             addon_id, quantity, parameter):
-        service = Extra.objects.get(pk=service_id)
+        service = cls._get_catalog_service(Extra, service_id)
 
         if date_from is None and date_to is None:
             return None, 'Both Dates are Missing'
@@ -1148,23 +1078,12 @@ class ConfigServices(object):
                     paxes = group[0] + group[1]
                     if paxes == 0:
                         continue
-                    queryset = cls._get_provider_queryset(
-                        ProviderExtraDetail.objects,
-                        provider.id, service_id, date_from, date_to, booked, contract_code)
-                    # pax range filtering
-                    queryset = queryset.filter(
-                        (Q(pax_range_min=0) & Q(pax_range_max__gte=paxes)) |
-                        (Q(pax_range_min__lte=paxes) & Q(pax_range_max__gte=paxes)) |
-                        (Q(pax_range_min__lte=paxes) & Q(pax_range_max=0)) |
-                        (Q(pax_range_min=0) & Q(pax_range_max=0))
-                    )
-                    # addon filtering
-                    if addon_id:
-                        queryset = queryset.filter(addon_id=addon_id)
-                    else:
-                        queryset = queryset.filter(addon_id=ADDON_FOR_NO_ADDON)
+                    catalog_details = cls._catalog_details_finder(
+                        ProviderExtraDetail, True,
+                        provider.id, service_id, date_from, date_to, booked, contract_code,
+                        paxes, addon_id)
 
-                    detail_list = list(queryset)
+                    detail_list = catalog_details()
                     if not detail_list:
                         return None, ERROR_NO_COST_FOUND % (service, provider, date_from)
                     group_cost, group_cost_message = cls.find_group_amount(
@@ -1179,16 +1098,12 @@ class ConfigServices(object):
                         cost_message = group_cost_message
                         break
             else:
-                queryset = cls._get_provider_queryset(
-                    ProviderExtraDetail.objects,
-                    provider.id, service_id, date_from, date_to, booked, contract_code)
-                # addon filtering
-                if addon_id:
-                    queryset = queryset.filter(addon_id=addon_id)
-                else:
-                    queryset = queryset.filter(addon_id=ADDON_FOR_NO_ADDON)
+                catalog_details = cls._catalog_details_finder(
+                    ProviderExtraDetail, True,
+                    provider.id, service_id, date_from, date_to, booked, contract_code,
+                    None, addon_id)
 
-                detail_list = list(queryset)
+                detail_list = catalog_details()
                 if not detail_list:
                     return None, ERROR_NO_COST_FOUND % (service, provider, date_from)
                 cost, cost_message = cls.find_groups_amount(
@@ -1199,10 +1114,11 @@ class ConfigServices(object):
 
 
     @classmethod
+    @cached_amounts(for_provider=False)
     def extra_prices(
             cls, service_id, date_from, date_to, price_groups, agency, booked, contract_code,
             addon_id, quantity, parameter):
-        service = Extra.objects.get(pk=service_id)
+        service = cls._get_catalog_service(Extra, service_id)
 
         if date_from is None and date_to is None:
             return None, 'Both Dates are Missing'
@@ -1232,23 +1148,12 @@ class ConfigServices(object):
                 # each group can have different details
                 for group in price_groups:
                     paxes = group[0] + group[1]
-                    queryset = cls._get_agency_queryset(
-                        AgencyExtraDetail.objects,
-                        agency.id, service_id, date_from, date_to, booked, contract_code)
-                    # pax range filtering
-                    queryset = queryset.filter(
-                        (Q(pax_range_min=0) & Q(pax_range_max__gte=paxes)) |
-                        (Q(pax_range_min__lte=paxes) & Q(pax_range_max__gte=paxes)) |
-                        (Q(pax_range_min__lte=paxes) & Q(pax_range_max=0)) |
-                        (Q(pax_range_min=0) & Q(pax_range_max=0))
-                    )
-                    # addon filtering
-                    if addon_id:
-                        queryset = queryset.filter(addon_id=addon_id)
-                    else:
-                        queryset = queryset.filter(addon_id=ADDON_FOR_NO_ADDON)
+                    catalog_details = cls._catalog_details_finder(
+                        AgencyExtraDetail, False,
+                        agency.id, service_id, date_from, date_to, booked, contract_code,
+                        paxes, addon_id)
 
-                    detail_list = list(queryset)
+                    detail_list = catalog_details()
                     if not detail_list:
                         return None, "Price Not Found"
                     group_price, group_price_message = cls.find_group_amount(
@@ -1263,16 +1168,12 @@ class ConfigServices(object):
                         price_message = group_price_message
                         break
             else:
-                queryset = cls._get_agency_queryset(
-                    AgencyExtraDetail.objects,
-                    agency.id, service_id, date_from, date_to, booked, contract_code)
-                # addon filtering
-                if addon_id:
-                    queryset = queryset.filter(addon_id=addon_id)
-                else:
-                    queryset = queryset.filter(addon_id=ADDON_FOR_NO_ADDON)
+                catalog_details = cls._catalog_details_finder(
+                    AgencyExtraDetail, False,
+                    agency.id, service_id, date_from, date_to, booked, contract_code,
+                    None, addon_id)
 
-                detail_list = list(queryset)
+                detail_list = catalog_details()
                 if not detail_list:
                     return None, "Price Not Found"
                 price, price_message = cls.find_groups_amount(
@@ -1284,65 +1185,39 @@ class ConfigServices(object):
 
     @classmethod
     def _find_package_group_price(cls, service, date_from, date_to, group, detail_list):
-        adults, children = group[0], group[1]
-        free_adults, free_children = 0, 0
-        if 2 in group:
-            free_adults = group[2]
-        if 3 in group:
-            free_children = group[3]
-
-        if adults + children - free_adults - free_children == 0:
-            return 0, ''
-        message = ''
-        stop = False
-        solved = False
-        current_date = date_from
-        amount = 0
-        details = list(detail_list)
-        # continue until solved or empty details list
-        while not stop:
-            # verify list not empty
-            if details:
-                # working with first detail
-                detail = details[0]
-
-                detail_date_from = detail.agency_service.date_from
-                detail_date_to = detail.agency_service.date_to
-
-                if current_date >= detail_date_from:
-                    # verify final date included
-                    end_date = detail_date_to + timedelta(days=1)
-                    if end_date >= date_to:
-                        # full date range
-                        result = ConfigServices.get_package_price(
-                            service, detail, current_date, date_to,
-                            adults, children, free_adults, free_children)
-                        if result is not None and result >= 0:
-                            amount += result
-                            solved = True
-                            stop = True
-                    else:
-                        result = ConfigServices.get_package_price(
-                            service, detail, current_date,
-                            datetime(year=end_date.year, month=end_date.month, day=end_date.day),
-                            adults, children, free_adults, free_children)
-                        if result is not None and result >= 0:
-                            amount += result
-                            current_date = datetime(
-                                year=end_date.year, month=end_date.month, day=end_date.day)
-                # remove detail from list
-                details.remove(detail)
-            else:
-                # empty list, no solved all days
-                stop = True
-                message = 'Amount Not Found for date %s' % current_date
-        if not solved:
-            amount = None
+        return cls._find_package_groups_prices(
+            service, date_from, date_to, [group], detail_list)[0]
 
-        if amount is not None and amount >= 0:
-            return cls._round_price(amount), message
-        else:
-            return None, message
+    @classmethod
+    def _find_package_groups_prices(cls, service, date_from, date_to, groups, detail_list):
+        """
+        returns (price, message) for every group resolving all of them in one pass
+        """
+        paxes_list = [group_paxes(group) for group in groups]
+        # groups with same paxes have same price
+        pending = list()
+        for paxes in paxes_list:
+            if paxes not in pending and paxes[0] + paxes[1] - paxes[2] - paxes[3] != 0:
+                pending.append(paxes)
+
+        def segment_price(detail, segment_from, segment_to, paxes):
+            return ConfigServices.get_package_price(
+                service, detail, segment_from, segment_to, *paxes)
+
+        resolved = dict(zip(pending, resolve_date_range(
+            detail_list, 'agency_service', date_from, date_to, pending,
+            segment_price, datetime)))
+        results = list()
+        for paxes in paxes_list:
+            if paxes not in resolved:
+                results.append((0, ''))
+                continue
+            amount, message = resolved[paxes]
+            if amount is not None and amount >= 0:
+                results.append((cls._round_price(amount), message))
+            else:
+                results.append((None, message))
+        return results
 
 
     @classmethod
@@ -1351,9 +1226,8 @@ class ConfigServices(object):
 
         groups_amount = 0
         groups_message = ''
-        for group in groups:
-            amount, message = cls._find_package_group_price(
-                service, date_from, date_to, group, detail_list)
+        for amount, message in cls._find_package_groups_prices(
+                service, date_from, date_to, groups, detail_list):
             if amount is None:
                 return None, message
             groups_amount += amount
@@ -1369,10 +1243,9 @@ class ConfigServices(object):
 
         groups_amount = 0
         groups_message = ''
-        for group in groups:
-            amount, message = cls.find_group_amount(
-                amount_for_provider, service, date_from, date_to, group,
-                quantity, parameter, detail_list)
+        for amount, message in cls.find_groups_amounts(
+                amount_for_provider, service, date_from, date_to, groups,
+                quantity, parameter, detail_list):
             if amount is None:
                 return None, message
             groups_amount += float(amount)
@@ -1380,27 +1253,51 @@ class ConfigServices(object):
 
         return groups_amount, groups_message
 
+    @classmethod
+    def find_groups_amounts(
+            cls, amount_for_provider, service, date_from, date_to, groups,
+            quantity, parameter, detail_list):
+        """
+        returns (amount, message) for every group resolving all of them
+        in one pass over detail list
+        """
+        paxes_list = [group_paxes(group) for group in groups]
+        # groups with same paxes have same amount
+        pending = list()
+        for paxes in paxes_list:
+            if paxes not in pending and paxes[0] + paxes[1] != 0:
+                pending.append(paxes)
+
+        def segment_amount(detail, segment_from, segment_to, paxes):
+            return cls._get_service_amount(
+                service, detail, segment_from, segment_to, *(paxes + (quantity, parameter)))
+
+        if amount_for_provider:
+            catalog_field = 'provider_service'
+        else:
+            catalog_field = 'agency_service'
+        resolved = dict(zip(pending, resolve_date_range(
+            detail_list, catalog_field, date_from, date_to, pending, segment_amount)))
+        results = list()
+        for paxes in paxes_list:
+            if paxes not in resolved:
+                results.append((0, ''))
+                continue
+            amount, message = resolved[paxes]
+            if amount is not None and amount >= 0:
+                results.append((amount, message))
+            else:
+                results.append((None, message))
+        return results
+
     @classmethod
     def find_group_amount(
             cls, amount_for_provider, service, date_from, date_to, group,
             quantity, parameter, detail_list):
 
-        adults = group[0]
-        children = group[1]
-        free_adults, free_children = 0, 0
-        if 2 in group:
-            free_adults = group[2]
-        if 3 in group:
-            free_children = group[3]
-
-        amount, message = cls.find_amount(
-            amount_for_provider, service, date_from, date_to,
-            adults, children, free_adults, free_children,
-            quantity, parameter, detail_list)
-        if amount is not None and amount >= 0:
-            return amount, message
-        else:
-            return None, message
+        return cls.find_groups_amounts(
+            amount_for_provider, service, date_from, date_to, [group],
+            quantity, parameter, detail_list)[0]
 
     @classmethod
     def find_amount(
@@ -1409,60 +1306,10 @@ class ConfigServices(object):
             quantity, parameter, detail_list):
         if adults + children == 0:
             return 0, ''
-        message = ''
-        stop = False
-        solved = False
-        current_date = date_from
-        amount = 0
-        details = list(detail_list)
-        # continue until solved or empty details list
-        while not stop:
-            # verify list not empty
-            if details:
-                # working with first detail
-                detail = details[0]
-
-                # verify current dat included
-                if amount_for_provider:
-                    detail_date_from = detail.provider_service.date_from
-                    detail_date_to = detail.provider_service.date_to
-                else:
-                    detail_date_from = detail.agency_service.date_from
-                    detail_date_to = detail.agency_service.date_to
-
-                if current_date >= detail_date_from:
-                    # verify final date included
-                    end_date = detail_date_to + timedelta(days=1)
-                    if end_date >= date_to:
-                        # full date range
-                        result = cls._get_service_amount(
-                            service, detail, current_date, date_to,
-                            adults, children, free_adults, free_children,
-                            quantity, parameter)
-                        if result is not None and result >= 0:
-                            amount += result
-                            solved = True
-                            stop = True
-                    else:
-                        result = cls._get_service_amount(
-                            service, detail, current_date,
-                            date(year=end_date.year, month=end_date.month, day=end_date.day),
-                            adults, children, free_adults, free_children,
-                            quantity, parameter)
-                        if result is not None and result >= 0:
-                            amount += result
-                            current_date = date(
-                                year=end_date.year, month=end_date.month, day=end_date.day)
-                # remove detail from list
-                details.remove(detail)
-            else:
-                # empty list, no solved all days
-                stop = True
-                message = 'Amount Not Found for date %s' % current_date
-        if not solved:
-            amount = None
-
-        return amount, message
+        return cls.find_groups_amounts(
+            amount_for_provider, service, date_from, date_to,
+            [{0: adults, 1: children, 2: free_adults, 3: free_children}],
+            quantity, parameter, detail_list)[0]
 
     @classmethod
     def _get_service_amount(
@@ -1593,93 +1440,165 @@ class ConfigServices(object):
 
     @classmethod
     def find_detail_amount(cls, service, detail, adults, children, free_adults=0, free_children=0):
-        if adults == 0:
-            if (children - free_children) == 1 and detail.ch_1_ad_0_amount is not None:
-                return (children - free_children) * detail.ch_1_ad_0_amount
-            if (children - free_children) == 2 and detail.ch_1_ad_0_amount is not None and detail.ch_2_ad_0_amount is not None:
-                return detail.ch_1_ad_0_amount + detail.ch_2_ad_0_amount
-            if (children == 3
-                and detail.ch_1_ad_0_amount is not None
-                and detail.ch_2_ad_0_amount is not None
-                and detail.ch_3_ad_0_amount is not None):
-                return detail.ch_1_ad_0_amount + detail.ch_2_ad_0_amount + detail.ch_3_ad_0_amount
-        elif adults == 1 and detail.ad_1_amount is not None:
-            if (children - free_children) == 0:
-                return (adults - free_adults) * detail.ad_1_amount
-            elif (children - free_children) == 1:
-                if detail.ch_1_ad_1_amount is not None:
-                    return (adults - free_adults) * detail.ad_1_amount + detail.ch_1_ad_1_amount
-                elif  service.child_discount_percent is not None:
-                    return (adults - free_adults) * float(detail.ad_1_amount) + (children - free_children) * float(detail.ad_1_amount) * (1.0 - float(service.child_discount_percent) / 100.0)
-            elif (children - free_children) == 2:
-                if detail.ch_1_ad_1_amount is not None and detail.ch_2_ad_1_amount is not None:
-                    return (adults - free_adults) * detail.ad_1_amount + detail.ch_1_ad_1_amount + detail.ch_2_ad_1_amount
-                elif  service.child_discount_percent is not None:
-                    return (adults - free_adults) * float(detail.ad_1_amount) + (children - free_children) * float(detail.ad_1_amount) * (1.0 - float(service.child_discount_percent) / 100.0)
-            # TODO: fix this calculation as done above
-            elif children == 3:
-                if detail.ch_3_ad_1_amount is not None:
-                    return (adults - free_adults) * detail.ad_1_amount + (children - free_children) * detail.ch_3_ad_1_amount
-                elif  service.child_discount_percent is not None:
-                    return (adults - free_adults) * float(detail.ad_1_amount) + (children - free_children) * float(detail.ad_1_amount) * (1.0 - float(service.child_discount_percent) / 100.0)
-        elif adults == 2 and detail.ad_2_amount is not None:
-            if (children - free_children) == 0:
-                return (adults - free_adults) * detail.ad_2_amount
-            elif (children - free_children) == 1:
-                if detail.ch_1_ad_2_amount is not None:
-                    return (adults - free_adults) * detail.ad_2_amount + detail.ch_1_ad_2_amount
-                elif  service.child_discount_percent is not None:
-                    return (adults - free_adults) * float(detail.ad_2_amount) + (children - free_children) * float(detail.ad_2_amount) * (1.0 - float(service.child_discount_percent) / 100.0)
-            elif (children - free_children) == 2:
-                if detail.ch_1_ad_2_amount is not None and detail.ch_2_ad_2_amount is not None:
-                    return (adults - free_adults) * detail.ad_2_amount + detail.ch_1_ad_2_amount + detail.ch_2_ad_2_amount
-                elif  service.child_discount_percent is not None:
-                    return (adults - free_adults) * float(detail.ad_2_amount) + (children - free_children) * float(detail.ad_2_amount) * (1.0 - float(service.child_discount_percent) / 100.0)
-            # TODO: fix this calculation as done above
-            elif children == 3:
-                if detail.ch_3_ad_2_amount is not None:
-                    return (adults - free_adults) * detail.ad_2_amount + (children - free_children) * detail.ch_3_ad_2_amount
-                elif  service.child_discount_percent is not None:
-                    return (adults - free_adults) * float(detail.ad_2_amount) + (children - free_children) * float(detail.ad_2_amount) * (1.0 - float(service.child_discount_percent) / 100.0)
-        elif adults == 3 and detail.ad_3_amount is not None:
-            if (children - free_children) == 0:
-                return (adults - free_adults) * detail.ad_3_amount
-            elif (children - free_children) == 1:
-                if detail.ch_1_ad_3_amount is not None:
-                    return (adults - free_adults) * detail.ad_3_amount + detail.ch_1_ad_3_amount
-                elif  service.child_discount_percent is not None:
-                    return (adults - free_adults) * float(detail.ad_3_amount) + (children - free_children) * float(detail.ad_3_amount) * (1.0 - float(service.child_discount_percent) / 100.0)
-            elif (children - free_children) == 2:
-                if detail.ch_1_ad_3_amount is not None and detail.ch_2_ad_3_amount is not None:
-                    return (adults - free_adults) * detail.ad_3_amount + detail.ch_1_ad_3_amount + detail.ch_2_ad_3_amount
-                elif  service.child_discount_percent is not None:
-                    return (adults - free_adults) * float(detail.ad_3_amount) + (children - free_children) * float(detail.ad_3_amount) * (1.0 - float(service.child_discount_percent) / 100.0)
-            # TODO: fix this calculation as done above
-            if (children - free_children) == 3:
-                if detail.ch_3_ad_3_amount is not None:
-                    return (adults - free_adults) * detail.ad_3_amount + (children - free_children) * detail.ch_3_ad_3_amount
-                elif  service.child_discount_percent is not None:
-                    return (adults - free_adults) * float(detail.ad_3_amount) + (children - free_children) * float(detail.ad_3_amount) * (1.0 - float(service.child_discount_percent) / 100.0)
-        elif adults == 4 and detail.ad_4_amount is not None:
-            if (children - free_children) == 0:
-                return (adults - free_adults) * detail.ad_4_amount
-            elif (children - free_children) == 1:
-                if detail.ch_1_ad_4_amount is not None:
-                    return (adults - free_adults) * detail.ad_4_amount + detail.ch_1_ad_4_amount
-                elif  service.child_discount_percent is not None:
-                    return (adults - free_adults) * float(detail.ad_4_amount) + (children - free_children) * float(detail.ad_4_amount) * (1.0 - float(service.child_discount_percent) / 100.0)
-            elif (children - free_children) == 2:
-                if detail.ch_2_ad_4_amount is not None:
-                    return (adults - free_adults) * detail.ad_4_amount + (children - free_children) * detail.ch_2_ad_4_amount
-                elif  service.child_discount_percent is not None:
-                    return (adults - free_adults) * float(detail.ad_4_amount) + (children - free_children) * float(detail.ad_4_amount) * (1.0 - float(service.child_discount_percent) / 100.0)
-            elif (children - free_children) == 3:
-                if detail.ch_3_ad_4_amount is not None:
-                    return (adults - free_adults) * detail.ad_4_amount + (children - free_children) * detail.ch_3_ad_4_amount
-                elif  service.child_discount_percent is not None:
-                    return (adults - free_adults) * float(detail.ad_4_amount) + (children - free_children) * float(detail.ad_4_amount) * (1.0 - float(service.child_discount_percent) / 100.0)
-        return None
+        return OccupancyKernel.for_detail(service, detail).amount(
+            adults, children, free_adults, free_children)
+
+
+    @classmethod
+    def pricing_cache_stats(cls):
+        """
+        returns catalog amounts cache size, hits, misses, hit rate, evictions and invalidations
+        """
+        return pricing_cache.stats()
+
+    @classmethod
+    def clear_pricing_cache(cls):
+        pricing_cache.clear()
+
+    @classmethod
+    def rate_plan_index(cls):
+        """
+        returns the rate plan index to use as context for a batch of amounts calculations.
+        Catalog details are loaded once per rate plan while the index is active
+        """
+        index = RatePlanIndex.active()
+        if index is None:
+            index = RatePlanIndex()
+        return index
+
+    @classmethod
+    def batch_amounts(cls, requests):
+        """
+        returns a (cost, cost_msg, price, price_msg) tuple for every AmountsRequest.
+        Catalog services and rate plans for all requests are prefetched
+        with one query by model before finding amounts
+        """
+        with cls.rate_plan_index() as index:
+            cls._prefetch_amounts_requests(index, requests)
+            results = list()
+            for request in requests:
+                results.append(cls._request_amounts(request))
+        return results
+
+    @classmethod
+    def _prefetch_amounts_requests(cls, index, requests):
+        # catalog services
+        service_ids = dict()
+        for request in requests:
+            service_ids.setdefault(request.service.category, set()).add(request.service.pk)
+        for category, ids in service_ids.items():
+            for service in SERVICE_MODELS[category].objects.filter(pk__in=ids):
+                index.add_service(service)
+        # rate plans
+        cost_keys = dict()
+        price_keys = dict()
+        for request in requests:
+            cost_model, price_model = CATALOG_DETAIL_MODELS[request.service.category]
+            if request.provider is not None:
+                cost_keys.setdefault(cost_model, set()).add((
+                    request.provider.pk, request.service.pk, request.contract_code or ''))
+            if request.agency is not None:
+                price_keys.setdefault(price_model, set()).add((
+                    request.agency.pk, request.service.pk, request.contract_code or ''))
+        for detail_model, keys in cost_keys.items():
+            index.load(detail_model, True, keys)
+        for detail_model, keys in price_keys.items():
+            index.load(detail_model, False, keys)
 
+    @classmethod
+    def _request_amounts(cls, request):
+        category = request.service.category
+        if category == SERVICE_CATEGORY_ALLOTMENT:
+            cost, cost_msg = cls.allotment_costs(
+                request.service, request.date_from, request.date_to, request.cost_groups,
+                request.provider, request.booked, request.contract_code,
+                request.board_type, request.room_type_id, request.addon_id, request.quantity)
+            price, price_msg = cls.allotment_prices(
+                request.service, request.date_from, request.date_to, request.price_groups,
+                request.agency, request.booked, request.contract_code,
+                request.board_type, request.room_type_id, request.addon_id, request.quantity)
+        elif category == SERVICE_CATEGORY_TRANSFER:
+            cost, cost_msg = cls.transfer_costs(
+                request.service, request.date_from, request.date_to, request.cost_groups,
+                request.provider, request.booked, request.contract_code,
+                request.location_from_id, request.location_to_id,
+                request.addon_id, request.quantity)
+            price, price_msg = cls.transfer_prices(
+                request.service, request.date_from, request.date_to, request.price_groups,
+                request.agency, request.booked, request.contract_code,
+                request.location_from_id, request.location_to_id,
+                request.addon_id, request.quantity)
+        elif category == SERVICE_CATEGORY_EXTRA:
+            cost, cost_msg = cls.extra_costs(
+                request.service, request.date_from, request.date_to, request.cost_groups,
+                request.provider, request.booked, request.contract_code,
+                request.addon_id, request.quantity, request.parameter)
+            price, price_msg = cls.extra_prices(
+                request.service, request.date_from, request.date_to, request.price_groups,
+                request.agency, request.booked, request.contract_code,
+                request.addon_id, request.quantity, request.parameter)
+        else:
+            error_msg = ERROR_INVALID_SERVICE_CATEGORY % category
+            return None, error_msg, None, error_msg
+        return cost, cost_msg, price, price_msg
+
+    @classmethod
+    def _get_catalog_service(cls, service_model, service_id):
+        index = RatePlanIndex.active()
+        if index is not None:
+            return index.get_service(service_model, service_id)
+        return service_model.objects.get(pk=service_id)
+
+    @classmethod
+    def _catalog_details_finder(
+            cls, detail_model, for_provider, owner_id, service_id, date_from, date_to,
+            booked, contract_code, paxes=None, addon_id=None):
+        """
+        returns a function listing catalog details ordered by date_from asc, date_to desc
+        for the detail filters specified (room and board, locations).
+        Details are taken from the active rate plan index or from database
+        """
+        index = RatePlanIndex.active()
+        if index is None:
+            if for_provider:
+                queryset = cls._get_provider_queryset(
+                    detail_model.objects,
+                    owner_id, service_id, date_from, date_to, booked, contract_code)
+            else:
+                queryset = cls._get_agency_queryset(
+                    detail_model.objects,
+                    owner_id, service_id, date_from, date_to, booked, contract_code)
+            if paxes is not None:
+                # pax range filtering
+                queryset = queryset.filter(
+                    (Q(pax_range_min=0) & Q(pax_range_max__gte=paxes)) |
+                    (Q(pax_range_min__lte=paxes) & Q(pax_range_max__gte=paxes)) |
+                    (Q(pax_range_min__lte=paxes) & Q(pax_range_max=0)) |
+                    (Q(pax_range_min=0) & Q(pax_range_max=0))
+                )
+            # addon filtering
+            if addon_id:
+                queryset = queryset.filter(addon_id=addon_id)
+            else:
+                queryset = queryset.filter(addon_id=ADDON_FOR_NO_ADDON)
+
+            def catalog_details(**detail_filter):
+                return list(queryset.filter(**detail_filter))
+            return catalog_details
+
+        details = [
+            detail for detail in index.details(
+                detail_model, for_provider, owner_id, service_id,
+                date_from, date_to, booked, contract_code)
+            if (paxes is None or pax_range_matches(detail, paxes))
+            and addon_matches(detail, addon_id)]
+
+        def catalog_details(**detail_filter):
+            return [
+                detail for detail in details
+                if all(same_id(getattr(detail, field), value)
+                       for field, value in detail_filter.items())]
+        return catalog_details
 
     @classmethod
     def _get_provider_queryset(
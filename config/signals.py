@@ -0,0 +1,72 @@
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.signals import setting_changed
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from config.models import (
+    Allotment, Transfer, Extra,
+    ProviderAllotmentService, ProviderAllotmentDetail,
+    AgencyAllotmentService, AgencyAllotmentDetail,
+    ProviderTransferService, ProviderTransferDetail,
+    AgencyTransferService, AgencyTransferDetail,
+    ProviderExtraService, ProviderExtraDetail,
+    AgencyExtraService, AgencyExtraDetail,
+)
+from config.pricing import pricing_cache
+
+
+@receiver(setting_changed)
+def pricing_setting_changed(setting, **kwargs):
+    if setting in ('CACHES', 'PRICING_CACHE_BACKEND', 'PRICING_CACHE_SIZE', 'PRICING_CACHE_TIMEOUT'):
+        pricing_cache.reset()
+
+
+# Services
+
+@receiver((post_save, post_delete), sender=Allotment)
+@receiver((post_save, post_delete), sender=Transfer)
+@receiver((post_save, post_delete), sender=Extra)
+def post_change_service(sender, instance, **kwargs):
+    pricing_cache.invalidate_on_commit(instance.pk)
+
+
+# Catalogs
+
+@receiver((post_save, post_delete), sender=ProviderAllotmentService)
+@receiver((post_save, post_delete), sender=ProviderTransferService)
+@receiver((post_save, post_delete), sender=ProviderExtraService)
+def post_change_provider_catalog(sender, instance, **kwargs):
+    pricing_cache.invalidate_on_commit(instance.service_id, True, instance.provider_id)
+
+
+@receiver((post_save, post_delete), sender=AgencyAllotmentService)
+@receiver((post_save, post_delete), sender=AgencyTransferService)
+@receiver((post_save, post_delete), sender=AgencyExtraService)
+def post_change_agency_catalog(sender, instance, **kwargs):
+    pricing_cache.invalidate_on_commit(instance.service_id, False, instance.agency_id)
+
+
+# Details
+
+@receiver((post_save, post_delete), sender=ProviderAllotmentDetail)
+@receiver((post_save, post_delete), sender=ProviderTransferDetail)
+@receiver((post_save, post_delete), sender=ProviderExtraDetail)
+def post_change_provider_detail(sender, instance, **kwargs):
+    try:
+        catalog = instance.provider_service
+    except ObjectDoesNotExist:
+        # deleted along with its catalog, invalidated by catalog signal
+        return
+    post_change_provider_catalog(sender, catalog)
+
+
+@receiver((post_save, post_delete), sender=AgencyAllotmentDetail)
+@receiver((post_save, post_delete), sender=AgencyTransferDetail)
+@receiver((post_save, post_delete), sender=AgencyExtraDetail)
+def post_change_agency_detail(sender, instance, **kwargs):
+    try:
+        catalog = instance.agency_service
+    except ObjectDoesNotExist:
+        # deleted along with its catalog, invalidated by catalog signal
+        return
+    post_change_agency_catalog(sender, catalog)
@@ -1,3 +1,348 @@
-from django.test import TestCase
+import json
+import shutil
+import tempfile
+from datetime import date
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from config.constants import AMOUNTS_BY_PAX, BOARD_TYPES
+from config.models import (
+    Addon, RoomType, Allotment,
+    ProviderAllotmentService, ProviderAllotmentDetail,
+    AgencyAllotmentService, AgencyAllotmentDetail,
+    ProviderTransferService, ProviderTransferDetail,
+    AgencyTransferService, AgencyTransferDetail,
+    ProviderExtraService, ProviderExtraDetail,
+    AgencyExtraService, AgencyExtraDetail,
+)
+from config.pricing import AmountsRequest
+from config.services import ConfigServices
+from finance.models import Agency, Provider
+from reservas.custom_settings import ADDON_FOR_NO_ADDON
+
+
+def pax_group(adults, children=0, free_adults=0, free_children=0):
+    return {0: adults, 1: children, 2: free_adults, 3: free_children}
+
+
+class ConfigBaseMixin(object):
+
+    def setUp(self):
+        ConfigServices.clear_pricing_cache()
+        Addon.objects.create(pk=ADDON_FOR_NO_ADDON, name='No Addon')
+        self.test_provider = Provider.objects.create(name='Test Provider')
+        self.test_agency = Agency.objects.create(name='Test Agency')
+        self.test_room_type = RoomType.objects.create(name='Standard')
+        self.test_board_type = BOARD_TYPES[0][0]
+        self.test_allotment = Allotment.objects.create(
+            name='Test Hotel', cost_type=AMOUNTS_BY_PAX)
+        self.create_allotment_season(date(2020, 1, 1), date(2020, 1, 31), 100, 80)
+        self.create_allotment_season(date(2020, 2, 1), date(2020, 3, 31), 110, 90)
+
+    def create_allotment_season(self, date_from, date_to, sgl_amount, dbl_amount):
+        provider_service = ProviderAllotmentService.objects.create(
+            provider=self.test_provider, service=self.test_allotment,
+            date_from=date_from, date_to=date_to)
+        ProviderAllotmentDetail.objects.create(
+            provider_service=provider_service,
+            room_type=self.test_room_type, board_type=self.test_board_type,
+            ad_1_amount=sgl_amount, ad_2_amount=dbl_amount)
+        agency_service = AgencyAllotmentService.objects.create(
+            agency=self.test_agency, service=self.test_allotment,
+            date_from=date_from, date_to=date_to)
+        AgencyAllotmentDetail.objects.create(
+            agency_service=agency_service,
+            room_type=self.test_room_type, board_type=self.test_board_type,
+            ad_1_amount=sgl_amount + 20, ad_2_amount=dbl_amount + 20)
+
+    def allotment_amounts(self, date_from, date_to, groups):
+        return ConfigServices.allotment_amounts(
+            self.test_allotment.pk, date_from, date_to, groups, groups,
+            self.test_provider, None, '', self.test_agency,
+            self.test_board_type, self.test_room_type.pk)
+
+
+class ConfigBaseTestCase(ConfigBaseMixin, TestCase):
+    pass
+
+
+class ConfigServicesTestCase(ConfigBaseTestCase):
+
+    def test_allotment_amounts_across_seasons(self):
+        """
+        Does allotment amounts for a stay covering two seasons
+        """
+        cost, cost_msg, price, price_msg = self.allotment_amounts(
+            date(2020, 1, 30), date(2020, 2, 2), [pax_group(2)])
+
+        self.assertEqual(float(cost), 2 * 2 * 80 + 2 * 90)
+        self.assertEqual(float(price), 2 * 2 * 100 + 2 * 110)
+
+    def test_allotment_amounts_not_found_for_date(self):
+        """
+        Does allotment amounts for a stay ending after last season
+        """
+        cost, cost_msg, price, price_msg = self.allotment_amounts(
+            date(2020, 3, 30), date(2020, 4, 2), [pax_group(1)])
+
+        self.assertIsNone(cost)
+        self.assertEqual(cost_msg, 'Amount Not Found for date 2020-04-01')
+        self.assertIsNone(price)
+
+    def test_find_groups_amounts(self):
+        """
+        Does groups amounts in one pass with a group without amounts
+        """
+        detail_list = list(ProviderAllotmentDetail.objects.order_by(
+            'provider_service__date_from', '-provider_service__date_to'))
+
+        results = ConfigServices.find_groups_amounts(
+            True, self.test_allotment, date(2020, 1, 30), date(2020, 2, 2),
+            [pax_group(2), pax_group(3), pax_group(0), pax_group(2)],
+            None, None, detail_list)
+
+        self.assertEqual(results, [
+            (2 * 2 * 80 + 2 * 90, ''),
+            (None, 'Amount Not Found for date 2020-01-30'),
+            (0, ''),
+            (2 * 2 * 80 + 2 * 90, ''),
+        ])
+
+    def test_find_detail_amount(self):
+        """
+        Does detail amounts by occupancy with child discount fallback
+        """
+        self.test_allotment.child_discount_percent = 50
+        detail = ProviderAllotmentDetail.objects.filter(
+            provider_service__date_from=date(2020, 1, 1)).get()
+        detail.ch_1_ad_2_amount = 30
+
+        def find_detail_amount(*paxes):
+            return ConfigServices.find_detail_amount(self.test_allotment, detail, *paxes)
+
+        self.assertEqual(find_detail_amount(1, 0), 100)
+        self.assertEqual(find_detail_amount(2, 0, 1), 80)
+        self.assertEqual(find_detail_amount(2, 1), 2 * 80 + 30)
+        self.assertEqual(find_detail_amount(2, 2), 2 * 80 + 2 * 40)
+        self.assertEqual(find_detail_amount(2, 2, 0, 1), 2 * 80 + 30)
+        self.assertIsNone(find_detail_amount(3, 0))
+        self.assertIsNone(find_detail_amount(0, 1))
+
+    def test_rate_plan_index_amounts(self):
+        """
+        Does allotment amounts with an active rate plan index
+        """
+        stays = [
+            (date(2020, 1, 30), date(2020, 2, 2), [pax_group(2)]),
+            (date(2020, 1, 2), date(2020, 1, 9), [pax_group(1), pax_group(2)]),
+            (date(2020, 3, 30), date(2020, 4, 2), [pax_group(1)]),
+        ]
+        expected = [self.allotment_amounts(*stay) for stay in stays]
+        ConfigServices.clear_pricing_cache()
+
+        with ConfigServices.rate_plan_index() as index:
+            self.assertEqual(self.allotment_amounts(*stays[0]), expected[0])
+            self.assertEqual(index.loaded_plans, 2)
+            # rate plans already loaded
+            with self.assertNumQueries(0):
+                for stay, amounts in zip(stays, expected):
+                    self.assertEqual(self.allotment_amounts(*stay), amounts)
+
+    def test_batch_amounts(self):
+        """
+        Does batch amounts with constant queries
+        """
+        stays = [
+            (date(2020, 1, 30), date(2020, 2, 2), [pax_group(2)]),
+            (date(2020, 1, 2), date(2020, 1, 9), [pax_group(1), pax_group(2)]),
+            (date(2020, 3, 30), date(2020, 4, 2), [pax_group(1)]),
+        ]
+        expected = [self.allotment_amounts(*stay) for stay in stays]
+        ConfigServices.clear_pricing_cache()
+        requests = [
+            AmountsRequest(
+                service=self.test_allotment,
+                date_from=date_from, date_to=date_to,
+                cost_groups=groups, price_groups=groups,
+                provider=self.test_provider, agency=self.test_agency,
+                booked=None, contract_code='',
+                board_type=self.test_board_type, room_type_id=self.test_room_type.pk)
+            for date_from, date_to, groups in stays]
+
+        # services, provider details and agency details
+        with self.assertNumQueries(3):
+            self.assertEqual(ConfigServices.batch_amounts(requests), expected)
+
+    def test_pricing_cache_disabled(self):
+        """
+        Does amounts computed each time without a shared cache backend
+        """
+        stay = (date(2020, 1, 30), date(2020, 2, 2), [pax_group(2)])
+        for alias in [None, 'default']:
+            with self.settings(PRICING_CACHE_BACKEND=alias):
+                self.allotment_amounts(*stay)
+                self.allotment_amounts(*stay)
+                stats = ConfigServices.pricing_cache_stats()
+                self.assertEqual((stats['size'], stats['hits'], stats['misses']), (0, 0, 0))
+
+
+class PricingCacheTestCase(ConfigBaseMixin, TransactionTestCase):
+
+    def setUp(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        caches_setting = dict(settings.CACHES)
+        caches_setting['pricing'] = dict(
+            BACKEND='django.core.cache.backends.filebased.FileBasedCache', LOCATION=location)
+        shared_cache = override_settings(CACHES=caches_setting, PRICING_CACHE_BACKEND='pricing')
+        shared_cache.enable()
+        self.addCleanup(shared_cache.disable)
+        super(PricingCacheTestCase, self).setUp()
+        self.stay = (date(2020, 1, 30), date(2020, 2, 2), [pax_group(2)])
+        self.detail = ProviderAllotmentDetail.objects.get(
+            provider_service__date_from=date(2020, 2, 1))
+
+    def generation(self):
+        return caches['pricing'].get('config.pricing.generation.%s' % self.test_allotment.pk, 0)
+
+    def test_pricing_cache(self):
+        """
+        Does cached allotment amounts invalidated on detail change
+        """
+        amounts = self.allotment_amounts(*self.stay)
+        stats = ConfigServices.pricing_cache_stats()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.allotment_amounts(*self.stay), amounts)
+        self.assertEqual(ConfigServices.pricing_cache_stats()['hits'], stats['hits'] + 2)
+
+        self.detail.ad_2_amount = 95
+        self.detail.save()
+
+        cost, cost_msg, price, price_msg = self.allotment_amounts(*self.stay)
+        self.assertEqual(float(cost), 2 * 2 * 80 + 2 * 95)
+        self.assertEqual(price, amounts[2])
+
+    def test_pricing_cache_invalidated_on_commit(self):
+        """
+        Does detail change invalidate other processes entries on commit only
+        """
+        self.allotment_amounts(*self.stay)
+        generation = self.generation()
+
+        with transaction.atomic():
+            self.detail.ad_2_amount = 95
+            self.detail.save()
+            self.assertEqual(self.generation(), generation)
+            # changing transaction does not read nor cache its own changes
+            cost, cost_msg, price, price_msg = self.allotment_amounts(*self.stay)
+            self.assertEqual(float(cost), 2 * 2 * 80 + 2 * 95)
+        self.assertEqual(self.generation(), generation + 1)
+
+        # local entries of other processes are checked against generation
+        ConfigServices.clear_pricing_cache()
+        cost, cost_msg, price, price_msg = self.allotment_amounts(*self.stay)
+        self.assertEqual(float(cost), 2 * 2 * 80 + 2 * 95)
+
+        with self.assertRaises(ValueError), transaction.atomic():
+            self.detail.ad_2_amount = 70
+            self.detail.save()
+            raise ValueError()
+        self.assertEqual(self.generation(), generation + 1)
+        with self.assertNumQueries(0):
+            self.allotment_amounts(*self.stay)
+
+
+def explain_tables(node):
+    """
+    yields table entries of a mysql json query plan
+    """
+    if isinstance(node, dict):
+        if 'table_name' in node:
+            yield node
+        for value in node.values():
+            for table in explain_tables(value):
+                yield table
+    elif isinstance(node, list):
+        for value in node:
+            for table in explain_tables(value):
+                yield table
+
+
+class CatalogIndexesTestCase(TestCase):
+
+    lookups = [
+        ('provider', ConfigServices._get_provider_queryset,
+         ProviderAllotmentService, ProviderAllotmentDetail,
+         dict(room_type_id=1, board_type=BOARD_TYPES[0][0])),
+        ('agency', ConfigServices._get_agency_queryset,
+         AgencyAllotmentService, AgencyAllotmentDetail,
+         dict(room_type_id=1, board_type=BOARD_TYPES[0][0])),
+        ('provider', ConfigServices._get_provider_queryset,
+         ProviderTransferService, ProviderTransferDetail,
+         dict(location_from_id=1, location_to_id=2)),
+        ('agency', ConfigServices._get_agency_queryset,
+         AgencyTransferService, AgencyTransferDetail,
+         dict(location_from_id=1, location_to_id=2)),
+        ('provider', ConfigServices._get_provider_queryset,
+         ProviderExtraService, ProviderExtraDetail, dict()),
+        ('agency', ConfigServices._get_agency_queryset,
+         AgencyExtraService, AgencyExtraDetail, dict()),
+    ]
+
+    def table_indexes(self, model):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(
+                cursor, model._meta.db_table)
+        return dict(
+            (name, constraint['columns']) for name, constraint in constraints.items()
+            if constraint['index'] or constraint['unique'])
+
+    def explain_lookup(self, get_queryset, detail_model, explain_format=None, **detail_filter):
+        queryset = get_queryset(
+            detail_model.objects, 1, 1, date(2020, 1, 1), date(2020, 1, 5),
+            date(2019, 12, 1), '')
+        return queryset.filter(addon_id=ADDON_FOR_NO_ADDON, **detail_filter).explain(
+            format=explain_format)
+
+    def test_catalog_lookup_indexes(self):
+        """
+        Does catalog tables indexes leading with lookups equality filters
+        """
+        for owner, get_queryset, catalog_model, detail_model, detail_filter in self.lookups:
+            catalog_indexes = self.table_indexes(catalog_model)
+            self.assertEqual(
+                catalog_indexes.get(catalog_model._meta.indexes[0].name),
+                ['%s_id' % owner, 'service_id', 'contract_code', 'date_from', 'date_to'])
+
+            detail_columns = set(['addon_id'] + [
+                detail_model._meta.get_field(name).column for name in detail_filter])
+            self.assertTrue(any(
+                columns[0] == '%s_service_id' % owner and detail_columns.issubset(columns)
+                for columns in self.table_indexes(detail_model).values()))
+
+    def test_catalog_lookups_use_indexes(self):
+        """
+        Does catalog date window lookups searching indexes instead of scanning
+        """
+        if connection.vendor not in ['sqlite', 'mysql']:
+            self.skipTest('query plan checked on sqlite and mysql')
+        for owner, get_queryset, catalog_model, detail_model, detail_filter in self.lookups:
+            index_name = catalog_model._meta.indexes[0].name
+            if connection.vendor == 'mysql':
+                plan = json.loads(self.explain_lookup(
+                    get_queryset, detail_model, 'json', **detail_filter))
+                tables = dict(
+                    (table['table_name'], table) for table in explain_tables(plan))
+                self.assertIn(
+                    index_name, tables[catalog_model._meta.db_table].get('possible_keys', []))
+                for model in [catalog_model, detail_model]:
+                    self.assertIsNotNone(tables[model._meta.db_table].get('key'))
+            else:
+                plan = self.explain_lookup(get_queryset, detail_model, **detail_filter)
+                self.assertIn(index_name, plan)
+                for model in [catalog_model, detail_model]:
+                    self.assertNotRegex(plan, r'SCAN (TABLE )?%s\b' % model._meta.db_table)
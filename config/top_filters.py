@@ -51,7 +51,6 @@ class ProviderDetailTransferTopFilter(filters.ForeignKeyFilter):
     def queryset(self, request, queryset):
         search_option = self._values[0]
         if search_option and search_option != []:
-            queryset = queryset.distinct()
             queryset = queryset.filter(
                 Q(provider_service__service__in=search_option))
         return queryset
@@ -66,7 +65,6 @@ class TransferDetailProviderTopFilter(filters.ForeignKeyFilter):
     def queryset(self, request, queryset):
         search_option = self._values[0]
         if search_option and search_option != []:
-            queryset = queryset.distinct()
             queryset = queryset.filter(
                 Q(provider_service__provider__in=search_option))
         return queryset
@@ -86,7 +84,6 @@ class ProviderTransferDetailLocationTopFilter(filters.ForeignKeyFilter):
     def queryset(self, request, queryset):
         search_option = self._values[0]
         if search_option and search_option != []:
-            queryset = queryset.distinct()
             if len(search_option) == 1:
                 queryset = queryset.filter(
                     Q(location_from=search_option[0]) |
@@ -112,10 +109,10 @@ class ProviderTransferLocationTopFilter(filters.ForeignKeyFilter):
     def queryset(self, request, queryset):
         search_option = self._values[0]
         if search_option and search_option != []:
-            queryset = queryset.distinct()
-            queryset = queryset.filter(
-                Q(providertransferdetail__location_from__in=search_option) |
-                Q(providertransferdetail__location_to__in=search_option))
+            queryset = filters.filter_related(
+                queryset, 'providertransferdetail',
+                Q(location_from__in=search_option) |
+                Q(location_to__in=search_option))
         return queryset
 
 
@@ -128,10 +125,10 @@ class ProviderTransferLocationAdditionalTopFilter(filters.ForeignKeyFilter):
     def queryset(self, request, queryset):
         search_option = self._values[0]
         if search_option and search_option != []:
-            queryset = queryset.distinct()
-            queryset = queryset.filter(
-                Q(providertransferdetail__location_from__in=search_option) |
-                Q(providertransferdetail__location_to__in=search_option))
+            queryset = filters.filter_related(
+                queryset, 'providertransferdetail',
+                Q(location_from__in=search_option) |
+                Q(location_to__in=search_option))
         return queryset
 
 
@@ -144,10 +141,10 @@ class AgencyTransferLocationTopFilter(filters.ForeignKeyFilter):
     def queryset(self, request, queryset):
         search_option = self._values[0]
         if search_option and search_option != []:
-            queryset = queryset.distinct()
-            queryset = queryset.filter(
-                Q(agencytransferdetail__location_from__in=search_option) |
-                Q(agencytransferdetail__location_to__in=search_option))
+            queryset = filters.filter_related(
+                queryset, 'agencytransferdetail',
+                Q(location_from__in=search_option) |
+                Q(location_to__in=search_option))
         return queryset
 
 
@@ -160,10 +157,10 @@ class AgencyTransferLocationAdditionalTopFilter(filters.ForeignKeyFilter):
     def queryset(self, request, queryset):
         search_option = self._values[0]
         if search_option and search_option != []:
-            queryset = queryset.distinct()
-            queryset = queryset.filter(
-                Q(agencytransferdetail__location_from__in=search_option) |
-                Q(agencytransferdetail__location_to__in=search_option))
+            queryset = filters.filter_related(
+                queryset, 'agencytransferdetail',
+                Q(location_from__in=search_option) |
+                Q(location_to__in=search_option))
         return queryset
 
 
@@ -48,6 +48,7 @@ from accounting.common_site import MENU_LABEL_ACCOUNTING
 from booking.services import BookingServices
 from common.sites import SiteModel, CommonChangeList, CommonTabularInline
 from reservas.admin import bookings_site
+from reservas.utils import retry_on_deadlock
 
 MENU_LABEL_FINANCE_BASIC = 'Finance Basic'
 MENU_LABEL_FINANCE_LOAN = 'Finance Loan'
@@ -73,6 +74,8 @@ class FinantialDocumentSiteModel(SiteModel):
     list_display = ('name', 'currency', 'amount', 'date', 'status')
     top_filters = ('name', 'currency', 'status', 'date')
     ordering = ['-date', 'currency', 'status']
+    keyset_pagination = True
+    export_allowed = True
 
     def get_changelist(self, request, **kwargs):
         """
@@ -214,6 +217,14 @@ class MatchableSiteModel(BaseFinantialDocumentSiteModel):
     def save_matches(self, parent, matches):
         pass
 
+    @retry_on_deadlock
+    def save_matches_atomic(self, parent, matches):
+        """
+        Saves matches in one transaction, rerun when it is a deadlock victim
+        """
+        with transaction.atomic(savepoint=False):
+            return self.save_matches(parent, matches)
+
     def _match_view(self, request, object_id, extra_context=None):
         """
         The 'match list' view for this model.
@@ -296,7 +307,7 @@ class MatchableSiteModel(BaseFinantialDocumentSiteModel):
             if formset.is_valid():
                 matches = self.build_matches(formset.forms)
                 try:
-                    self.save_matches(obj, matches)
+                    self.save_matches_atomic(obj, matches)
                     msg = "Matched successfully."
                     self.message_user(request, msg, messages.SUCCESS)
                 except ValidationError as ex:
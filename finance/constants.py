@@ -98,3 +98,17 @@ ERROR_MATCH_PROVIDER = 'Can not change Provider if document has matches'
 ERROR_MATCH_STATUS = 'Can not change Status from Ready if document has matches'
 ERROR_MATCH_WITHOUT_AMOUNT = 'Amount (%s) Insufficient for total matching (%s)'
 ERROR_NOT_READY = '%s Status must be Ready'
+ERROR_MATCH_POLICY = 'Unknown Match Policy %s'
+
+AGENCY_CREDIT_DOC_TYPES = [DOC_TYPE_AGENCY_PAYMENT, DOC_TYPE_AGENCY_DISCOUNT]
+PROVIDER_CREDIT_DOC_TYPES = [DOC_TYPE_PROVIDER_PAYMENT, DOC_TYPE_PROVIDER_DISCOUNT]
+
+# automatic matching order of debit documents
+MATCH_POLICY_OLDEST = 'oldest'
+MATCH_POLICY_CONTENT_DATE = 'content_date'
+MATCH_POLICY_EXACT_AMOUNT = 'exact_amount'
+MATCH_POLICIES = (
+    (MATCH_POLICY_OLDEST, 'Oldest First'),
+    (MATCH_POLICY_CONTENT_DATE, 'By Booking Date'),
+    (MATCH_POLICY_EXACT_AMOUNT, 'Exact Amount First'),
+)
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from finance.reconciliation import SummaryReconciliation, SUMMARIES
+
+
+class Command(BaseCommand):
+    help = 'Recomputes finance summaries and documents matched amounts, repairing drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'summaries', nargs='*',
+            help='Summaries to check, all by default: %s' % ', '.join(
+                spec['name'] for spec in SUMMARIES))
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report drift')
+
+    def handle(self, *args, **options):
+        names = [spec['name'] for spec in SUMMARIES]
+        for name in options['summaries']:
+            if name not in names:
+                raise CommandError('Unknown summary %s' % name)
+        start = time.time()
+        drifts = SummaryReconciliation.reconcile(
+            names=options['summaries'], fix=not options['dry_run'], log=self.stdout.write)
+        for drift in drifts:
+            self.stdout.write('%s %s %s: stored %s computed %s' % (
+                drift['model'], drift['id'] or drift['key'], drift['field'],
+                drift['stored'], drift['computed']))
+        self.stdout.write('%s drifts %s in %.3fs' % (
+            len(drifts), 'found' if options['dry_run'] else 'fixed', time.time() - start))
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
-from django.db import connection, models
+from django.db import models
 from django.core.exceptions import ValidationError
 from django.conf import settings
 from django.utils.timezone import now
@@ -235,143 +235,31 @@ class LoanEntityCurrency(SummaryModel):
         return '%s (%s)' % (self.loan_entity.name, self.get_currency_display())
 
     def fix_credit_amount(self):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_loanentitycurrency lec SET lec.credit_amount = (
-                    SELECT COALESCE(SUM(fd.amount), 0)
-                    FROM finance_loanentitydeposit ledd
-                        INNER JOIN finance_loanentitydocument led
-                            ON led.finantialdocument_ptr_id = ledd.loanentitydocument_ptr_id
-                        INNER JOIN finance_finantialdocument fd
-                            ON fd.id = led.finantialdocument_ptr_id
-                    WHERE led.loan_entity_id = lec.loan_entity_id
-                        AND fd.currency = lec.currency
-                        AND fd.status = %s)
-                WHERE lec.id = %s
-                """, [STATUS_READY, self.pk])
-            self.refresh_from_db()
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_summary(self, ['credit_amount'])
 
     @classmethod
     def fix_credit_amounts(cls):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_loanentitycurrency lec SET lec.credit_amount = (
-                    SELECT COALESCE(SUM(fd.amount), 0)
-                    FROM finance_loanentitydeposit ledd
-                        INNER JOIN finance_loanentitydocument led
-                            ON led.finantialdocument_ptr_id = ledd.loanentitydocument_ptr_id
-                        INNER JOIN finance_finantialdocument fd
-                            ON fd.id = led.finantialdocument_ptr_id
-                    WHERE led.loan_entity_id = lec.loan_entity_id
-                        AND fd.currency = lec.currency
-                        AND fd.status = %s)
-            """, [STATUS_READY])
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_summaries(cls, ['credit_amount'])
 
     def fix_debit_amount(self):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_loanentitycurrency lec SET lec.credit_amount = (
-                    SELECT COALESCE(SUM(fd.amount), 0)
-                    FROM finance_loanentitywithdraw lew
-                        INNER JOIN finance_loanentitydocument led
-                            ON led.finantialdocument_ptr_id = lew.loanentitydocument_ptr_id
-                        INNER JOIN finance_finantialdocument fd
-                            ON fd.id = led.finantialdocument_ptr_id
-                    WHERE led.loan_entity_id = lec.loan_entity_id
-                        AND fd.currency = lec.currency
-                        AND fd.status = %s)
-                WHERE lec.id = %s
-                """, [STATUS_READY, self.pk])
-            self.refresh_from_db()
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_summary(self, ['debit_amount'])
 
     @classmethod
     def fix_debit_amounts(cls):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_loanentitycurrency lec SET lec.credit_amount = (
-                    SELECT COALESCE(SUM(fd.amount), 0)
-                    FROM finance_loanentitywithdraw lew
-                        INNER JOIN finance_loanentitydocument led
-                            ON led.finantialdocument_ptr_id = lew.loanentitydocument_ptr_id
-                        INNER JOIN finance_finantialdocument fd
-                            ON fd.id = led.finantialdocument_ptr_id
-                    WHERE led.loan_entity_id = lec.loan_entity_id
-                        AND fd.currency = lec.currency
-                        AND fd.status = %s)
-            """, [STATUS_READY])
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_summaries(cls, ['debit_amount'])
 
     def fix_matched_amount(self):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_loanentitycurrency lec SET lec.matched_amount = (
-                    SELECT COALESCE(SUM(lem.matched_amount), 0)
-                    FROM finance_loanentitymatch lem
-                        INNER JOIN finance_loanentitydeposit ledd
-                            ON ledd.loanentitydocument_ptr_id = lem.loan_entity_deposit_id
-                        INNER JOIN finance_loanentitydocument led1
-                            ON led1.finantialdocument_ptr_id = ledd.loanentitydocument_ptr_id
-                        INNER JOIN finance_finantialdocument fd1
-                            ON fd1.id = led1.finantialdocument_ptr_id
-                        INNER JOIN finance_loanentitywithdraw lew
-                            ON lew.loanentitydocument_ptr_id = lem.loan_entity_withdraw_id
-                        INNER JOIN finance_loanentitydocument led2
-                            ON led2.finantialdocument_ptr_id = lew.loanentitydocument_ptr_id
-                        INNER JOIN finance_finantialdocument fd2
-                            ON fd2.id = led2.finantialdocument_ptr_id
-                    WHERE led1.loan_entity_id = lec.loan_entity_id
-                        AND led2.loan_entity_id = lec.loan_entity_id
-                        AND fd1.currency = lec.currency
-                        AND fd2.currency = lec.currency
-                        AND fd1.status = %s
-                        AND fd2.status = fd1.status)
-                WHERE lec.id = %s
-                """, [STATUS_READY, self.pk])
-            self.refresh_from_db()
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_summary(self, ['matched_amount'])
 
     @classmethod
     def fix_matched_amounts(cls):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_loanentitycurrency lec SET lec.matched_amount = (
-                    SELECT COALESCE(SUM(lem.matched_amount), 0)
-                    FROM finance_loanentitymatch lem
-                        INNER JOIN finance_loanentitydeposit ledd
-                            ON ledd.loanentitydocument_ptr_id = lem.loan_entity_deposit_id
-                        INNER JOIN finance_loanentitydocument led1
-                            ON led1.finantialdocument_ptr_id = ledd.loanentitydocument_ptr_id
-                        INNER JOIN finance_finantialdocument fd1
-                            ON fd1.id = led1.finantialdocument_ptr_id
-                        INNER JOIN finance_loanentitywithdraw lew
-                            ON lew.loanentitydocument_ptr_id = lem.loan_entity_withdraw_id
-                        INNER JOIN finance_loanentitydocument led2
-                            ON led2.finantialdocument_ptr_id = lew.loanentitydocument_ptr_id
-                        INNER JOIN finance_finantialdocument fd2
-                            ON fd2.id = led2.finantialdocument_ptr_id
-                    WHERE led1.loan_entity_id = lec.loan_entity_id
-                        AND led2.loan_entity_id = lec.loan_entity_id
-                        AND fd1.currency = lec.currency
-                        AND fd2.currency = lec.currency
-                        AND fd1.status = %s
-                        AND fd2.status = fd1.status)
-            """, [STATUS_READY])
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_summaries(cls, ['matched_amount'])
 
 
 class LoanEntityDocument(LoanDocument):
@@ -395,45 +283,13 @@ class LoanEntityDeposit(LoanEntityDocument):
             self.date, account, self.amount, account.get_currency_display(), loan_entity)
 
     def fix_matched_amount(self):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_loanentitydocument led SET led.matched_amount = (
-                    SELECT COALESCE(
-                        CASE WHEN fd1.status != %s THEN 0 ELSE SUM(lem.matched_amount) END,
-                        0)
-                    FROM finance_loanentitymatch lem
-                        INNER JOIN finance_finantialdocument fd1
-                            ON fd1.id = lem.loan_entity_deposit_id
-                        INNER JOIN finance_finantialdocument fd2
-                            ON fd2.id = lem.loan_entity_withdraw_id
-                    WHERE fd1.id = led.finantialdocument_ptr_id
-                        AND fd2.status = fd1.status)
-                WHERE led.finantialdocument_ptr_id = %s
-                """, [STATUS_READY, self.pk])
-            self.refresh_from_db()
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_document(self)
 
     @classmethod
     def fix_matched_amounts(cls):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_loanentitydocument led SET led.matched_amount = (
-                    SELECT COALESCE(
-                        CASE WHEN fd1.status != %s THEN 0 ELSE SUM(lem.matched_amount) END,
-                        0)
-                    FROM finance_loanentitymatch lem
-                        INNER JOIN finance_finantialdocument fd1
-                            ON fd1.id = lem.loan_entity_deposit_id
-                        INNER JOIN finance_finantialdocument fd2
-                            ON fd2.id = lem.loan_entity_withdraw_id
-                    WHERE fd1.id = led.finantialdocument_ptr_id
-                        AND fd2.status = fd1.status)
-            """, [STATUS_READY])
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_documents(cls)
 
 
 class LoanEntityWithdraw(LoanEntityDocument):
@@ -449,45 +305,13 @@ class LoanEntityWithdraw(LoanEntityDocument):
             self.date, account, self.amount, account.get_currency_display(), loan_entity)
 
     def fix_matched_amount(self):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_loanentitydocument led SET led.matched_amount = (
-                    SELECT COALESCE(
-                        CASE WHEN fd1.status != %s THEN 0 ELSE SUM(lem.matched_amount) END,
-                        0)
-                    FROM finance_loanentitymatch lem
-                        INNER JOIN finance_finantialdocument fd1
-                            ON fd1.id = lem.loan_entity_withdraw_id
-                        INNER JOIN finance_finantialdocument fd2
-                            ON fd2.id = lem.loan_entity_deposit_id
-                    WHERE fd1.id = led.finantialdocument_ptr_id
-                        AND fd2.status = fd1.status)
-                WHERE led.finantialdocument_ptr_id = %s
-                """, [STATUS_READY, self.pk])
-            self.refresh_from_db()
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_document(self)
 
     @classmethod
     def fix_matched_amounts(cls):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_loanentitydocument led SET led.matched_amount = (
-                    SELECT COALESCE(
-                        CASE WHEN fd1.status != %s THEN 0 ELSE SUM(lem.matched_amount) END,
-                        0)
-                    FROM finance_loanentitymatch lem
-                        INNER JOIN finance_finantialdocument fd1
-                            ON fd1.id = lem.loan_entity_withdraw_id
-                        INNER JOIN finance_finantialdocument fd2
-                            ON fd2.id = lem.loan_entity_deposit_id
-                    WHERE fd1.id = led.finantialdocument_ptr_id
-                        AND fd2.status = fd1.status)
-            """, [STATUS_READY])
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_documents(cls)
 
 
 class LoanEntityMatch(models.Model):
@@ -513,135 +337,31 @@ class LoanAccount(SummaryModel):
         return self.account.__str__()
 
     def fix_credit_amount(self):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_loanaccount la SET la.credit_amount = (
-                    SELECT COALESCE(SUM(fd.amount), 0)
-                    FROM finance_loanaccountdeposit ladd
-                        INNER JOIN finance_loanaccountdocument lad
-                            ON lad.finantialdocument_ptr_id = ladd.loanaccountdocument_ptr_id
-                        INNER JOIN finance_finantialdocument fd
-                            ON fd.id = lad.finantialdocument_ptr_id
-                    WHERE lad.loan_account_id = la.account_id
-                        AND fd.status = %s)
-                WHERE la.id = %s
-                """, [STATUS_READY, self.pk])
-            self.refresh_from_db()
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_summary(self, ['credit_amount'])
 
     @classmethod
     def fix_credit_amounts(cls):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_loanaccount la SET la.credit_amount = (
-                    SELECT COALESCE(SUM(fd.amount), 0)
-                    FROM finance_loanaccountdeposit ladd
-                        INNER JOIN finance_loanaccountdocument lad
-                            ON lad.finantialdocument_ptr_id = ladd.loanaccountdocument_ptr_id
-                        INNER JOIN finance_finantialdocument fd
-                            ON fd.id = lad.finantialdocument_ptr_id
-                    WHERE lad.loan_account_id = la.account_id
-                        AND fd.status = %s)
-            """, [STATUS_READY])
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_summaries(cls, ['credit_amount'])
 
     def fix_debit_amount(self):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_loanaccount la SET la.debit_amount = (
-                    SELECT COALESCE(SUM(fd.amount), 0)
-                    FROM finance_loanaccountwithdraw law
-                        INNER JOIN finance_loanaccountdocument lad
-                            ON lad.finantialdocument_ptr_id = law.loanaccountdocument_ptr_id
-                        INNER JOIN finance_finantialdocument fd
-                            ON fd.id = lad.finantialdocument_ptr_id
-                    WHERE lad.loan_account_id = la.account_id
-                        AND fd.status = %s)
-                WHERE la.id = %s
-                """, [STATUS_READY, self.pk])
-            self.refresh_from_db()
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_summary(self, ['debit_amount'])
 
     @classmethod
     def fix_debit_amounts(cls):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_loanaccount la SET la.debit_amount = (
-                    SELECT COALESCE(SUM(fd.amount), 0)
-                    FROM finance_loanaccountwithdraw law
-                        INNER JOIN finance_loanaccountdocument lad
-                            ON lad.finantialdocument_ptr_id = law.loanaccountdocument_ptr_id
-                        INNER JOIN finance_finantialdocument fd
-                            ON fd.id = lad.finantialdocument_ptr_id
-                    WHERE lad.loan_account_id = la.account_id
-                        AND fd.status = %s)
-            """, [STATUS_READY])
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_summaries(cls, ['debit_amount'])
 
     def fix_matched_amount(self):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_loanaccount la SET la.matched_amount = (
-                    SELECT COALESCE(SUM(lam.amount), 0)
-                    FROM finance_loanaccountmatch lam
-                        INNER JOIN finance_loanaccountdeposit ladd
-                            ON ladd.loanaccountdocument_ptr_id = lam.loan_account_deposit_id
-                        INNER JOIN finance_loanaccountdocument lad1
-                            ON lad1.finantialdocument_ptr_id = ladd.loanaccountdocument_ptr_id
-                        INNER JOIN finance_finantialdocument fd1
-                            ON fd1.id = lad1.finantialdocument_ptr_id
-                        INNER JOIN finance_loanaccountwithdraw law
-                            ON law.loanaccountdocument_ptr_id = lam.loan_account_withdraw_id
-                        INNER JOIN finance_loanaccountdocument lad2
-                            ON lad2.finantialdocument_ptr_id = law.loanaccountdocument_ptr_id
-                        INNER JOIN finance_finantialdocument fd2
-                            ON fd2.id = lad2.finantialdocument_ptr_id
-                    WHERE lad1.loan_account_id = la.account_id
-                        AND lad2.loan_account_id = la.account_id
-                        AND fd1.status = %s
-                        AND fd2.status = fd1.status)
-                WHERE la.id = %s
-                """, [STATUS_READY, self.pk])
-            self.refresh_from_db()
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_summary(self, ['matched_amount'])
 
     @classmethod
     def fix_matched_amounts(cls):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_loanaccount la SET la.matched_amount = (
-                    SELECT COALESCE(SUM(lam.amount), 0)
-                    FROM finance_loanaccountmatch lam
-                        INNER JOIN finance_loanaccountdeposit ladd
-                            ON ladd.loanaccountdocument_ptr_id = lam.loan_account_deposit_id
-                        INNER JOIN finance_loanaccountdocument lad1
-                            ON lad1.finantialdocument_ptr_id = ladd.loanaccountdocument_ptr_id
-                        INNER JOIN finance_finantialdocument fd1
-                            ON fd1.id = lad1.finantialdocument_ptr_id
-                        INNER JOIN finance_loanaccountwithdraw law
-                            ON law.loanaccountdocument_ptr_id = lam.loan_account_withdraw_id
-                        INNER JOIN finance_loanaccountdocument lad2
-                            ON lad2.finantialdocument_ptr_id = law.loanentitydocument_ptr_id
-                        INNER JOIN finance_finantialdocument fd2
-                            ON fd2.id = lad2.finantialdocument_ptr_id
-                    WHERE lad1.loan_account_id = la.account_id
-                        AND lad2.loan_account_id = la.account_id
-                        AND fd1.status = %s
-                        AND fd2.status = fd1.status)
-            """, [STATUS_READY])
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_summaries(cls, ['matched_amount'])
 
 
 class LoanAccountDocument(LoanDocument):
@@ -665,45 +385,13 @@ class LoanAccountDeposit(LoanAccountDocument):
             self.date, account, self.amount, account.get_currency_display(), loan_account)
 
     def fix_matched_amount(self):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_loanaccountdocument lad SET lad.matched_amount = (
-                    SELECT COALESCE(
-                        CASE WHEN fd1.status != %s THEN 0 ELSE SUM(lam.matched_amount) END,
-                        0)
-                    FROM finance_loanaccountmatch lam
-                        INNER JOIN finance_finantialdocument fd1
-                            ON fd1.id = lam.loan_account_deposit_id
-                        INNER JOIN finance_finantialdocument fd2
-                            ON fd2.id = lam.loan_account_withdraw_id
-                    WHERE fd1.id = lad.finantialdocument_ptr_id
-                        AND fd2.status = fd1.status)
-                WHERE lad.finantialdocument_ptr_id = %s
-                """, [STATUS_READY, self.pk])
-            self.refresh_from_db()
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_document(self)
 
     @classmethod
     def fix_matched_amounts(cls):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_loanaccountdocument lad SET lad.matched_amount = (
-                    SELECT COALESCE(
-                        CASE WHEN fd1.status != %s THEN 0 ELSE SUM(lam.matched_amount) END,
-                        0)
-                    FROM finance_loanaccountmatch lam
-                        INNER JOIN finance_finantialdocument fd1
-                            ON fd1.id = lam.loan_account_deposit_id
-                        INNER JOIN finance_finantialdocument fd2
-                            ON fd2.id = lam.loan_account_withdraw_id
-                    WHERE fd1.id = lad.finantialdocument_ptr_id
-                        AND fd2.status = fd1.status)
-            """, [STATUS_READY])
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_documents(cls)
 
 
 class LoanAccountWithdraw(LoanAccountDocument):
@@ -719,45 +407,13 @@ class LoanAccountWithdraw(LoanAccountDocument):
             self.date, account, self.amount, account.get_currency_display(), loan_account)
 
     def fix_matched_amount(self):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_loanaccountdocument lad SET lad.matched_amount = (
-                    SELECT COALESCE(
-                        CASE WHEN fd1.status != %s THEN 0 ELSE SUM(lam.matched_amount) END,
-                        0)
-                    FROM finance_loanaccountmatch lam
-                        INNER JOIN finance_finantialdocument fd1
-                            ON fd1.id = lam.loan_account_withdraw_id
-                        INNER JOIN finance_finantialdocument fd2
-                            ON fd2.id = lam.loan_account_deposit_id
-                    WHERE fd1.id = lad.finantialdocument_ptr_id
-                        AND fd2.status = fd1.status)
-                WHERE lad.finantialdocument_ptr_id = %s
-                """, [STATUS_READY, self.pk])
-            self.refresh_from_db()
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_document(self)
 
     @classmethod
     def fix_matched_amounts(cls):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_loanaccountdocument lad SET lad.matched_amount = (
-                    SELECT COALESCE(
-                        CASE WHEN fd1.status != %s THEN 0 ELSE SUM(lam.matched_amount) END,
-                        0)
-                    FROM finance_loanaccountmatch lam
-                        INNER JOIN finance_finantialdocument fd1
-                            ON fd1.id = lam.loan_account_withdraw_id
-                        INNER JOIN finance_finantialdocument fd2
-                            ON fd2.id = lam.loan_account_deposit_id
-                    WHERE fd1.id = lad.finantialdocument_ptr_id
-                        AND fd2.status = fd1.status)
-            """, [STATUS_READY])
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_documents(cls)
 
 
 class LoanAccountMatch(models.Model):
@@ -851,45 +507,13 @@ class AgencyDebitDocument(AgencyDocument):
         verbose_name_plural = 'Agencies Debits Documents'
 
     def fix_matched_amount(self):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_agencydocument ad SET ad.matched_amount = (
-                    SELECT COALESCE(
-                        CASE WHEN fd1.status != %s THEN 0 ELSE SUM(adm.matched_amount) END,
-                        0)
-                    FROM finance_agencydocumentmatch adm
-                        INNER JOIN finance_finantialdocument fd1
-                            ON fd1.id = adm.debit_document_id
-                        INNER JOIN finance_finantialdocument fd2
-                            ON fd2.id = adm.credit_document_id
-                    WHERE fd1.id = ad.finantialdocument_ptr_id
-                        AND fd2.status = fd1.status)
-                WHERE ad.finantialdocument_ptr_id = %s
-                """, [STATUS_READY, self.pk])
-            self.refresh_from_db()
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_document(self)
 
     @classmethod
     def fix_matched_amounts(cls):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_agencydocument ad SET ad.matched_amount = (
-                    SELECT COALESCE(
-                        CASE WHEN fd1.status != %s THEN 0 ELSE SUM(adm.matched_amount) END,
-                        0)
-                    FROM finance_agencydocumentmatch adm
-                        INNER JOIN finance_finantialdocument fd1
-                            ON fd1.id = adm.debdit_document_id
-                        INNER JOIN finance_finantialdocument fd2
-                            ON fd2.id = adm.credit_document_id
-                    WHERE fd1.id = ad.finantialdocument_ptr_id
-                        AND fd2.status = fd1.status)
-                """, [STATUS_READY])
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_documents(cls)
 
 
 class AgencyCreditDocument(AgencyDocument):
@@ -898,45 +522,13 @@ class AgencyCreditDocument(AgencyDocument):
         verbose_name_plural = 'Agencies Credits Documents'
 
     def fix_matched_amount(self):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_agencydocument ad SET ad.matched_amount = (
-                    SELECT COALESCE(
-                        CASE WHEN fd1.status != %s THEN 0 ELSE SUM(adm.matched_amount) END,
-                        0)
-                    FROM finance_agencydocumentmatch adm
-                        INNER JOIN finance_finantialdocument fd1
-                            ON fd1.id = adm.credit_document_id
-                        INNER JOIN finance_finantialdocument fd2
-                            ON fd2.id = adm.debit_document_id
-                    WHERE fd1.id = ad.finantialdocument_ptr_id
-                        AND fd2.status = fd1.status)
-                WHERE ad.finantialdocument_ptr_id = %s
-                """, [STATUS_READY, self.pk])
-            self.refresh_from_db()
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_document(self)
 
     @classmethod
     def fix_matched_amounts(cls):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_agencydocument ad SET ad.matched_amount = (
-                    SELECT COALESCE(
-                        CASE WHEN fd1.status != %s THEN 0 ELSE SUM(adm.matched_amount) END,
-                        0)
-                    FROM finance_agencydocumentmatch adm
-                        INNER JOIN finance_finantialdocument fd1
-                            ON fd1.id = adm.credit_document_id
-                        INNER JOIN finance_finantialdocument fd2
-                            ON fd2.id = adm.debit_document_id
-                    WHERE fd1.id = ad.finantialdocument_ptr_id
-                        AND fd2.status = fd1.status)
-                """, [STATUS_READY])
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_documents(cls)
 
 
 class AgencyInvoice(AgencyDebitDocument):
@@ -1055,45 +647,13 @@ class ProviderDebitDocument(ProviderDocument):
         verbose_name_plural = 'Providers Debits Documents'
 
     def fix_matched_amount(self):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_providerdocument pd SET pd.matched_amount = (
-                    SELECT COALESCE(
-                        CASE WHEN fd1.status != %s THEN 0 ELSE SUM(pdm.matched_amount) END,
-                        0)
-                    FROM finance_providerdocumentmatch pdm
-                        INNER JOIN finance_finantialdocument fd1
-                            ON fd1.id = pdm.debit_document_id
-                        INNER JOIN finance_finantialdocument fd2
-                            ON fd2.id = pdm.credit_document_id
-                    WHERE fd1.id = pd.finantialdocument_ptr_id
-                        AND fd2.status = fd1.status)
-                WHERE pd.finantialdocument_ptr_id = %s
-                """, [STATUS_READY, self.pk])
-            self.refresh_from_db()
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_document(self)
 
     @classmethod
     def fix_matched_amounts(cls):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_providerdocument pd SET pd.matched_amount = (
-                    SELECT COALESCE(
-                        CASE WHEN fd1.status != %s THEN 0 ELSE SUM(pdm.matched_amount) END,
-                        0)
-                    FROM finance_providerdocumentmatch pdm
-                        INNER JOIN finance_finantialdocument fd1
-                            ON fd1.id = pdm.debit_document_id
-                        INNER JOIN finance_finantialdocument fd2
-                            ON fd2.id = pdm.credit_document_id
-                    WHERE fd1.id = pd.finantialdocument_ptr_id
-                        AND fd2.status = fd1.status)
-                """, [STATUS_READY])
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_documents(cls)
 
 
 class ProviderCreditDocument(ProviderDocument):
@@ -1102,45 +662,13 @@ class ProviderCreditDocument(ProviderDocument):
         verbose_name_plural = 'Providers Credits Documents'
 
     def fix_matched_amount(self):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_providerdocument pd SET pd.matched_amount = (
-                    SELECT COALESCE(
-                        CASE WHEN fd1.status != %s THEN 0 ELSE SUM(pdm.matched_amount) END,
-                        0)
-                    FROM finance_providerdocumentmatch pdm
-                        INNER JOIN finance_finantialdocument fd1
-                            ON fd1.id = pdm.credit_document_id
-                        INNER JOIN finance_finantialdocument fd2
-                            ON fd2.id = pdm.debit_document_id
-                    WHERE fd1.id = pd.finantialdocument_ptr_id
-                        AND fd2.status = fd1.status)
-                WHERE pd.finantialdocument_ptr_id = %s
-                """, [STATUS_READY, self.pk])
-            self.refresh_from_db()
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_document(self)
 
     @classmethod
     def fix_matched_amounts(cls):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("""
-                UPDATE finance_providerdocument pd SET pd.matched_amount = (
-                    SELECT COALESCE(
-                        CASE WHEN fd1.status != %s THEN 0 ELSE SUM(pdm.matched_amount) END,
-                        0)
-                    FROM finance_providerdocumentmatch pdm
-                        INNER JOIN finance_finantialdocument fd1
-                            ON fd1.id = pdm.credit_document_id
-                        INNER JOIN finance_finantialdocument fd2
-                            ON fd2.id = pdm.debit_document_id
-                    WHERE fd1.id = pd.finantialdocument_ptr_id
-                        AND fd2.status = fd1.status)
-                """, [STATUS_READY])
-        finally:
-            cursor.close()
+        from finance.reconciliation import SummaryReconciliation
+        SummaryReconciliation.fix_documents(cls)
 
 
 class ProviderInvoice(ProviderDebitDocument):
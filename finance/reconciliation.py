@@ -0,0 +1,276 @@
+"""
+finance summaries reconciliation
+
+Recomputes summary and document amounts with grouped aggregates, reports drift
+against stored values and optionally repairs it in bulk
+"""
+import time
+
+from django.db import transaction
+from django.db.models import Sum
+
+from finance.constants import STATUS_READY
+from finance.models import (
+    LoanEntityCurrency, LoanEntityDocument, LoanEntityDeposit, LoanEntityWithdraw,
+    LoanEntityMatch,
+    LoanAccount, LoanAccountDocument, LoanAccountDeposit, LoanAccountWithdraw,
+    LoanAccountMatch,
+    AgencyCurrency, AgencyDocument, AgencyCreditDocument, AgencyDebitDocument,
+    AgencyDocumentMatch,
+    ProviderCurrency, ProviderDocument, ProviderCreditDocument, ProviderDebitDocument,
+    ProviderDocumentMatch)
+
+
+BATCH_SIZE = 1000
+
+SUMMARY_FIELDS = ['credit_amount', 'debit_amount', 'matched_amount']
+
+# summary_keys on summary model correspond to document_keys on documents
+SUMMARIES = [
+    dict(
+        name='loan_entity',
+        summary_model=LoanEntityCurrency,
+        summary_keys=('loan_entity', 'currency'),
+        document_model=LoanEntityDocument,
+        document_keys=('loan_entity', 'currency'),
+        credit_model=LoanEntityDeposit,
+        debit_model=LoanEntityWithdraw,
+        match_model=LoanEntityMatch,
+        match_credit='loan_entity_deposit',
+        match_debit='loan_entity_withdraw'),
+    dict(
+        name='loan_account',
+        summary_model=LoanAccount,
+        summary_keys=('pk',),
+        document_model=LoanAccountDocument,
+        document_keys=('loan_account',),
+        credit_model=LoanAccountDeposit,
+        debit_model=LoanAccountWithdraw,
+        match_model=LoanAccountMatch,
+        match_credit='loan_account_deposit',
+        match_debit='loan_account_withdraw'),
+    dict(
+        name='agency',
+        summary_model=AgencyCurrency,
+        summary_keys=('agency', 'currency'),
+        document_model=AgencyDocument,
+        document_keys=('agency', 'currency'),
+        credit_model=AgencyCreditDocument,
+        debit_model=AgencyDebitDocument,
+        match_model=AgencyDocumentMatch,
+        match_credit='credit_document',
+        match_debit='debit_document'),
+    dict(
+        name='provider',
+        summary_model=ProviderCurrency,
+        summary_keys=('provider', 'currency'),
+        document_model=ProviderDocument,
+        document_keys=('provider', 'currency'),
+        credit_model=ProviderCreditDocument,
+        debit_model=ProviderDebitDocument,
+        match_model=ProviderDocumentMatch,
+        match_credit='credit_document',
+        match_debit='debit_document'),
+]
+
+
+class SummaryReconciliation(object):
+    """
+    SummaryReconciliation
+    """
+
+    @classmethod
+    def reconcile(cls, names=None, fix=False, log=None):
+        """
+        checks all summaries and matching documents, documents first as
+        finance services lock them before summaries. returns drifts found
+        """
+        drifts = list()
+        for spec in SUMMARIES:
+            if names and spec['name'] not in names:
+                continue
+            start = time.time()
+            document_drifts = cls.reconcile_documents(spec, fix=fix)
+            document_time = time.time() - start
+            start = time.time()
+            summary_drifts = cls.reconcile_summaries(spec, SUMMARY_FIELDS, fix=fix)
+            summary_time = time.time() - start
+            if log:
+                log('%s: %s document drifts in %.3fs, %s summary drifts in %.3fs' % (
+                    spec['name'], len(document_drifts), document_time,
+                    len(summary_drifts), summary_time))
+            drifts.extend(document_drifts)
+            drifts.extend(summary_drifts)
+        return drifts
+
+    @classmethod
+    def fix_summary(cls, summary, fields):
+        """
+        recomputes fields of one summary and refreshes it
+        """
+        spec = cls._find_spec(type(summary), 'summary_model')
+        cls.reconcile_summaries(spec, fields, fix=True, summary_id=summary.pk)
+        summary.refresh_from_db()
+
+    @classmethod
+    def fix_document(cls, document):
+        """
+        recomputes matched amount of one document and refreshes it
+        """
+        spec = cls._find_spec(type(document), 'document_model')
+        match_field = spec['match_credit']
+        if isinstance(document, spec['debit_model']):
+            match_field = spec['match_debit']
+        stored = spec['document_model'].objects.filter(
+            pk=document.pk).values_list('pk', 'matched_amount')
+        computed = cls._document_matched_amounts(
+            spec, match_field, {match_field: document.pk})
+        drifts = cls._document_drifts(spec, dict(stored), computed)
+        cls._fix_documents(spec, drifts)
+        document.refresh_from_db()
+
+    @classmethod
+    def fix_summaries(cls, summary_model, fields):
+        """
+        recomputes fields of all summaries of a model
+        """
+        cls.reconcile_summaries(cls._find_spec(summary_model, 'summary_model'), fields, fix=True)
+
+    @classmethod
+    def fix_documents(cls, document_model):
+        """
+        recomputes matched amount of all documents matched with document model ones
+        """
+        cls.reconcile_documents(cls._find_spec(document_model, 'document_model'), fix=True)
+
+    @classmethod
+    def reconcile_documents(cls, spec, fix=False):
+        """
+        checks matched amount of all matching documents of a summary kind
+        """
+        with transaction.atomic(savepoint=False):
+            stored = spec['document_model'].objects.exclude(
+                matched_amount=0).values_list('pk', 'matched_amount').order_by()
+            computed = cls._document_matched_amounts(spec, spec['match_credit'])
+            computed.update(cls._document_matched_amounts(spec, spec['match_debit']))
+            drifts = cls._document_drifts(spec, dict(stored.iterator()), computed)
+            if fix:
+                cls._fix_documents(spec, drifts)
+        return drifts
+
+    @classmethod
+    def reconcile_summaries(cls, spec, fields, fix=False, summary_id=None):
+        """
+        checks summary fields against ready documents and matches totals
+        """
+        summary_model = spec['summary_model']
+        keys = spec['summary_keys']
+        filters = dict()
+        with transaction.atomic(savepoint=False):
+            queryset = summary_model.objects.all()
+            if fix:
+                queryset = queryset.select_for_update()
+            if summary_id is not None:
+                queryset = queryset.filter(pk=summary_id)
+            stored = dict()
+            for row in queryset.values_list('pk', *(keys + tuple(fields))).order_by():
+                stored[row[1:len(keys) + 1]] = (row[0], row[len(keys) + 1:])
+            if summary_id is not None:
+                if not stored:
+                    return list()
+                filters = dict(zip(spec['document_keys'], list(stored)[0]))
+
+            computed = dict()
+            for index, field in enumerate(fields):
+                for key, total in cls._summary_totals(spec, field, filters).items():
+                    computed.setdefault(key, [0] * len(fields))[index] = total
+
+            drifts = list()
+            summaries = list()
+            for key in set(stored) | set(computed):
+                stored_id, stored_values = stored.get(key, (None, None))
+                computed_values = computed.get(key, [0] * len(fields))
+                for index, field in enumerate(fields):
+                    stored_value = stored_values[index] if stored_values else None
+                    if stored_value != computed_values[index]:
+                        drifts.append(dict(
+                            model=summary_model._meta.label, id=stored_id, key=key,
+                            field=field, stored=stored_value,
+                            computed=computed_values[index]))
+                if stored_values is None:
+                    # loan accounts are the summary themselves, always there
+                    if 'pk' not in keys:
+                        summary = summary_model(**dict(zip(fields, computed_values)))
+                        for name, value in zip(keys, key):
+                            setattr(summary, summary_model._meta.get_field(name).attname, value)
+                        summaries.append(summary)
+                elif list(stored_values) != list(computed_values):
+                    summaries.append(summary_model(
+                        pk=stored_id, **dict(zip(fields, computed_values))))
+            if fix:
+                summary_model.objects.bulk_update(
+                    [summary for summary in summaries if summary.pk],
+                    fields, batch_size=BATCH_SIZE)
+                summary_model.objects.bulk_create(
+                    [summary for summary in summaries if not summary.pk],
+                    batch_size=BATCH_SIZE)
+        return drifts
+
+    @classmethod
+    def _find_spec(cls, model, model_key):
+        for spec in SUMMARIES:
+            if issubclass(model, spec[model_key]):
+                return spec
+        raise ValueError('No summary for %s' % model._meta.label)
+
+    @classmethod
+    def _ready_matches(cls, spec, filters=None):
+        return spec['match_model'].objects.filter(**dict(
+            {'%s__status' % spec['match_credit']: STATUS_READY,
+             '%s__status' % spec['match_debit']: STATUS_READY},
+            **(filters or dict())))
+
+    @classmethod
+    def _document_matched_amounts(cls, spec, match_field, filters=None):
+        return dict(
+            cls._ready_matches(spec, filters).values_list(match_field).annotate(
+                total=Sum('matched_amount')).order_by())
+
+    @classmethod
+    def _document_drifts(cls, spec, stored, computed):
+        drifts = list()
+        for document_id in set(stored) | set(computed):
+            stored_value = stored.get(document_id, 0)
+            computed_value = computed.get(document_id, 0)
+            if stored_value != computed_value:
+                drifts.append(dict(
+                    model=spec['document_model']._meta.label, id=document_id,
+                    key=(document_id,), field='matched_amount',
+                    stored=stored_value, computed=computed_value))
+        return drifts
+
+    @classmethod
+    def _fix_documents(cls, spec, drifts):
+        document_model = spec['document_model']
+        document_model.objects.bulk_update(
+            [document_model(pk=drift['id'], matched_amount=drift['computed'])
+             for drift in drifts],
+            ['matched_amount'], batch_size=BATCH_SIZE)
+
+    @classmethod
+    def _summary_totals(cls, spec, field, filters):
+        if field == 'matched_amount':
+            prefix = '%s__' % spec['match_credit']
+            queryset = cls._ready_matches(spec, dict(
+                (prefix + name, value) for name, value in filters.items()))
+            keys = [prefix + name for name in spec['document_keys']]
+            amount = 'matched_amount'
+        else:
+            model = spec['credit_model'] if field == 'credit_amount' else spec['debit_model']
+            queryset = model.objects.filter(status=STATUS_READY, **filters)
+            keys = spec['document_keys']
+            amount = 'amount'
+        return dict(
+            (row[:-1], row[-1])
+            for row in queryset.values_list(*keys).annotate(
+                total=Sum(amount)).order_by().values_list(*(list(keys) + ['total'])))
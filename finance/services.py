@@ -6,6 +6,7 @@ Finance Service
 
 from django.core.exceptions import ValidationError
 from django.db import transaction
+from django.db.models import F, Q
 from django.utils import timezone
 
 from accounting.constants import (
@@ -16,7 +17,9 @@ from accounting.services import AccountingService
 
 from finance.constants import (
     STATUS_READY,
-    ERROR_MATCH_STATUS, ERROR_NOT_READY, ERROR_MATCH_AMOUNT, ERROR_MATCH_ACCOUNT,
+    AGENCY_CREDIT_DOC_TYPES, PROVIDER_CREDIT_DOC_TYPES,
+    MATCH_POLICIES, MATCH_POLICY_OLDEST, MATCH_POLICY_CONTENT_DATE, MATCH_POLICY_EXACT_AMOUNT,
+    ERROR_MATCH_POLICY, ERROR_MATCH_STATUS, ERROR_NOT_READY, ERROR_MATCH_AMOUNT, ERROR_MATCH_ACCOUNT,
     ERROR_MATCH_CURRENCY, ERROR_MATCH_LOAN_ENTITY, ERROR_MATCH_LOAN_ACCOUNT,
     ERROR_MATCH_AGENCY, ERROR_MATCH_PROVIDER, ERROR_MATCH_OVERMATCHED,
     ERROR_INVALID_MATCH, ERROR_MATCH_WITHOUT_AMOUNT, ERROR_DIFFERENT_DOCUMENTS)
@@ -25,12 +28,12 @@ from finance.models import (
     LoanEntityDeposit, LoanEntityWithdraw, LoanEntityMatch, LoanEntityCurrency,
     LoanAccountDeposit, LoanAccountWithdraw, LoanAccountMatch, LoanAccount,
     AgencyInvoice, AgencyPayment, AgencyDevolution, AgencyDiscount, AgencyDocumentMatch,
-    AgencyCreditDocument, AgencyDebitDocument, AgencyCurrency,
+    AgencyDocument, AgencyCreditDocument, AgencyDebitDocument, AgencyCurrency,
     ProviderInvoice, ProviderPayment, ProviderDevolution, ProviderDiscount, ProviderDocumentMatch,
-    ProviderCreditDocument, ProviderDebitDocument, ProviderCurrency,
+    ProviderDocument, ProviderCreditDocument, ProviderDebitDocument, ProviderCurrency,
     FinantialDocumentHistory, AccountingDocumentHistory)
 
-from reservas.utils import load_locked_model_object
+from reservas.utils import load_locked_model_object, retry_on_deadlock
 
 
 MATCH_TYPE_ENTITY = 1
@@ -46,6 +49,7 @@ class FinanceServices(object):
     """
 
     @classmethod
+    @retry_on_deadlock
     def save_deposit(cls, user, deposit):
         """
         Saves Deposit
@@ -65,6 +69,7 @@ class FinanceServices(object):
                 movement_type=MOVEMENT_TYPE_INPUT)
 
     @classmethod
+    @retry_on_deadlock
     def save_withdraw(cls, user, withdraw):
         """
         Saves Withdraw
@@ -84,17 +89,16 @@ class FinanceServices(object):
                 movement_type=MOVEMENT_TYPE_OUTPUT)
 
     @classmethod
+    @retry_on_deadlock
     def save_transfer(cls, user, transfer):
         """
         Saves Transfer
         """
         with transaction.atomic(savepoint=False):
             # load and lock accounts
-            account = load_locked_model_object(
-                pk=transfer.account_id, model_class=Account, allow_empty_pk=False)
-            other_account = load_locked_model_object(
-                pk=transfer.transfer_account_id, model_class=Account,
-                allow_empty_pk=False)
+            account, other_account = cls._get_locked_accounts(
+                account_id=transfer.account_id,
+                other_account_id=transfer.transfer_account_id)
             # verify accounts
             if account.currency != other_account.currency:
                 raise ValidationError(ERROR_DIFFERENT_CURRENCY % (account, other_account))
@@ -129,17 +133,16 @@ class FinanceServices(object):
                     db_other_amount=db_other_amount)
 
     @classmethod
+    @retry_on_deadlock
     def save_currency_exchange(cls, user, currency_exchange):
         """
         Saves Currency Exchange
         """
         with transaction.atomic(savepoint=False):
             # load and lock account
-            account = load_locked_model_object(
-                pk=currency_exchange.account_id, model_class=Account, allow_empty_pk=False)
-            other_account = load_locked_model_object(
-                pk=currency_exchange.exchange_account_id, model_class=Account,
-                allow_empty_pk=False)
+            account, other_account = cls._get_locked_accounts(
+                account_id=currency_exchange.account_id,
+                other_account_id=currency_exchange.exchange_account_id)
             # verify accounts
             if account.currency == other_account.currency:
                 raise ValidationError(ERROR_SAME_CURRENCY % (account, other_account))
@@ -164,6 +167,7 @@ class FinanceServices(object):
                 db_other_amount=db_other_amount)
 
     @classmethod
+    @retry_on_deadlock
     def save_loan_entity_deposit(cls, user, loan_entity_deposit):
         """
         Saves Loan Entity Deposit
@@ -195,6 +199,7 @@ class FinanceServices(object):
             return document
 
     @classmethod
+    @retry_on_deadlock
     def save_loan_entity_withdraw(cls, user, loan_entity_withdraw):
         """
         Saves Loan Withdraw
@@ -296,6 +301,7 @@ class FinanceServices(object):
             cls.save_loan_entity_match(new_db_match)
 
     @classmethod
+    @retry_on_deadlock
     def save_loan_entity_match(cls, loan_entity_match):
         """
         Save Loan Entity Match
@@ -321,6 +327,7 @@ class FinanceServices(object):
                     match_type=MATCH_TYPE_ENTITY)
 
     @classmethod
+    @retry_on_deadlock
     def delete_loan_entity_match(cls, loan_entity_match_id):
         """
         Delete Loan Entity Match
@@ -332,10 +339,8 @@ class FinanceServices(object):
                 raise ValidationError(ERROR_MODEL_NOT_FOUND % 'Loan Entity Match')
             matched_amount = loan_entity_match.matched_amount
             # obtain related documents and update matched_amount
-            loan_entity_deposit = load_locked_model_object(
-                pk=loan_entity_match.loan_entity_deposit_id, model_class=LoanEntityDeposit)
-            loan_entity_withdraw = load_locked_model_object(
-                pk=loan_entity_match.loan_entity_withdraw_id, model_class=LoanEntityWithdraw)
+            loan_entity_deposit, loan_entity_withdraw = cls._get_locked_match_documents(
+                document_match=loan_entity_match, match_type=MATCH_TYPE_ENTITY)
             # delete loan_match
             loan_entity_match.delete()
             # documents matched_amount
@@ -350,17 +355,16 @@ class FinanceServices(object):
                     match_type=MATCH_TYPE_ENTITY)
 
     @classmethod
+    @retry_on_deadlock
     def save_loan_account_deposit(cls, user, loan_account_deposit):
         """
         Saves Loan Account Deposit
         """
         with transaction.atomic(savepoint=False):
             # load and lock accounts
-            account = load_locked_model_object(
-                pk=loan_account_deposit.account_id, model_class=Account, allow_empty_pk=False)
-            other_account = load_locked_model_object(
-                pk=loan_account_deposit.loan_account.account_id, model_class=Account,
-                allow_empty_pk=False)
+            account, other_account = cls._get_locked_accounts(
+                account_id=loan_account_deposit.account_id,
+                other_account_id=loan_account_deposit.loan_account.account_id)
             # verify accounts
             if account.currency != other_account.currency:
                 raise ValidationError(ERROR_DIFFERENT_CURRENCY % (account, other_account))
@@ -393,17 +397,16 @@ class FinanceServices(object):
             return document
 
     @classmethod
+    @retry_on_deadlock
     def save_loan_account_withdraw(cls, user, loan_account_withdraw):
         """
         Saves Loan Account Withdraw
         """
         with transaction.atomic(savepoint=False):
             # load and lock accounts
-            account = load_locked_model_object(
-                pk=loan_account_withdraw.account_id, model_class=Account, allow_empty_pk=False)
-            other_account = load_locked_model_object(
-                pk=loan_account_withdraw.loan_account.account_id, model_class=Account,
-                allow_empty_pk=False)
+            account, other_account = cls._get_locked_accounts(
+                account_id=loan_account_withdraw.account_id,
+                other_account_id=loan_account_withdraw.loan_account.account_id)
             # verify accounts
             if account.currency != other_account.currency:
                 raise ValidationError(ERROR_DIFFERENT_CURRENCY % (account, other_account))
@@ -506,6 +509,7 @@ class FinanceServices(object):
             cls.save_loan_account_match(new_db_match)
 
     @classmethod
+    @retry_on_deadlock
     def save_loan_account_match(cls, loan_account_match):
         """
         Save Loan Account Match
@@ -531,6 +535,7 @@ class FinanceServices(object):
                     match_type=MATCH_TYPE_ACCOUNT)
 
     @classmethod
+    @retry_on_deadlock
     def delete_loan_account_match(cls, loan_account_match_id):
         """
         Delete Loan Account Match
@@ -542,10 +547,8 @@ class FinanceServices(object):
             if not loan_account_match:
                 raise ValidationError(ERROR_MODEL_NOT_FOUND % 'Loan Account Match')
             # obtain related documents and update matched_amount
-            loan_account_deposit = load_locked_model_object(
-                pk=loan_account_match.loan_account_deposit_id, model_class=LoanAccountDeposit)
-            loan_account_withdraw = load_locked_model_object(
-                pk=loan_account_match.loan_account_withdraw_id, model_class=LoanAccountWithdraw)
+            loan_account_deposit, loan_account_withdraw = cls._get_locked_match_documents(
+                document_match=loan_account_match, match_type=MATCH_TYPE_ACCOUNT)
             # delete loan account match
             loan_account_match.delete()
             # documents matched_amount
@@ -560,6 +563,7 @@ class FinanceServices(object):
                     match_type=MATCH_TYPE_ACCOUNT)
 
     @classmethod
+    @retry_on_deadlock
     def save_agency_invoice(cls, user, agency_invoice, model_class=None):
         """
         Saves Agency Invoice
@@ -589,6 +593,7 @@ class FinanceServices(object):
 
 
     @classmethod
+    @retry_on_deadlock
     def save_agency_payment(cls, user, agency_payment):
         """
         Saves Agency Payment
@@ -620,6 +625,7 @@ class FinanceServices(object):
             return document
 
     @classmethod
+    @retry_on_deadlock
     def save_agency_devolution(cls, user, agency_devolution):
         """
         Saves Agency Devolution
@@ -651,6 +657,7 @@ class FinanceServices(object):
             return document
 
     @classmethod
+    @retry_on_deadlock
     def save_agency_discount(cls, user, agency_discount):
         """
         Saves Agency Discount
@@ -751,6 +758,7 @@ class FinanceServices(object):
             cls.save_agency_match(new_db_match)
 
     @classmethod
+    @retry_on_deadlock
     def save_agency_match(cls, agency_match):
         """
         Save Agency Match
@@ -776,6 +784,7 @@ class FinanceServices(object):
                     match_type=MATCH_TYPE_AGENCY)
 
     @classmethod
+    @retry_on_deadlock
     def delete_agency_match(cls, agency_match_id):
         """
         Delete Agency Match
@@ -787,10 +796,8 @@ class FinanceServices(object):
                 raise ValidationError(ERROR_MODEL_NOT_FOUND % 'Agency Match')
             matched_amount = agency_match.matched_amount
             # obtain related documents and update matched_amount
-            credit_document = load_locked_model_object(
-                pk=agency_match.credit_document_id, model_class=AgencyCreditDocument)
-            debit_document = load_locked_model_object(
-                pk=agency_match.debit_document_id, model_class=AgencyDebitDocument)
+            credit_document, debit_document = cls._get_locked_match_documents(
+                document_match=agency_match, match_type=MATCH_TYPE_AGENCY)
             # delete agency_match
             agency_match.delete()
             # documents matched_amount
@@ -805,6 +812,33 @@ class FinanceServices(object):
                     match_type=MATCH_TYPE_AGENCY)
 
     @classmethod
+    @retry_on_deadlock
+    def auto_match_agency_documents(
+            cls, agency_id, currency, policy=MATCH_POLICY_OLDEST, credit_document_id=None):
+        """
+        Matches agency open credit documents, or only the credit document given,
+        against open debit documents of the same currency in policy order
+        """
+        return cls._auto_match(
+            match_type=MATCH_TYPE_AGENCY,
+            related_id=agency_id,
+            currency=currency,
+            policy=policy,
+            credit_document_id=credit_document_id)
+
+    @classmethod
+    def auto_match_agency_document(cls, credit_document, policy=MATCH_POLICY_OLDEST):
+        """
+        Matches agency credit document against open debit documents in policy order
+        """
+        return cls.auto_match_agency_documents(
+            agency_id=credit_document.agency_id,
+            currency=credit_document.currency,
+            policy=policy,
+            credit_document_id=credit_document.pk)
+
+    @classmethod
+    @retry_on_deadlock
     def save_provider_invoice(cls, user, provider_invoice):
         """
         Saves Provider Invoice
@@ -832,6 +866,7 @@ class FinanceServices(object):
 
 
     @classmethod
+    @retry_on_deadlock
     def save_provider_payment(cls, user, provider_payment):
         """
         Saves Provider Payment
@@ -863,6 +898,7 @@ class FinanceServices(object):
             return document
 
     @classmethod
+    @retry_on_deadlock
     def save_provider_discount(cls, user, provider_discount):
         """
         Saves Provider Discount
@@ -889,6 +925,7 @@ class FinanceServices(object):
             return document
 
     @classmethod
+    @retry_on_deadlock
     def save_provider_devolution(cls, user, provider_devolution):
         """
         Saves Provider Devolution
@@ -994,6 +1031,7 @@ class FinanceServices(object):
             cls.save_provider_match(new_db_match)
 
     @classmethod
+    @retry_on_deadlock
     def save_provider_match(cls, provider_match):
         """
         Save Provider Match
@@ -1019,6 +1057,7 @@ class FinanceServices(object):
                     match_type=MATCH_TYPE_PROVIDER)
 
     @classmethod
+    @retry_on_deadlock
     def delete_provider_match(cls, provider_match_id):
         """
         Delete Provider Match
@@ -1030,10 +1069,8 @@ class FinanceServices(object):
                 raise ValidationError(ERROR_MODEL_NOT_FOUND % 'Provider Match')
             matched_amount = provider_match.matched_amount
             # obtain related documents and update matched_amount
-            credit_document = load_locked_model_object(
-                pk=provider_match.credit_document_id, model_class=ProviderCreditDocument)
-            debit_document = load_locked_model_object(
-                pk=provider_match.debit_document_id, model_class=ProviderDebitDocument)
+            credit_document, debit_document = cls._get_locked_match_documents(
+                document_match=provider_match, match_type=MATCH_TYPE_PROVIDER)
             # delete provider_match
             provider_match.delete()
             # documents matched_amount
@@ -1047,6 +1084,32 @@ class FinanceServices(object):
                     delta_amount=-matched_amount,
                     match_type=MATCH_TYPE_PROVIDER)
 
+    @classmethod
+    @retry_on_deadlock
+    def auto_match_provider_documents(
+            cls, provider_id, currency, policy=MATCH_POLICY_OLDEST, credit_document_id=None):
+        """
+        Matches provider open credit documents, or only the credit document given,
+        against open debit documents of the same currency in policy order
+        """
+        return cls._auto_match(
+            match_type=MATCH_TYPE_PROVIDER,
+            related_id=provider_id,
+            currency=currency,
+            policy=policy,
+            credit_document_id=credit_document_id)
+
+    @classmethod
+    def auto_match_provider_document(cls, credit_document, policy=MATCH_POLICY_OLDEST):
+        """
+        Matches provider credit document against open debit documents in policy order
+        """
+        return cls.auto_match_provider_documents(
+            provider_id=credit_document.provider_id,
+            currency=credit_document.currency,
+            policy=policy,
+            credit_document_id=credit_document.pk)
+
     @classmethod
     def document_save(
             cls, user, document, db_document, account=None, movement_type=None,
@@ -1384,11 +1447,10 @@ class FinanceServices(object):
         matched_amount = document_match.matched_amount
         if matched_amount <= 0:
             raise ValidationError(ERROR_AMOUNT_REQUIRED)
-        # obtain credit document
-        credit_document = cls._get_locked_match_related(
+        # obtain credit and debit documents
+        credit_document, debit_document = cls._get_locked_match_documents(
             document_match=document_match,
-            match_type=match_type,
-            is_credit=True)
+            match_type=match_type)
         # verify status
         credit_msg = 'Loan Entity Deposit'
         if match_type == MATCH_TYPE_ACCOUNT:
@@ -1399,11 +1461,6 @@ class FinanceServices(object):
             credit_msg = 'Provider Credit Document'
         if credit_document.status != STATUS_READY:
             raise ValidationError(ERROR_NOT_READY % credit_msg)
-        # obtain debit document
-        debit_document = cls._get_locked_match_related(
-            document_match=document_match,
-            match_type=match_type,
-            is_credit=False)
         # verify status
         debit_msg = 'Loan Entity Withdraw'
         if match_type == MATCH_TYPE_ACCOUNT:
@@ -1496,6 +1553,116 @@ class FinanceServices(object):
         )
         return document_match
 
+    @classmethod
+    def _auto_match(cls, match_type, related_id, currency, policy, credit_document_id=None):
+        """
+        allocates open credit documents amounts to open debit documents.
+        All documents involved are locked at once ordered by id, matches are
+        created or increased in bulk and matched amounts updated with one query
+        """
+        if policy not in dict(MATCH_POLICIES):
+            raise ValidationError(ERROR_MATCH_POLICY % policy)
+        if match_type == MATCH_TYPE_AGENCY:
+            document_model = AgencyDocument
+            match_model = AgencyDocumentMatch
+            credit_types = AGENCY_CREDIT_DOC_TYPES
+            related_filter = dict(agency_id=related_id)
+        else:
+            document_model = ProviderDocument
+            match_model = ProviderDocumentMatch
+            credit_types = PROVIDER_CREDIT_DOC_TYPES
+            related_filter = dict(provider_id=related_id)
+
+        with transaction.atomic(savepoint=False):
+            queryset = document_model.objects.select_for_update().filter(
+                currency=currency,
+                status=STATUS_READY,
+                matched_amount__lt=F('amount'),
+                **related_filter)
+            if credit_document_id:
+                queryset = queryset.filter(
+                    Q(pk=credit_document_id) | ~Q(document_type__in=credit_types))
+            documents = list(queryset.order_by('pk'))
+
+            open_amounts = dict(
+                (document.pk, document.amount - document.matched_amount)
+                for document in documents)
+            credits = sorted(
+                [document for document in documents if document.document_type in credit_types],
+                key=lambda document: (document.date, document.pk))
+            debits = cls._auto_match_debits(
+                policy,
+                [document for document in documents
+                 if document.document_type not in credit_types])
+
+            # allocation
+            allocations = dict()
+            for credit in credits:
+                candidates = debits
+                if policy == MATCH_POLICY_EXACT_AMOUNT:
+                    # stable sort keeps oldest order among same amount kind
+                    candidates = sorted(
+                        debits,
+                        key=lambda debit: open_amounts[debit.pk] != open_amounts[credit.pk])
+                for debit in candidates:
+                    if open_amounts[credit.pk] <= 0:
+                        break
+                    amount = min(open_amounts[credit.pk], open_amounts[debit.pk])
+                    if amount <= 0:
+                        continue
+                    key = (credit.pk, debit.pk)
+                    allocations[key] = allocations.get(key, 0) + amount
+                    open_amounts[credit.pk] -= amount
+                    open_amounts[debit.pk] -= amount
+            if not allocations:
+                return []
+
+            # matches, pairs already matched are increased
+            existing = dict(
+                ((match.credit_document_id, match.debit_document_id), match)
+                for match in match_model.objects.filter(
+                    credit_document_id__in=set(key[0] for key in allocations),
+                    debit_document_id__in=set(key[1] for key in allocations)))
+            new_matches = list()
+            updated_matches = list()
+            for (credit_id, debit_id), amount in allocations.items():
+                match = existing.get((credit_id, debit_id))
+                if match is None:
+                    new_matches.append(match_model(
+                        credit_document_id=credit_id,
+                        debit_document_id=debit_id,
+                        matched_amount=amount))
+                else:
+                    match.matched_amount += amount
+                    updated_matches.append(match)
+            if updated_matches:
+                match_model.objects.bulk_update(updated_matches, ['matched_amount'])
+            match_model.objects.bulk_create(new_matches)
+
+            # documents matched_amount
+            changed = list()
+            for document in documents:
+                matched_amount = document.amount - open_amounts[document.pk]
+                if matched_amount != document.matched_amount:
+                    document.matched_amount = matched_amount
+                    changed.append(document)
+            document_model.objects.bulk_update(changed, ['matched_amount'])
+
+            # related summary matched_amount
+            cls._process_matched_amount(
+                related_id=related_id,
+                currency=currency,
+                delta_amount=sum(allocations.values()),
+                match_type=match_type)
+            return updated_matches + new_matches
+
+    @classmethod
+    def _auto_match_debits(cls, policy, debits):
+        if policy == MATCH_POLICY_CONTENT_DATE:
+            return sorted(debits, key=lambda document: (
+                document.content_date or document.date, document.date, document.pk))
+        return sorted(debits, key=lambda document: (document.date, document.pk))
+
     @classmethod
     def _process_summary_amount(cls, document, db_document, match_type, is_credit=False):
         old_ready = False
@@ -1517,82 +1684,51 @@ class FinanceServices(object):
             new_related_id = cls._get_related_id(document, match_type)
             new_currency = document.currency
             new_amount = document.amount
+        # summary deltas by related and currency
+        deltas = dict()
         if old_ready:
-            if new_ready:
-                if (new_related_id == old_related_id) and (new_currency == old_currency):
-                    if new_amount != old_amount:
-                        # get locked related
-                        related_summary = cls._get_locked_related_summary(
-                            related_id=new_related_id,
-                            currency=new_currency,
-                            match_type=match_type)
-                        # update amount
-                        if is_credit:
-                            related_summary.credit_amount += new_amount
-                            related_summary.credit_amount -= old_amount
-                        else:
-                            related_summary.debit_amount += new_amount
-                            related_summary.debit_amount -= old_amount
-                        related_summary.save()
-                else:
-                    # get locked old related
-                    related_summary = cls._get_locked_related_summary(
-                        related_id=old_related_id,
-                        currency=old_currency,
-                        match_type=match_type)
-                    # update amount
-                    if is_credit:
-                        related_summary.credit_amount -= old_amount
-                    else:
-                        related_summary.debit_amount -= old_amount
-                    related_summary.save()
-
-                    # get locked new related
-                    related_summary = cls._get_locked_related_summary(
-                        related_id=new_related_id,
-                        currency=new_currency,
-                        match_type=match_type)
-                    # update credit amount
-                    if is_credit:
-                        related_summary.credit_amount += new_amount
-                    else:
-                        related_summary.debit_amount += new_amount
-                    related_summary.save()
-            else:
-                # get locked old related
-                related_summary = cls._get_locked_related_summary(
-                    related_id=old_related_id,
-                    currency=old_currency,
-                    match_type=match_type)
-                # update amount
-                if is_credit:
-                    related_summary.credit_amount -= old_amount
-                else:
-                    related_summary.debit_amount -= old_amount
-                related_summary.save()
-        elif new_ready:
-            # get locked new related
-            related_summary = cls._get_locked_related_summary(
-                related_id=new_related_id,
-                currency=new_currency,
-                match_type=match_type)
-            # update amount
-            if is_credit:
-                related_summary.credit_amount += new_amount
-            else:
-                related_summary.debit_amount += new_amount
-            related_summary.save()
+            key = (old_related_id, old_currency)
+            deltas[key] = deltas.get(key, 0) - old_amount
+        if new_ready:
+            key = (new_related_id, new_currency)
+            deltas[key] = deltas.get(key, 0) + new_amount
+        cls._update_related_summaries(
+            field='credit_amount' if is_credit else 'debit_amount',
+            deltas=deltas,
+            match_type=match_type)
 
     @classmethod
     def _process_matched_amount(cls, related_id, currency, delta_amount, match_type):
-        # get locked related
-        related_summary = cls._get_locked_related_summary(
-            related_id=related_id,
-            currency=currency,
+        cls._update_related_summaries(
+            field='matched_amount',
+            deltas={(related_id, currency): delta_amount},
             match_type=match_type)
-        # update amount
-        related_summary.matched_amount += delta_amount
-        related_summary.save()
+
+    @classmethod
+    def _update_related_summaries(cls, field, deltas, match_type):
+        """
+        adds deltas to related summaries field with atomic increments, no read
+        lock needed. Summaries are updated by related and currency order so
+        transactions updating several summaries lock them in the same order
+        """
+        for related_id, currency in sorted(deltas):
+            delta_amount = deltas[(related_id, currency)]
+            if not delta_amount:
+                continue
+            model_class, lookup = cls._get_related_summary_lookup(
+                related_id=related_id,
+                currency=currency,
+                match_type=match_type)
+            increment = {field: F(field) + delta_amount}
+            if model_class.objects.filter(**lookup).update(**increment):
+                continue
+            if match_type == MATCH_TYPE_ACCOUNT:
+                raise ValidationError(ERROR_MODEL_NOT_FOUND % model_class.__name__)
+            # first document of related and currency
+            related_summary, created = model_class.objects.get_or_create(
+                defaults={field: delta_amount}, **lookup)
+            if not created:
+                model_class.objects.filter(**lookup).update(**increment)
 
     @classmethod
     def _get_related_id(cls, document, match_type):
@@ -1605,6 +1741,40 @@ class FinanceServices(object):
         if match_type == MATCH_TYPE_PROVIDER:
             return document.provider_id
 
+    @classmethod
+    def _get_locked_accounts(cls, account_id, other_account_id):
+        """
+        locks both accounts by id order
+        """
+        locked = dict()
+        for pk in sorted(set([account_id, other_account_id]), key=lambda pk: pk or 0):
+            locked[pk] = load_locked_model_object(
+                pk=pk, model_class=Account, allow_empty_pk=False)
+        return locked[account_id], locked[other_account_id]
+
+    @classmethod
+    def _get_locked_match_documents(cls, document_match, match_type):
+        """
+        locks match credit and debit documents by id order
+        """
+        if match_type == MATCH_TYPE_ENTITY:
+            credit_id = document_match.loan_entity_deposit_id
+            debit_id = document_match.loan_entity_withdraw_id
+        elif match_type == MATCH_TYPE_ACCOUNT:
+            credit_id = document_match.loan_account_deposit_id
+            debit_id = document_match.loan_account_withdraw_id
+        else:
+            credit_id = document_match.credit_document_id
+            debit_id = document_match.debit_document_id
+        locked = dict()
+        for is_credit in sorted([True, False], key=lambda is_credit: (
+                (credit_id if is_credit else debit_id) or 0)):
+            locked[is_credit] = cls._get_locked_match_related(
+                document_match=document_match,
+                match_type=match_type,
+                is_credit=is_credit)
+        return locked[True], locked[False]
+
     @classmethod
     def _get_locked_match_related(cls, document_match, match_type, is_credit):
         if match_type == MATCH_TYPE_ENTITY:
@@ -1637,32 +1807,12 @@ class FinanceServices(object):
                     pk=document_match.debit_document_id, model_class=ProviderDebitDocument)
 
     @classmethod
-    def _get_locked_related_summary(cls, related_id, currency, match_type):
+    def _get_related_summary_lookup(cls, related_id, currency, match_type):
         if match_type == MATCH_TYPE_ENTITY:
-            # find or create related
-            related_summary = LoanEntityCurrency.objects.get_or_create(
-                loan_entity_id=related_id,
-                currency=currency)
-            # load locked
-            return load_locked_model_object(
-                pk=related_summary[0].pk, model_class=LoanEntityCurrency)
+            return LoanEntityCurrency, dict(loan_entity_id=related_id, currency=currency)
         if match_type == MATCH_TYPE_ACCOUNT:
-            # load locked
-            return load_locked_model_object(
-                pk=related_id, model_class=LoanAccount)
+            return LoanAccount, dict(pk=related_id)
         if match_type == MATCH_TYPE_AGENCY:
-            # find or create related
-            related_summary = AgencyCurrency.objects.get_or_create(
-                agency_id=related_id,
-                currency=currency)
-            # load locked
-            return load_locked_model_object(
-                pk=related_summary[0].pk, model_class=AgencyCurrency)
+            return AgencyCurrency, dict(agency_id=related_id, currency=currency)
         if match_type == MATCH_TYPE_PROVIDER:
-            # find or create related
-            related_summary = ProviderCurrency.objects.get_or_create(
-                provider_id=related_id,
-                currency=currency)
-            # load locked
-            return load_locked_model_object(
-                pk=related_summary[0].pk, model_class=ProviderCurrency)
+            return ProviderCurrency, dict(provider_id=related_id, currency=currency)
@@ -0,0 +1,151 @@
+from datetime import date
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+
+from accounting.constants import CURRENCY_CUC
+from accounting.models import Account
+
+from finance.constants import (
+    STATUS_DRAFT, STATUS_READY, MATCH_POLICY_EXACT_AMOUNT, MATCH_POLICY_CONTENT_DATE)
+from finance.models import (
+    Agency, AgencyInvoice, AgencyPayment, AgencyDocumentMatch,
+    Provider, ProviderInvoice, ProviderPayment, ProviderDocumentMatch)
+from finance.services import FinanceServices
+from finance.tests.utils import FinanceBaseTestCase
+
+
+class FinanceServicesTestCase(FinanceBaseTestCase):
+
+    test_user = None
+
+    def setUp(self):
+        self.test_user = User.objects.create(
+            username="Test User")
+        self.test_account = Account.objects.create(
+            name='Test Account',
+            currency=CURRENCY_CUC,
+            balance=1000)
+        self.test_agency = Agency.objects.create(
+            name='Test Agency',
+            currency=CURRENCY_CUC)
+
+    def create_agency_invoice(self, test_date, amount, status=STATUS_READY, content_date=None):
+        return FinanceServices.save_agency_invoice(
+            user=self.test_user,
+            agency_invoice=AgencyInvoice(
+                date=test_date,
+                content_date=content_date,
+                currency=CURRENCY_CUC,
+                amount=amount,
+                agency=self.test_agency,
+                status=status))
+
+    def create_agency_payment(self, test_date, amount):
+        return FinanceServices.save_agency_payment(
+            user=self.test_user,
+            agency_payment=AgencyPayment(
+                date=test_date,
+                account=self.test_account,
+                amount=amount,
+                agency=self.test_agency,
+                status=STATUS_READY))
+
+    def assertMatchedAmounts(self, documents, amounts):
+        for document, amount in zip(documents, amounts):
+            document.refresh_from_db()
+            self.assertEqual(document.matched_amount, amount)
+
+    def test_agency_auto_match_oldest(self):
+        """
+        Does agency payment matched against oldest ready invoices first
+        """
+        invoices = [
+            self.create_agency_invoice(date(2020, 1, day), 100) for day in [3, 1, 2]]
+        draft_invoice = self.create_agency_invoice(date(2019, 1, 1), 100, STATUS_DRAFT)
+        payment = self.create_agency_payment(date(2020, 2, 1), 250)
+
+        matches = FinanceServices.auto_match_agency_document(payment)
+
+        self.assertEqual(len(matches), 3)
+        self.assertMatchedAmounts(invoices + [draft_invoice, payment], [50, 100, 100, 0, 250])
+        self.assertEqual(
+            sorted(AgencyDocumentMatch.objects.values_list('debit_document_id', 'matched_amount')),
+            [(invoices[0].pk, 50), (invoices[1].pk, 100), (invoices[2].pk, 100)])
+        self.assertAgencyCurrencyMatchedAmount(self.test_agency, CURRENCY_CUC, 250)
+
+    def test_agency_auto_match_increases_matches(self):
+        """
+        Does agency auto match increase existing matches and use all open payments
+        """
+        invoice = self.create_agency_invoice(date(2020, 1, 1), 100)
+        payment = self.create_agency_payment(date(2020, 2, 1), 60)
+        FinanceServices.auto_match_agency_document(payment)
+        invoice.refresh_from_db()
+        invoice.amount = 150
+        invoice = FinanceServices.save_agency_invoice(self.test_user, invoice)
+        other_payment = self.create_agency_payment(date(2020, 2, 2), 200)
+        payment.refresh_from_db()
+        payment.amount = 80
+        payment = FinanceServices.save_agency_payment(self.test_user, payment)
+
+        FinanceServices.auto_match_agency_documents(self.test_agency.pk, CURRENCY_CUC)
+
+        self.assertMatchedAmounts([invoice, payment, other_payment], [150, 80, 70])
+        self.assertEqual(
+            sorted(AgencyDocumentMatch.objects.values_list('credit_document_id', 'matched_amount')),
+            [(payment.pk, 80), (other_payment.pk, 70)])
+        self.assertAgencyCurrencyMatchedAmount(self.test_agency, CURRENCY_CUC, 150)
+
+    def test_agency_auto_match_policies(self):
+        """
+        Does agency auto match with exact amount and booking date policies
+        """
+        invoices = [
+            self.create_agency_invoice(date(2020, 1, 1), 100, content_date=date(2020, 3, 1)),
+            self.create_agency_invoice(date(2020, 1, 2), 80, content_date=date(2020, 2, 1)),
+            self.create_agency_invoice(date(2020, 1, 3), 50, content_date=date(2020, 1, 1))]
+
+        payment = self.create_agency_payment(date(2020, 2, 1), 80)
+        FinanceServices.auto_match_agency_document(payment, MATCH_POLICY_EXACT_AMOUNT)
+        self.assertMatchedAmounts(invoices, [0, 80, 0])
+
+        payment = self.create_agency_payment(date(2020, 2, 2), 60)
+        FinanceServices.auto_match_agency_document(payment, MATCH_POLICY_CONTENT_DATE)
+        self.assertMatchedAmounts(invoices, [10, 80, 50])
+
+        with self.assertRaises(ValidationError):
+            FinanceServices.auto_match_agency_document(payment, 'newest')
+
+    def test_provider_auto_match_oldest(self):
+        """
+        Does provider payment matched against oldest invoices first
+        """
+        test_provider = Provider.objects.create(
+            name='Test Provider',
+            currency=CURRENCY_CUC)
+        invoices = list()
+        for day in [2, 1]:
+            invoices.append(FinanceServices.save_provider_invoice(
+                user=self.test_user,
+                provider_invoice=ProviderInvoice(
+                    date=date(2020, 1, day),
+                    currency=CURRENCY_CUC,
+                    amount=100,
+                    provider=test_provider,
+                    status=STATUS_READY)))
+        payment = FinanceServices.save_provider_payment(
+            user=self.test_user,
+            provider_payment=ProviderPayment(
+                date=date(2020, 2, 1),
+                account=self.test_account,
+                amount=Decimal('120.50'),
+                provider=test_provider,
+                status=STATUS_READY))
+
+        FinanceServices.auto_match_provider_document(payment)
+
+        self.assertMatchedAmounts(invoices + [payment], [Decimal('20.50'), 100, Decimal('120.50')])
+        self.assertEqual(ProviderDocumentMatch.objects.count(), 2)
+        self.assertProviderCurrencyMatchedAmount(test_provider, CURRENCY_CUC, Decimal('120.50'))
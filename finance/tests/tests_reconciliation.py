@@ -0,0 +1,102 @@
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+
+from accounting.constants import CURRENCY_CUC
+from accounting.models import Account
+
+from finance.constants import STATUS_DRAFT, STATUS_READY
+from finance.models import (
+    Agency, AgencyCurrency, AgencyDocument, AgencyInvoice, AgencyPayment,
+    LoanEntity, LoanEntityCurrency, LoanEntityWithdraw)
+from finance.reconciliation import SummaryReconciliation
+from finance.services import FinanceServices
+from finance.tests.utils import FinanceBaseTestCase
+
+
+class FinanceReconciliationTestCase(FinanceBaseTestCase):
+
+    def setUp(self):
+        self.test_user = User.objects.create(
+            username="Test User")
+        self.test_account = Account.objects.create(
+            name='Test Account',
+            currency=CURRENCY_CUC,
+            balance=1000)
+        self.test_agency = Agency.objects.create(
+            name='Test Agency',
+            currency=CURRENCY_CUC)
+        self.invoice = FinanceServices.save_agency_invoice(
+            user=self.test_user,
+            agency_invoice=AgencyInvoice(
+                currency=CURRENCY_CUC,
+                amount=100,
+                agency=self.test_agency,
+                status=STATUS_READY))
+        self.payment = FinanceServices.save_agency_payment(
+            user=self.test_user,
+            agency_payment=AgencyPayment(
+                account=self.test_account,
+                amount=60,
+                agency=self.test_agency,
+                status=STATUS_READY))
+        FinanceServices.auto_match_agency_document(self.payment)
+
+    def test_reconcile_without_drift(self):
+        """
+        Does reconcile find no drift on summaries kept by services
+        """
+        self.assertEqual(SummaryReconciliation.reconcile(), [])
+
+    def test_reconcile_drift(self):
+        """
+        Does reconcile report drift on dry run and repair it in bulk
+        """
+        AgencyCurrency.objects.update(debit_amount=0, matched_amount=10)
+        AgencyDocument.objects.filter(pk=self.invoice.pk).update(matched_amount=0)
+
+        out = StringIO()
+        call_command('reconcile_summaries', 'agency', dry_run=True, stdout=out)
+        self.assertIn('3 drifts found', out.getvalue())
+        self.assertEqual(
+            sorted(drift['field'] for drift in SummaryReconciliation.reconcile()),
+            ['debit_amount', 'matched_amount', 'matched_amount'])
+
+        call_command('reconcile_summaries', stdout=StringIO())
+        self.assertEqual(SummaryReconciliation.reconcile(), [])
+        self.assertAgencyCurrencyDebitAmount(self.test_agency, CURRENCY_CUC, 100)
+        self.assertAgencyCurrencyMatchedAmount(self.test_agency, CURRENCY_CUC, 60)
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.matched_amount, 60)
+
+    def test_reconcile_missing_summary(self):
+        """
+        Does reconcile create missing summaries and fix debit amount only
+        """
+        loan_entity = LoanEntity.objects.create(name='Test Loan Entity')
+        FinanceServices.save_loan_entity_withdraw(
+            user=self.test_user,
+            loan_entity_withdraw=LoanEntityWithdraw(
+                account=self.test_account,
+                amount=30,
+                loan_entity=loan_entity,
+                status=STATUS_READY))
+        FinanceServices.save_loan_entity_withdraw(
+            user=self.test_user,
+            loan_entity_withdraw=LoanEntityWithdraw(
+                account=self.test_account,
+                amount=50,
+                loan_entity=loan_entity,
+                status=STATUS_DRAFT))
+        loan_entity_currency = LoanEntityCurrency.objects.get(loan_entity=loan_entity)
+        LoanEntityCurrency.objects.update(credit_amount=5, debit_amount=0)
+
+        loan_entity_currency.fix_debit_amount()
+        self.assertEqual(loan_entity_currency.credit_amount, 5)
+        self.assertEqual(loan_entity_currency.debit_amount, 30)
+
+        loan_entity_currency.delete()
+        SummaryReconciliation.reconcile(names=['loan_entity'], fix=True)
+        self.assertLoanEntityCurrencyCreditAmount(loan_entity, CURRENCY_CUC, 0)
+        self.assertLoanEntityCurrencyDebitAmount(loan_entity, CURRENCY_CUC, 30)
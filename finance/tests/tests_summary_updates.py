@@ -0,0 +1,196 @@
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import OperationalError, connection, transaction
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from accounting.constants import CURRENCY_CUC
+from accounting.models import Account
+
+from finance.constants import STATUS_DRAFT, STATUS_READY
+from finance.models import (
+    Agency, AgencyCurrency, AgencyDocumentMatch, AgencyInvoice, AgencyPayment)
+from finance.services import FinanceServices
+from finance.tests.utils import FinanceBaseTestCase
+
+from reservas.utils import retry_on_deadlock
+
+
+class FinanceSummaryUpdatesMixin(object):
+
+    def setUp(self):
+        self.test_user = User.objects.create(
+            username="Test User")
+        self.test_account = Account.objects.create(
+            name='Test Account',
+            currency=CURRENCY_CUC,
+            balance=1000)
+        self.test_agency = Agency.objects.create(
+            name='Test Agency',
+            currency=CURRENCY_CUC)
+
+    def save_payment(self, amount, status=STATUS_READY, payment=None):
+        if payment is None:
+            payment = AgencyPayment(
+                account=self.test_account,
+                agency=self.test_agency)
+        payment.amount = amount
+        payment.status = status
+        return FinanceServices.save_agency_payment(
+            user=self.test_user,
+            agency_payment=payment)
+
+    def agency_currency(self):
+        return AgencyCurrency.objects.get(agency=self.test_agency, currency=CURRENCY_CUC)
+
+
+class FinanceSummaryUpdatesTestCase(FinanceSummaryUpdatesMixin, FinanceBaseTestCase):
+
+    def test_summary_increments(self):
+        """
+        Does agency currency updated with increments without reading it
+        """
+        payment = self.save_payment(100)
+        self.assertAgencyCurrencyCreditAmount(self.test_agency, CURRENCY_CUC, 100)
+
+        with CaptureQueriesContext(connection) as captured:
+            self.save_payment(50)
+        summary_queries = [
+            query['sql'] for query in captured if 'finance_agencycurrency' in query['sql']]
+        self.assertEqual(len(summary_queries), 1)
+        self.assertTrue(summary_queries[0].startswith('UPDATE'))
+        self.assertAgencyCurrencyCreditAmount(self.test_agency, CURRENCY_CUC, 150)
+
+        self.save_payment(100, STATUS_DRAFT, payment)
+        self.assertAgencyCurrencyCreditAmount(self.test_agency, CURRENCY_CUC, 50)
+
+
+class RetryOnDeadlockTestCase(TransactionTestCase):
+
+    def test_retry_on_deadlock(self):
+        """
+        Does deadlock victims rerun and other errors raised at once
+        """
+        calls = list()
+
+        @retry_on_deadlock
+        def deadlocked(error):
+            calls.append(error)
+            if len(calls) < 3:
+                raise error
+            return len(calls)
+
+        self.assertEqual(deadlocked(OperationalError(1213, 'Deadlock found')), 3)
+
+        calls.clear()
+        with self.assertRaises(OperationalError):
+            deadlocked(OperationalError(1054, 'Unknown column'))
+        self.assertEqual(len(calls), 1)
+
+
+class FinanceDeadlockRetryTestCase(FinanceSummaryUpdatesMixin, TransactionTestCase):
+    """
+    deadlocks are only retried outside transactions, test case ones included
+    """
+
+    def deadlock_once(self, method_name):
+        method = getattr(FinanceServices, method_name)
+        calls = list()
+
+        def deadlocked(*args, **kwargs):
+            calls.append(kwargs)
+            if len(calls) == 1:
+                raise OperationalError(1213, 'Deadlock found when trying to get lock')
+            return method(*args, **kwargs)
+        return mock.patch.object(FinanceServices, method_name, side_effect=deadlocked), calls
+
+    def test_retry_new_payment(self):
+        """
+        Does new payment saved once when first attempt is a deadlock victim
+        """
+        patcher, calls = self.deadlock_once('_process_summary_amount')
+        with patcher:
+            payment = self.save_payment(100)
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(AgencyPayment.objects.get().pk, payment.pk)
+        self.assertEqual(self.agency_currency().credit_amount, 100)
+        self.test_account.refresh_from_db()
+        self.assertEqual(self.test_account.balance, 1100)
+
+    def test_retry_new_match(self):
+        """
+        Does new match saved once when first attempt is a deadlock victim
+        """
+        payment = self.save_payment(100)
+        invoice = FinanceServices.save_agency_invoice(
+            user=self.test_user,
+            agency_invoice=AgencyInvoice(
+                currency=CURRENCY_CUC, amount=80, agency=self.test_agency, status=STATUS_READY))
+
+        patcher, calls = self.deadlock_once('_process_matched_amount')
+        with patcher:
+            FinanceServices.save_agency_match(AgencyDocumentMatch(
+                credit_document=payment.agencycreditdocument_ptr,
+                debit_document=invoice.agencydebitdocument_ptr,
+                matched_amount=80))
+
+        self.assertEqual(AgencyDocumentMatch.objects.count(), 1)
+        self.assertEqual(self.agency_currency().matched_amount, 80)
+        invoice.refresh_from_db()
+        self.assertEqual(invoice.matched_amount, 80)
+
+    def test_retry_at_transaction_boundary(self):
+        """
+        Does deadlock inside a transaction rerun the whole transaction
+        """
+        @retry_on_deadlock
+        def save_payments(payments):
+            with transaction.atomic(savepoint=False):
+                for payment in payments:
+                    FinanceServices.save_agency_payment(
+                        user=self.test_user, agency_payment=payment)
+
+        payments = [
+            AgencyPayment(
+                account=self.test_account, agency=self.test_agency,
+                amount=amount, status=STATUS_READY)
+            for amount in [100, 50]]
+        patcher, calls = self.deadlock_once('_process_summary_amount')
+        with patcher:
+            save_payments(payments)
+
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(AgencyPayment.objects.count(), 2)
+        self.assertEqual(self.agency_currency().credit_amount, 150)
+        self.test_account.refresh_from_db()
+        self.assertEqual(self.test_account.balance, 1150)
+
+    def test_no_retry_after_commit(self):
+        """
+        Does deadlock raised by a commit hook not rerun the committed transaction
+        """
+        calls = list()
+
+        def deadlocked():
+            calls.append(None)
+            if len(calls) == 1:
+                raise OperationalError(1213, 'Deadlock found when trying to get lock')
+
+        @retry_on_deadlock
+        def save_payment(payment):
+            with transaction.atomic(savepoint=False):
+                FinanceServices.save_agency_payment(
+                    user=self.test_user, agency_payment=payment)
+                transaction.on_commit(deadlocked)
+
+        payment = AgencyPayment(
+            account=self.test_account, agency=self.test_agency,
+            amount=100, status=STATUS_READY)
+        with self.assertRaises(OperationalError):
+            save_payment(payment)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(AgencyPayment.objects.get().pk, payment.pk)
+        self.assertEqual(self.agency_currency().credit_amount, 100)
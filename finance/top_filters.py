@@ -41,5 +41,4 @@ class EnabledTopFilter(filters.BooleanFilter):
             # queryset = queryset.filter(status__exact=BOOKING_STATUS_CANCELLED)
             queryset = queryset.filter(enabled=False)
 
-        queryset = queryset.distinct()
         return queryset
@@ -72,6 +72,8 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     # 'django_pdb.middleware.PdbMiddleware',
     'common.middleware.SetOrganizationMiddleware',
+    'common.middleware.RecentLinkMiddleware',
+    # 'common.middleware.QueryStatsMiddleware',
 ]
 
 ROOT_URLCONF = 'reservas.urls'
@@ -1,7 +1,16 @@
 """
 reservas utils
 """
+import random
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
 from django.core.exceptions import ValidationError
+from django.db import OperationalError, connection, models, transaction
 
 
 ERROR_MODEL_NOT_FOUND = 'Invalid %s PK'
@@ -18,3 +27,94 @@ def load_locked_model_object(pk, model_class, allow_empty_pk=True):
     elif not allow_empty_pk:
         raise ValidationError(ERROR_MODEL_NOT_FOUND % model_class.__name__)
     return db_model_object
+
+
+def get_shared_cache(setting_name):
+    """
+    returns the django cache named by setting when it is shared by processes,
+    None when the setting is missing or names a local memory or dummy cache
+    """
+    alias = getattr(settings, setting_name, None)
+    if not alias:
+        return None
+    backend = caches[alias]
+    if isinstance(backend, (LocMemCache, DummyCache)):
+        return None
+    return backend
+
+
+# mysql deadlock victim and lock wait timeout
+DEADLOCK_ERROR_CODES = (1213, 1205)
+
+DEADLOCK_RETRIES = 3
+
+# seconds, random wait grows by attempt
+DEADLOCK_RETRY_WAIT = 0.05
+
+
+def is_deadlock(error):
+    if error.args and error.args[0] in DEADLOCK_ERROR_CODES:
+        return True
+    message = str(error).lower()
+    return 'deadlock' in message or 'database is locked' in message
+
+
+def _model_instances(values):
+    for value in values:
+        if isinstance(value, models.Model):
+            yield value
+        elif isinstance(value, dict):
+            yield from _model_instances(value.values())
+        elif isinstance(value, (list, tuple)):
+            yield from _model_instances(value)
+
+
+def _save_instances_state(args, kwargs):
+    """
+    returns attributes of model instances in arguments, those saved by the
+    rolled back attempt keep their pk and would be updated on retry
+    """
+    return [
+        (instance, dict(instance.__dict__), instance._state.adding, instance._state.db,
+         dict(instance._state.fields_cache))
+        for instance in _model_instances(list(args) + list(kwargs.values()))]
+
+
+def _restore_instances_state(states):
+    for instance, attributes, adding, db, fields_cache in states:
+        instance.__dict__.clear()
+        instance.__dict__.update(attributes)
+        instance._state.adding = adding
+        instance._state.db = db
+        instance._state.fields_cache = fields_cache
+
+
+def retry_on_deadlock(func):
+    """
+    reruns func in one transaction when it was rolled back by a deadlock.
+    Model instances in arguments, in lists or dicts too, get back
+    their state before the attempt.
+    Only outermost calls are retried, inside an enclosing transaction
+    the error is raised for the whole transaction to be rerun.
+    Errors raised by commit hooks are never retried, data is already committed
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if connection.in_atomic_block:
+            return func(*args, **kwargs)
+        attempt = 0
+        states = _save_instances_state(args, kwargs)
+        while True:
+            committed = list()
+            try:
+                with transaction.atomic(savepoint=False):
+                    # first commit hook, marks that next ones run on committed data
+                    transaction.on_commit(lambda: committed.append(True))
+                    return func(*args, **kwargs)
+            except OperationalError as ex:
+                attempt += 1
+                if committed or attempt > DEADLOCK_RETRIES or not is_deadlock(ex):
+                    raise
+                time.sleep(random.uniform(0, DEADLOCK_RETRY_WAIT * attempt))
+                _restore_instances_state(states)
+    return wrapper